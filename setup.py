@@ -11,6 +11,7 @@ setup(
             "simple_p2p.udp",
             "simple_p2p.common",
             "simple_p2p.repository",
+            "simple_p2p.bulk",
         ]
     ),
     entry_points={"console_scripts": ["simple-p2p = simple_p2p.core.main:run"]},
@@ -0,0 +1,55 @@
+from typing import Iterable, Optional
+
+
+def xor_parity(payloads: Iterable[bytes], size: int) -> bytes:
+    """
+    Parity packet of a group: the XOR of its payloads padded with zeros to `size`.
+    Any single payload of the group is the XOR of the parity and the others.
+    """
+    parity = 0
+    for payload in payloads:
+        # little endian, so that the padding zeros do not change the value
+        parity ^= int.from_bytes(payload, "little")
+    return parity.to_bytes(size, "little")
+
+
+class ParityGroup:
+    """
+    Running XOR of the packets of a group received so far,
+    recovers a single lost data packet once the parity arrived.
+    Does not perform locking.
+    """
+
+    __slots__ = ("_size", "_received", "_has_parity", "_value")
+
+    def __init__(self, size: int):
+        # data packets in the group
+        self._size = size
+        self._received = 0
+        self._has_parity = False
+        self._value = 0
+
+    @property
+    def missing(self) -> int:
+        return self._size - self._received
+
+    def add_data(self, payload: bytes):
+        self._received += 1
+        self._value ^= int.from_bytes(payload, "little")
+
+    def add_parity(self, payload: bytes):
+        if not self._has_parity:
+            self._has_parity = True
+            self._value ^= int.from_bytes(payload, "little")
+
+    def recover(self, length: int) -> Optional[bytes]:
+        """
+        The missing data packet of `length` bytes,
+        None unless exactly one is missing and the parity arrived
+        """
+        if not self._has_parity or self.missing != 1:
+            return None
+        if self._value.bit_length() > 8 * length:
+            # the parity does not match the packets
+            return None
+        return self._value.to_bytes(length, "little")
@@ -0,0 +1,199 @@
+import binascii
+import struct
+from enum import IntEnum
+from typing import List, Tuple
+
+from simple_p2p.common.config import BULK_MAGIC_NUMBER, DIGEST_ALG, ENCODING
+from simple_p2p.common.digests import algorithm_by_id, get_algorithm, split_digest
+
+
+class BulkPacketType(IntEnum):
+    ANNOUNCE = 1
+    DATA = 2
+    PARITY = 3
+    NACK = 4
+
+
+# magic number, packet type, session id
+HEADER_STRUCT = struct.Struct("!HBI")
+# index of the data packet, or of the group for parity
+INDEX_STRUCT = struct.Struct("!I")
+NACK_COUNT_STRUCT = struct.Struct("!H")
+# first missing packet and number of packets missing after it
+NACK_RANGE_STRUCT = struct.Struct("!II")
+
+
+def parse_packet(data: bytes) -> Tuple[BulkPacketType, int, memoryview]:
+    """
+    Returns the type, session and body of a packet.
+    Raises `ValueError` if it is not a bulk packet.
+    """
+    try:
+        (magic_number, packet_type, session) = HEADER_STRUCT.unpack_from(data)
+    except struct.error:
+        raise ValueError("Truncated packet")
+    if magic_number != BULK_MAGIC_NUMBER:
+        raise ValueError("Unknown magic number")
+    return (BulkPacketType(packet_type), session, memoryview(data)[HEADER_STRUCT.size :])
+
+
+def _header(packet_type: BulkPacketType, session: int) -> bytes:
+    return HEADER_STRUCT.pack(BULK_MAGIC_NUMBER, packet_type, session)
+
+
+def pack_indexed(
+    packet_type: BulkPacketType, session: int, index: int, payload: bytes
+) -> bytes:
+    """
+    DATA packet `index` or PARITY packet of group `index`
+    """
+    return b"".join((_header(packet_type, session), INDEX_STRUCT.pack(index), payload))
+
+
+def unpack_indexed(body: memoryview) -> Tuple[int, memoryview]:
+    """
+    Raises `ValueError` if the packet is truncated
+    """
+    if len(body) < INDEX_STRUCT.size:
+        raise ValueError("Truncated packet")
+    (index,) = INDEX_STRUCT.unpack_from(body)
+    return (index, body[INDEX_STRUCT.size :])
+
+
+def pack_nack(session: int, ranges: List[Tuple[int, int]]) -> bytes:
+    parts = [_header(BulkPacketType.NACK, session), NACK_COUNT_STRUCT.pack(len(ranges))]
+    parts.extend(NACK_RANGE_STRUCT.pack(first, count) for (first, count) in ranges)
+    return b"".join(parts)
+
+
+def unpack_nack(body: memoryview) -> List[Tuple[int, int]]:
+    """
+    Raises `ValueError` if the packet is truncated
+    """
+    try:
+        (count,) = NACK_COUNT_STRUCT.unpack_from(body)
+        return [
+            NACK_RANGE_STRUCT.unpack_from(
+                body, NACK_COUNT_STRUCT.size + index * NACK_RANGE_STRUCT.size
+            )
+            for index in range(count)
+        ]
+    except struct.error:
+        raise ValueError("Truncated packet")
+
+
+class Announce:
+    """
+    Description of a file sent to the group, repeated during the transfer
+    so that the receivers can join late and know where to send NACKs
+    """
+
+    # size, payload size, group size, NACK port, flags, raw digest, name length
+    _codec = struct.Struct("!QHBHB32sB")
+    # after the name, the digest algorithm id, ignored by the older receivers
+    # which only know DIGEST_ALG digests
+    _alg_codec = struct.Struct("!B")
+    # the sender finished a pass over the file and waits for NACKs
+    FLAG_END_OF_PASS = 0x01
+
+    __slots__ = (
+        "session",
+        "name",
+        "digest",
+        "size",
+        "payload_size",
+        "group_size",
+        "nack_port",
+        "flags",
+    )
+
+    def __init__(
+        self,
+        session: int,
+        name: str,
+        digest: str,
+        size: int,
+        payload_size: int,
+        group_size: int,
+        nack_port: int,
+        flags: int = 0,
+    ):
+        self.session = session
+        self.name = name
+        self.digest = digest
+        self.size = size
+        self.payload_size = payload_size
+        self.group_size = group_size
+        self.nack_port = nack_port
+        self.flags = flags
+
+    @property
+    def end_of_pass(self) -> bool:
+        return bool(self.flags & self.FLAG_END_OF_PASS)
+
+    @property
+    def packet_count(self) -> int:
+        return (self.size + self.payload_size - 1) // self.payload_size
+
+    def payload_length(self, index: int) -> int:
+        """
+        Length of data packet `index`, only the last one is shorter
+        """
+        return min(self.payload_size, self.size - index * self.payload_size)
+
+    def to_bytes(self) -> bytes:
+        name = self.name.encode(ENCODING)
+        (algorithm, hex_digest) = split_digest(self.digest)
+        return b"".join(
+            (
+                _header(BulkPacketType.ANNOUNCE, self.session),
+                self._codec.pack(
+                    self.size,
+                    self.payload_size,
+                    self.group_size,
+                    self.nack_port,
+                    self.flags,
+                    binascii.unhexlify(hex_digest),
+                    len(name),
+                ),
+                name,
+                self._alg_codec.pack(algorithm.alg_id),
+            )
+        )
+
+    @classmethod
+    def from_body(cls, session: int, body: memoryview) -> "Announce":
+        """
+        Raises `ValueError` if the packet is malformed
+        """
+        try:
+            (
+                size,
+                payload_size,
+                group_size,
+                nack_port,
+                flags,
+                digest,
+                name_length,
+            ) = cls._codec.unpack_from(body)
+            name_end = cls._codec.size + name_length
+            name = bytes(body[cls._codec.size : name_end])
+            if len(name) != name_length or not payload_size or not group_size:
+                raise ValueError("Malformed announce")
+            if len(body) > name_end:
+                (alg_id,) = cls._alg_codec.unpack_from(body, name_end)
+                algorithm = algorithm_by_id(alg_id)
+            else:
+                algorithm = get_algorithm(DIGEST_ALG)
+            return cls(
+                session,
+                name.decode(ENCODING),
+                algorithm.format(binascii.hexlify(digest[: algorithm.size]).decode("ascii")),
+                size,
+                payload_size,
+                group_size,
+                nack_port,
+                flags,
+            )
+        except (struct.error, UnicodeDecodeError, KeyError):
+            raise ValueError("Malformed announce")
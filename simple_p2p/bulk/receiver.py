@@ -0,0 +1,307 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from simple_p2p.bulk.fec import ParityGroup
+from simple_p2p.bulk.packets import (
+    Announce,
+    BulkPacketType,
+    pack_nack,
+    parse_packet,
+    unpack_indexed,
+)
+from simple_p2p.bulk.sockets import group_socket
+from simple_p2p.common.config import (
+    BULK_MAX_NACK_RANGES,
+    BULK_NACK_DELAY,
+    BULK_SESSION_TIMEOUT,
+    Config,
+)
+from simple_p2p.common.models import AbstractController, FileMetadata
+from simple_p2p.file_transfer.context import FileProviderContext
+
+# sessions refused, e.g. files that are here already, before they are forgotten
+MAX_REFUSED_SESSIONS = 1024
+
+
+class BulkReceiver:
+    """
+    Writes the packets of a multicast session into a file being downloaded,
+    recovering the lost ones from the parity of their group when possible,
+    and asks the sender for the others in NACKs after every pass.
+    Runs on the loop of the listener, does not perform locking.
+    """
+
+    def __init__(
+        self,
+        controller: AbstractController,
+        file: FileMetadata,
+        announce: Announce,
+        sender: Tuple[str, int],
+        transport: asyncio.DatagramTransport,
+    ):
+        self._logger = logging.getLogger("BulkReceiver")
+        self._controller = controller
+        self._file = file
+        self._announce = announce
+        self._sender = sender
+        self._transport = transport
+        self._loop = asyncio.get_running_loop()
+        self._context = FileProviderContext(controller, file, sender)
+        self._context.__enter__()
+        self._fd = os.open(file.path, os.O_RDWR | os.O_CREAT)
+        self._received = bytearray(announce.packet_count)
+        self._missing = announce.packet_count
+        # packets received in order from the beginning, the resume offset
+        self._prefix = 0
+        self._groups: Dict[int, ParityGroup] = {}
+        self._recovered = 0
+        self._nack_handle: Optional[asyncio.TimerHandle] = None
+        self._last_packet = time.monotonic()
+        self._idle_handle = self._loop.call_later(BULK_SESSION_TIMEOUT, self._check_idle)
+        self.done = False
+
+    def announced(self, announce: Announce):
+        self._last_packet = time.monotonic()
+        if announce.end_of_pass and self._missing and self._nack_handle is None:
+            # spread the NACKs of the receivers
+            self._nack_handle = self._loop.call_later(
+                random.uniform(0, BULK_NACK_DELAY), self._send_nack
+            )
+
+    def data(self, index: int, payload: memoryview):
+        announce = self._announce
+        if (
+            index >= announce.packet_count
+            or self._received[index]
+            or len(payload) != announce.payload_length(index)
+        ):
+            return
+        group_index = index // announce.group_size
+        group = self._groups.get(group_index)
+        if group is None:
+            group = self._groups[group_index] = ParityGroup(self._group_length(group_index))
+        group.add_data(payload)
+        self._store(index, payload)
+        self._settle(group_index, group)
+
+    def parity(self, group_index: int, payload: memoryview):
+        announce = self._announce
+        if (
+            len(payload) != announce.payload_size
+            or group_index * announce.group_size >= announce.packet_count
+        ):
+            return
+        group = self._groups.get(group_index)
+        if group is None:
+            if not self._group_missing(group_index):
+                return
+            group = self._groups[group_index] = ParityGroup(self._group_length(group_index))
+        group.add_parity(payload)
+        self._settle(group_index, group)
+
+    def close(self):
+        """
+        Stops receiving, the file stays in its current state
+        """
+        if self.done:
+            return
+        self.done = True
+        self._idle_handle.cancel()
+        if self._nack_handle is not None:
+            self._nack_handle.cancel()
+        os.close(self._fd)
+        self._context.__exit__(None, None, None)
+
+    def _group_length(self, group_index: int) -> int:
+        announce = self._announce
+        return min(
+            announce.group_size, announce.packet_count - group_index * announce.group_size
+        )
+
+    def _group_missing(self, group_index: int) -> List[int]:
+        first = group_index * self._announce.group_size
+        return [
+            index
+            for index in range(first, first + self._group_length(group_index))
+            if not self._received[index]
+        ]
+
+    def _settle(self, group_index: int, group: ParityGroup):
+        """
+        Forgets the group once complete, recovers its last missing packet
+        """
+        if group.missing > 1:
+            return
+        if group.missing == 1:
+            (index,) = self._group_missing(group_index)
+            payload = group.recover(self._announce.payload_length(index))
+            if payload is None:
+                return
+            self._recovered += 1
+            self._store(index, payload)
+        del self._groups[group_index]
+
+    def _store(self, index: int, payload: bytes):
+        announce = self._announce
+        os.pwrite(self._fd, payload, index * announce.payload_size)
+        self._received[index] = 1
+        self._missing -= 1
+        self._last_packet = time.monotonic()
+        if index == self._prefix:
+            prefix = self._received.find(0, index)
+            self._prefix = announce.packet_count if prefix == -1 else prefix
+            self._context.update(min(self._prefix * announce.payload_size, announce.size))
+        if not self._missing:
+            self._finish()
+
+    def _finish(self):
+        os.ftruncate(self._fd, self._announce.size)
+        self.close()
+        self._logger.info(
+            "Received %s, %d packets recovered from parity",
+            self._file.name,
+            self._recovered,
+        )
+        self._loop.create_task(self._complete())
+
+    async def _complete(self):
+        try:
+            await self._controller.complete_download(self._file)
+        except Exception as exc:
+            # left to the usual download retries
+            self._logger.warning("Received %s is invalid", self._file.name, exc_info=exc)
+
+    def _missing_ranges(self) -> List[Tuple[int, int]]:
+        received = self._received
+        ranges = []
+        first = received.find(0)
+        while first != -1 and len(ranges) < BULK_MAX_NACK_RANGES:
+            end = received.find(1, first)
+            if end == -1:
+                end = len(received)
+            ranges.append((first, end - first))
+            first = received.find(0, end)
+        return ranges
+
+    def _send_nack(self):
+        self._nack_handle = None
+        if self.done or not self._missing:
+            return
+        ranges = self._missing_ranges()
+        self._logger.debug(
+            "Asking for %d missing packets of %s", self._missing, self._file.name
+        )
+        self._transport.sendto(pack_nack(self._announce.session, ranges), self._sender)
+
+    def _check_idle(self):
+        idle = time.monotonic() - self._last_packet
+        if idle < BULK_SESSION_TIMEOUT:
+            self._idle_handle = self._loop.call_later(
+                BULK_SESSION_TIMEOUT - idle, self._check_idle
+            )
+            return
+        self._logger.info(
+            "Multicast of %s stopped with %d packets missing",
+            self._file.name,
+            self._missing,
+        )
+        self.close()
+
+
+class BulkListener(asyncio.DatagramProtocol):
+    """
+    Listens to the bulk multicast group and receives the files announced there,
+    unless they are here already, another file has the name
+    or they are larger than `Config.push_max_size`.
+    An interrupted transfer is left to the usual download retries.
+    """
+
+    def __init__(
+        self, controller: AbstractController, group: Tuple[str, int], ifaces: List[str]
+    ):
+        self._logger = logging.getLogger("BulkListener")
+        self._controller = controller
+        self._group = group
+        self._ifaces = ifaces
+        self._transport: asyncio.DatagramTransport = None
+        self._receivers: Dict[int, BulkReceiver] = {}
+        self._refused: Set[int] = set()
+
+    async def start(self):
+        sock = group_socket(self._group[0], self._group[1], self._ifaces)
+        (self._transport, _) = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: self, sock=sock
+        )
+
+    def stop(self):
+        for receiver in self._receivers.values():
+            receiver.close()
+        self._receivers = {}
+        if self._transport is not None:
+            self._transport.close()
+
+    def datagram_received(self, data: bytes, address: Tuple[str, int]):
+        try:
+            (packet_type, session, body) = parse_packet(data)
+            receiver = self._receivers.get(session)
+            if receiver is not None and receiver.done:
+                # the rest of the session is of no use
+                del self._receivers[session]
+                self._refused.add(session)
+                return
+            if packet_type == BulkPacketType.ANNOUNCE:
+                announce = Announce.from_body(session, body)
+                if receiver is None:
+                    receiver = self._join(announce, address[0])
+                if receiver is not None:
+                    receiver.announced(announce)
+            elif receiver is None:
+                return
+            elif packet_type == BulkPacketType.DATA:
+                receiver.data(*unpack_indexed(body))
+            elif packet_type == BulkPacketType.PARITY:
+                receiver.parity(*unpack_indexed(body))
+        except ValueError as exc:
+            self._logger.debug("Dropping invalid packet from %s: %s", address[0], exc)
+
+    def error_received(self, exc):
+        self._logger.warning("Bulk receive failed: %s", exc)
+
+    def _join(self, announce: Announce, sender_ip: str) -> Optional[BulkReceiver]:
+        session = announce.session
+        if session in self._refused:
+            return None
+        max_size = Config().push_max_size
+        file = None
+        if max_size and announce.size > max_size:
+            self._logger.info(
+                "Refusing %s, %d bytes is too large", announce.name, announce.size
+            )
+        else:
+            try:
+                file = self._controller.accept_push(
+                    announce.name, announce.digest, announce.size
+                )
+            except Exception as exc:
+                self._logger.debug("Refusing %s: %s", announce.name, exc)
+        if file is None:
+            if len(self._refused) >= MAX_REFUSED_SESSIONS:
+                self._refused.clear()
+            self._refused.add(session)
+            return None
+        self._logger.info(
+            "Receiving %s by multicast from %s", announce.name, sender_ip
+        )
+        receiver = BulkReceiver(
+            self._controller,
+            file,
+            announce,
+            (sender_ip, announce.nack_port),
+            self._transport,
+        )
+        self._receivers[session] = receiver
+        return receiver
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import random
+import time
+from typing import BinaryIO, Set, Tuple
+
+from simple_p2p.bulk.fec import xor_parity
+from simple_p2p.bulk.packets import (
+    Announce,
+    BulkPacketType,
+    pack_indexed,
+    parse_packet,
+    unpack_nack,
+)
+from simple_p2p.bulk.sockets import sender_socket
+from simple_p2p.common.config import (
+    BULK_ANNOUNCE_PERIOD,
+    BULK_BURST,
+    BULK_GROUP_SIZE,
+    BULK_LINGER,
+    BULK_MAX_REPAIR_ROUNDS,
+    BULK_NACK_DELAY,
+    BULK_PAYLOAD_SIZE,
+)
+from simple_p2p.common.exceptions import LogicError
+from simple_p2p.common.models import AbstractController, FileMetadata
+from simple_p2p.file_transfer.context import FileConsumerContext
+from simple_p2p.udp.token_bucket import TokenBucket
+
+
+class BulkSender(asyncio.DatagramProtocol):
+    """
+    Sends a local file once to the bulk multicast group, with a parity packet
+    after every BULK_GROUP_SIZE data packets, so that the receivers recover
+    a lost packet per group by themselves. Then multicasts again the packets
+    the receivers still miss, as listed in their NACKs, until they stop asking.
+    """
+
+    def __init__(
+        self,
+        controller: AbstractController,
+        file: FileMetadata,
+        group: Tuple[str, int],
+        iface: str,
+        ttl: int = 1,
+        loop: bool = False,
+        rate: int = 20 * 1024 * 1024,
+    ):
+        self._logger = logging.getLogger("BulkSender")
+        self._controller = controller
+        self._file = file
+        self._group = group
+        self._iface = iface
+        self._ttl = ttl
+        self._multicast_loop = loop
+        self._session = random.getrandbits(32)
+        # packets per second
+        self._bucket = TokenBucket(rate / BULK_PAYLOAD_SIZE, BULK_BURST)
+        self._transport: asyncio.DatagramTransport = None
+        self._announce: Announce = None
+        self._nacked: Set[int] = set()
+        self._nack_event = asyncio.Event()
+        self._repaired = 0
+
+    async def run(self) -> Tuple[int, int]:
+        """
+        Returns the number of data packets of the file and of the repairs sent
+        """
+        file = self._file
+        sock = sender_socket(self._iface, self._ttl, self._multicast_loop)
+        (self._transport, _) = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: self, sock=sock
+        )
+        self._announce = Announce(
+            self._session,
+            file.name,
+            file.digest,
+            file.size,
+            BULK_PAYLOAD_SIZE,
+            BULK_GROUP_SIZE,
+            sock.getsockname()[1],
+        )
+        self._logger.info(
+            "Sending %s to %s:%s in session %08x",
+            file.name,
+            *self._group,
+            self._session,
+        )
+        try:
+            with FileConsumerContext(self._controller, file, None) as context:
+                with open(file.path, "rb") as source:
+                    await self._send_pass(source, context)
+                    await self._repair(source, context)
+        finally:
+            self._transport.close()
+        self._logger.info(
+            "Sent %s: %d packets, %d repairs",
+            file.name,
+            self._announce.packet_count,
+            self._repaired,
+        )
+        return (self._announce.packet_count, self._repaired)
+
+    def datagram_received(self, data: bytes, address: Tuple[str, int]):
+        try:
+            (packet_type, session, body) = parse_packet(data)
+            if packet_type != BulkPacketType.NACK or session != self._session:
+                return
+            ranges = unpack_nack(body)
+        except ValueError:
+            return
+        packet_count = self._announce.packet_count
+        for (first, count) in ranges:
+            self._nacked.update(range(first, min(first + count, packet_count)))
+        self._nack_event.set()
+
+    def error_received(self, exc):
+        self._logger.warning("Bulk send failed: %s", exc)
+
+    async def _send(self, packet: bytes):
+        """
+        Sends a packet to the group at the configured rate
+        """
+        delay = self._bucket.delay()
+        if delay:
+            await asyncio.sleep(delay)
+            self._bucket.delay()
+        self._bucket.consume()
+        # the socket buffer is full, let it drain
+        while self._transport.get_write_buffer_size() > BULK_BURST * BULK_PAYLOAD_SIZE:
+            await asyncio.sleep(0.001)
+        self._transport.sendto(packet, self._group)
+
+    async def _send_pass(self, source: BinaryIO, context: FileConsumerContext):
+        announce = self._announce
+        group_bytes = BULK_GROUP_SIZE * BULK_PAYLOAD_SIZE
+        group_count = (announce.packet_count + BULK_GROUP_SIZE - 1) // BULK_GROUP_SIZE
+        await self._send(announce.to_bytes())
+        next_announce = time.monotonic() + BULK_ANNOUNCE_PERIOD
+        for group in range(group_count):
+            if context.should_stop:
+                raise LogicError("Bulk transfer stopped")
+            block = source.read(group_bytes)
+            payloads = [
+                block[offset : offset + BULK_PAYLOAD_SIZE]
+                for offset in range(0, len(block), BULK_PAYLOAD_SIZE)
+            ]
+            for (offset, payload) in enumerate(payloads):
+                await self._send(
+                    pack_indexed(
+                        BulkPacketType.DATA,
+                        self._session,
+                        group * BULK_GROUP_SIZE + offset,
+                        payload,
+                    )
+                )
+            await self._send(
+                pack_indexed(
+                    BulkPacketType.PARITY,
+                    self._session,
+                    group,
+                    xor_parity(payloads, BULK_PAYLOAD_SIZE),
+                )
+            )
+            context.sent(len(block))
+            # late receivers learn about the transfer
+            if time.monotonic() >= next_announce:
+                await self._send(announce.to_bytes())
+                next_announce += BULK_ANNOUNCE_PERIOD
+
+    async def _repair(self, source: BinaryIO, context: FileConsumerContext):
+        announce = self._announce
+        announce.flags |= Announce.FLAG_END_OF_PASS
+        end_of_pass = announce.to_bytes()
+        for _ in range(BULK_MAX_REPAIR_ROUNDS):
+            deadline = time.monotonic() + BULK_LINGER
+            while not self._nacked and time.monotonic() < deadline:
+                self._nack_event.clear()
+                await self._send(end_of_pass)
+                try:
+                    await asyncio.wait_for(
+                        self._nack_event.wait(),
+                        min(BULK_ANNOUNCE_PERIOD, deadline - time.monotonic()),
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            if not self._nacked:
+                return
+            # the NACKs of the other receivers arrive meanwhile
+            await asyncio.sleep(BULK_NACK_DELAY)
+            (indexes, self._nacked) = (sorted(self._nacked), set())
+            for index in indexes:
+                if context.should_stop:
+                    raise LogicError("Bulk transfer stopped")
+                source.seek(index * BULK_PAYLOAD_SIZE)
+                payload = source.read(announce.payload_length(index))
+                await self._send(
+                    pack_indexed(BulkPacketType.DATA, self._session, index, payload)
+                )
+                context.sent(len(payload))
+            self._repaired += len(indexes)
+        self._logger.warning(
+            "Receivers of %s still miss packets after %d repair rounds",
+            self._file.name,
+            BULK_MAX_REPAIR_ROUNDS,
+        )
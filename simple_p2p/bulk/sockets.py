@@ -0,0 +1,39 @@
+import socket
+from typing import List
+
+from simple_p2p.common.config import BULK_RECEIVE_BUFFER
+from simple_p2p.common.utils import get_ip4_address
+
+
+def sender_socket(iface: str, ttl: int, loop: bool) -> socket.socket:
+    """
+    Socket sending to the multicast groups through `iface`,
+    bound to an ephemeral port on which it receives the NACKs
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, int(loop))
+    sock.setsockopt(
+        socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(get_ip4_address(iface))
+    )
+    sock.bind(("", 0))
+    return sock
+
+
+def group_socket(group: str, port: int, ifaces: List[str]) -> socket.socket:
+    """
+    Socket receiving from the multicast `group`, joined on `ifaces`
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # several instances on a single host might listen to the group
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # room for the bursts of data, capped by the system limit
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BULK_RECEIVE_BUFFER)
+    sock.bind(("", port))
+    for iface in ifaces:
+        sock.setsockopt(
+            socket.IPPROTO_IP,
+            socket.IP_ADD_MEMBERSHIP,
+            socket.inet_aton(group) + socket.inet_aton(get_ip4_address(iface)),
+        )
+    return sock
@@ -0,0 +1,114 @@
+import hashlib
+import struct
+import zlib
+from typing import BinaryIO, Iterator, List, Tuple
+
+from simple_p2p.common.config import CHUNK_MAX_SIZE, CHUNK_MIN_SIZE, DIGEST_ALG
+from simple_p2p.common.digests import DIGEST_ALGORITHMS, DigestAlgorithm
+
+# length and digest of a chunk, as stored and sent over TCP
+CHUNK_DIGEST_SIZE = 32
+CHUNK_STRUCT = struct.Struct(f"!I{CHUNK_DIGEST_SIZE}s")
+
+# bytes hashed to decide whether a chunk ends at a position
+CHUNK_WINDOW = 32
+# a boundary needs two anchor bytes in a row (1 in 256)
+# and the low byte of the window hash equal to zero (1 in 256)
+CHUNK_HASH_MASK = 0xFF
+_READ_SIZE = 4 * CHUNK_MAX_SIZE
+
+
+def _anchor_bytes() -> bytes:
+    # fixed pseudo-random choice, every peer has to cut at the same positions;
+    # fill bytes are left out so that runs of them are not probed byte by byte
+    candidates = [value for value in range(256) if value not in (0x00, 0xFF)]
+    candidates.sort(key=lambda value: hashlib.sha256(b"anchor%d" % value).digest())
+    return bytes(candidates[:16])
+
+
+_ANCHOR_TABLE = bytes(
+    1 if value in _anchor_bytes() else 0 for value in range(256)
+)
+_ANCHOR_PAIR = b"\x01\x01"
+
+
+def hash_chunk(algorithm: DigestAlgorithm, data: bytes) -> bytes:
+    """
+    Digest of a chunk with the algorithm of the file,
+    a shorter one being padded as in CHUNK_STRUCT
+    """
+    return algorithm.digest(data).ljust(CHUNK_DIGEST_SIZE, b"\0")
+
+
+def _chunk_end(data: bytes, marks: bytes, start: int, end: int) -> int:
+    """
+    End of the chunk of `data` starting at `start`, `end` at the latest.
+    `marks` tells which bytes of `data` are anchors.
+    """
+    if end - start <= CHUNK_MIN_SIZE:
+        return end
+    position = marks.find(_ANCHOR_PAIR, start + CHUNK_MIN_SIZE - 2, end)
+    while position != -1:
+        boundary = position + 2
+        if not zlib.crc32(data[boundary - CHUNK_WINDOW : boundary]) & CHUNK_HASH_MASK:
+            return boundary
+        position = marks.find(_ANCHOR_PAIR, position + 1, end)
+    return end
+
+
+def iter_chunks(
+    stream: BinaryIO, algorithm: DigestAlgorithm = DIGEST_ALGORITHMS[DIGEST_ALG]
+) -> Iterator[Tuple[int, bytes]]:
+    """
+    Splits the content of `stream` into chunks at positions defined
+    by the content itself, so that an insertion or a removal
+    only changes the chunks around it.
+    Yields the length and `hash_chunk` digest of every chunk.
+    """
+    data = b""
+    start = 0
+    eof = False
+    while True:
+        if not eof and len(data) - start < CHUNK_MAX_SIZE:
+            block = stream.read(_READ_SIZE)
+            eof = not block
+            data = data[start:] + block
+            marks = data.translate(_ANCHOR_TABLE)
+            start = 0
+            continue
+        if start == len(data):
+            return
+        end = _chunk_end(data, marks, start, min(len(data), start + CHUNK_MAX_SIZE))
+        yield (end - start, hash_chunk(algorithm, data[start:end]))
+        start = end
+
+
+def chunk_file(
+    path: str, algorithm: DigestAlgorithm = DIGEST_ALGORITHMS[DIGEST_ALG]
+) -> Tuple[List[Tuple[int, bytes]], str]:
+    """
+    Chunks of the file at `path` with the digest of the whole file,
+    both computed with `algorithm` from the same read of the content
+    """
+    file_hash = algorithm.new()
+
+    class HashingReader:
+        def read(self, size: int) -> bytes:
+            block = file.read(size)
+            file_hash.update(block)
+            return block
+
+    with open(path, "rb") as file:
+        chunks = list(iter_chunks(HashingReader(), algorithm))
+    return (chunks, algorithm.format(file_hash.hexdigest()))
+
+
+def pack_chunks(chunks: List[Tuple[int, bytes]]) -> bytes:
+    return b"".join(CHUNK_STRUCT.pack(length, digest) for (length, digest) in chunks)
+
+
+def unpack_chunks(chunks_bytes: bytes) -> List[Tuple[int, bytes]]:
+    """
+    Raises `struct.error` if `chunks_bytes` are not a list of chunks
+    """
+    return list(CHUNK_STRUCT.iter_unpack(chunks_bytes))
@@ -7,25 +7,95 @@ DEFAULT_BROADCAST_PORT = 13370
 DEFAULT_UDP_PORT = 13371
 DEFAULT_TCP_PORT = 13372
 DEFAULT_BIND_IP = '0.0.0.0'
+DEFAULT_MULTICAST_GROUP = '239.255.13.70'
+DEFAULT_BULK_GROUP = '239.255.13.71'
+DEFAULT_BULK_PORT = 13373
+DISCOVERY_MODES = ('broadcast', 'multicast')
 
 BROADCAST_OMIT_SELF = True
-PROTO_VERSION = 1
+PROTO_VERSION = 2
+MIN_PROTO_VERSION = 1
 ENCODING = "utf-8"
 MAGIC_NUMBER = 0xD16D
 FILE_CHUNK_SIZE = 16384
 UDP_BUFFER_SIZE = 2048
+UDP_SEND_QUEUE_SIZE = 1024
+UDP_SEND_BATCH = 64
+UDP_BROADCAST_RATE = 200
+UDP_BROADCAST_BURST = 32
 UDP_PEER_CLEANUP_PERIOD = 30
 UDP_ADVERTISE_PERIOD = 10
+UDP_ADVERTISE_MAX_PERIOD = 120
+UDP_ADVERTISE_RATE = 20
+UDP_ADVERTISE_JITTER = 0.25
+UDP_PEER_EXPIRY_TICK = 1
+UDP_PEER_EXPIRY_SLOTS = 512
+LOCAL_ADDRESSES_REFRESH_PERIOD = 5
+HELLO_REPLY_JITTER = 0.5
+HELLO_RETRY_DELAY = 2
+PEER_LIST_RESPONDERS = 3
 TCP_FILE_SEND_TIMEOUT = 15
 TCP_FILE_RECEIVE_TIMEOUT = 10
+# the answer to a PUSH waits for the rest of the chain
+TCP_PUSH_ACK_TIMEOUT = 60
 FILE_WATCHER_PERIOD = 5
+CHUNK_MIN_SIZE = 16 * 1024
+CHUNK_MAX_SIZE = 256 * 1024
 MAX_FILENAME_LENGTH = 32
+# algorithm of the digests that do not name one, see `simple_p2p.common.digests`
 DIGEST_ALG = "sha256"
+HASH_BLOCK_SIZE = 1024 * 1024
 FINGERPRINT_LENGTH = 10
+UPLOAD_SLOTS = 16
+# compressed transfers, see `simple_p2p.file_transfer.encoding`
+COMPRESSION_FRAME_SIZE = 256 * 1024
+# bytes read from a few places of a file to tell whether it compresses
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_SAMPLES = 4
+# compressed to original size of the sample below which files are compressed
+COMPRESSION_MIN_RATIO = 0.9
+# smaller responses are never compressed
+COMPRESSION_MIN_SIZE = 16 * 1024
+COMPRESSION_CACHE_SIZE = 4096
+# multicast bulk transfer, see `simple_p2p.bulk`
+BULK_MAGIC_NUMBER = 0xB1C5
+BULK_PAYLOAD_SIZE = 1400
+# data packets protected by a parity packet
+BULK_GROUP_SIZE = 16
+BULK_BURST = 64
+BULK_RECEIVE_BUFFER = 4 * 1024 * 1024
+BULK_ANNOUNCE_PERIOD = 0.5
+# the sender stops once no NACK came for that long after a pass
+BULK_LINGER = 1
+BULK_MAX_REPAIR_ROUNDS = 50
+# receivers wait up to that long before sending a NACK, so that the repairs
+# asked by others are seen first
+BULK_NACK_DELAY = 0.05
+BULK_MAX_NACK_RANGES = 128
+# a receiver hearing nothing for that long leaves the file to the TCP retries
+BULK_SESSION_TIMEOUT = 10
+UPLOAD_RATE_HALF_LIFE = 2
 FINDING_TIME = 2
+SEARCH_MIN_TIMEOUT = 0.05
 SEARCH_RETRIES = 2
+UNICAST_FIND_LIMIT = 4
+FIND_RATE = 100
+FIND_BURST = 128
+FIND_REPLY_JITTER = 0.02
+FIND_DUPLICATE_WINDOW = 1
+# files of up to that size might be sent inline in FETCHED datagrams
+INLINE_TRANSFER_MAX_SIZE = 64 * 1024
+FETCH_RETRIES = 2
+CATALOG_FILTER_BITS_PER_ITEM = 10
+CATALOG_FILTER_HASHES = 7
+CATALOG_FILTER_MAX_BYTES = 1024
+CATALOG_ADVERTISE_DELAY = 1
+CATALOG_GOSSIP_PERIOD = 5
+CATALOG_STALE_AFTER = 2 * UDP_ADVERTISE_PERIOD + 5
 
 METADATA_FOLDER_NAME = ".meta"
+BLOBS_FOLDER_NAME = ".blobs"
+CHUNKS_FOLDER_NAME = ".chunks"
 YAML_EXTENSION = ".yaml"
 
 class Config(metaclass=Singleton):
@@ -37,6 +107,28 @@ class Config(metaclass=Singleton):
         self.bind_ip: str = DEFAULT_BIND_IP
         self.broadcast_drop_chance: int = 0
         self.broadcast_drop_in_row: int = 1
+        self.discovery_mode: str = "broadcast"
+        self.multicast_group: str = DEFAULT_MULTICAST_GROUP
+        # comma separated interface names or addresses, the first one sends
+        self.multicast_ifaces: str = "default"
+        self.multicast_ttl: int = 1
+        self.multicast_loop: int = 0
+        # receive the files sent by multicast bulk transfer
+        self.bulk_multicast: int = 0
+        self.bulk_group: str = DEFAULT_BULK_GROUP
+        self.bulk_port: int = DEFAULT_BULK_PORT
+        # bytes per second sent by multicast bulk transfer
+        self.bulk_rate: int = 20 * 1024 * 1024
+        # store the files pushed by peers, of up to push_max_size bytes, 0 for any size;
+        # the size limit applies to the files sent by multicast too
+        self.accept_push: int = 0
+        self.push_max_size: int = 0
+        # files of up to that many bytes are sent and fetched over UDP, 0 disables it
+        self.inline_transfer_size: int = 0
+        # compress the transfers of the files that are worth it, if the peer agrees
+        self.transfer_compression: int = 1
+        # digest algorithm of the files added from now on
+        self.digest_alg: str = DIGEST_ALG
 
     def update(self, new_values: dict[str, object]):
         for (key, value) in new_values.items():
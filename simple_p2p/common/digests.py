@@ -0,0 +1,228 @@
+import hashlib
+import re
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Mapping, Optional, Tuple
+
+from simple_p2p.common.config import DIGEST_ALG
+from simple_p2p.common.exceptions import UnsupportedError
+
+try:
+    import blake3
+except ImportError:  # optional, see DIGEST_ALGORITHMS
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:  # optional, see DIGEST_ALGORITHMS
+    xxhash = None
+
+# between the algorithm and the hex digest, a DIGEST_ALG digest has neither
+DIGEST_SEPARATOR = ":"
+# the same in the names of the files named after a digest, ":" is not portable
+DIGEST_FILENAME_SEPARATOR = "-"
+
+
+class DigestAlgorithm:
+    """
+    Hash function identifying the content of files,
+    under a name used in the headers and an id used in the datagrams
+    """
+
+    __slots__ = ("name", "alg_id", "size", "_new")
+
+    def __init__(self, name: str, alg_id: int, size: int, new: Optional[Callable]):
+        self.name = name
+        self.alg_id = alg_id
+        # of the raw digest in bytes
+        self.size = size
+        self._new = new
+
+    @property
+    def available(self) -> bool:
+        """
+        Whether content can be hashed here, the digests are understood anyway
+        """
+        return self._new is not None
+
+    def new(self):
+        """
+        Hash object with the `hashlib` `update` and `hexdigest` methods.
+        Raises `UnsupportedError` if the module of the algorithm is not installed.
+        """
+        if self._new is None:
+            raise UnsupportedError(f"Digest algorithm '{self.name}' is not installed")
+        return self._new()
+
+    def digest(self, data: bytes) -> bytes:
+        hasher = self.new()
+        hasher.update(data)
+        return hasher.digest()
+
+    def format(self, hex_digest: str) -> str:
+        """
+        Digest of a file from the hex digest of its content
+        """
+        if self.name == DIGEST_ALG:
+            return hex_digest
+        return self.name + DIGEST_SEPARATOR + hex_digest
+
+    def is_hex(self, hex_digest: str) -> bool:
+        return len(hex_digest) == 2 * self.size and bool(_HEX.match(hex_digest))
+
+
+_HEX = re.compile("^[a-f0-9]*$")
+
+# every known algorithm by name, the unavailable ones have no hash function;
+# the ids are sent in the datagrams and never change
+DIGEST_ALGORITHMS: Dict[str, DigestAlgorithm] = OrderedDict(
+    (algorithm.name, algorithm)
+    for algorithm in (
+        DigestAlgorithm("sha256", 1, 32, hashlib.sha256),
+        # 256 bits, as long as a sha256 digest
+        DigestAlgorithm("blake2b", 2, 32, lambda: hashlib.blake2b(digest_size=32)),
+        DigestAlgorithm("blake3", 3, 32, blake3.blake3 if blake3 else None),
+        # not collision resistant, only for peers that trust each other
+        DigestAlgorithm("xxh3", 4, 16, xxhash.xxh3_128 if xxhash else None),
+    )
+)
+_ALGORITHMS_BY_ID: Dict[int, DigestAlgorithm] = {
+    algorithm.alg_id: algorithm for algorithm in DIGEST_ALGORITHMS.values()
+}
+
+
+def available_algorithms() -> Tuple[str, ...]:
+    return tuple(
+        name for (name, algorithm) in DIGEST_ALGORITHMS.items() if algorithm.available
+    )
+
+
+def get_algorithm(name: str) -> DigestAlgorithm:
+    """
+    Raises `UnsupportedError` if the algorithm `name` is unknown
+    """
+    algorithm = DIGEST_ALGORITHMS.get(name.strip().lower())
+    if algorithm is None:
+        raise UnsupportedError(f"Unknown digest algorithm '{name}'")
+    return algorithm
+
+
+def algorithm_by_id(alg_id: int) -> DigestAlgorithm:
+    """
+    Raises `KeyError` if the id `alg_id` is unknown
+    """
+    return _ALGORITHMS_BY_ID[alg_id]
+
+
+def split_digest(digest: str) -> Tuple[DigestAlgorithm, str]:
+    """
+    Algorithm and hex digest of the digest of a file,
+    a digest without an algorithm being a DIGEST_ALG one.
+    Raises `UnsupportedError` if the algorithm is unknown.
+    """
+    (name, _, hex_digest) = digest.rpartition(DIGEST_SEPARATOR)
+    return (get_algorithm(name or DIGEST_ALG), hex_digest)
+
+
+def digest_algorithm(digest: str) -> DigestAlgorithm:
+    return split_digest(digest)[0]
+
+
+def has_default_algorithm(digest: str) -> bool:
+    """
+    Whether `digest` is empty or a DIGEST_ALG one, the only ones
+    version 1 peers and SHA-256 only clients understand
+    """
+    return DIGEST_SEPARATOR not in digest
+
+
+def is_digest(digest: str) -> bool:
+    try:
+        (algorithm, hex_digest) = split_digest(digest)
+    except UnsupportedError:
+        return False
+    return algorithm.is_hex(hex_digest)
+
+
+def check_digest(digest: str) -> DigestAlgorithm:
+    """
+    Algorithm of `digest`.
+    Raises `UnsupportedError` if content cannot be verified against it here.
+    """
+    (algorithm, hex_digest) = split_digest(digest)
+    if not algorithm.is_hex(hex_digest):
+        raise UnsupportedError(f"Invalid {algorithm.name} digest '{digest}'")
+    if not algorithm.available:
+        raise UnsupportedError(f"Digest algorithm '{algorithm.name}' is not installed")
+    return algorithm
+
+
+def digest_uri(digest: str) -> str:
+    """
+    Request URI of the content `digest`, file names never contain a slash
+    """
+    (algorithm, hex_digest) = split_digest(digest)
+    return f"/{algorithm.name}/{hex_digest}"
+
+
+def parse_digest_uri(uri: str) -> Optional[str]:
+    """
+    Digest requested by `uri`, None if it is a file name.
+    Raises `UnsupportedError` if the algorithm is unknown.
+    """
+    if not uri.startswith("/"):
+        return None
+    (name, _, hex_digest) = uri[1:].partition("/")
+    return get_algorithm(name).format(hex_digest)
+
+
+def digest_filename(digest: str) -> str:
+    """
+    Name of a file named after the content `digest`, as `<alg>-<hex>`
+    """
+    (algorithm, hex_digest) = split_digest(digest)
+    return algorithm.name + DIGEST_FILENAME_SEPARATOR + hex_digest
+
+
+def parse_digest_filename(filename: str) -> Optional[str]:
+    """
+    Digest a file is named after by `digest_filename`, None if it is not one
+    """
+    (name, _, hex_digest) = filename.rpartition(DIGEST_FILENAME_SEPARATOR)
+    algorithm = DIGEST_ALGORITHMS.get(name)
+    if algorithm is None or not algorithm.is_hex(hex_digest):
+        return None
+    return algorithm.format(hex_digest)
+
+
+def digest_header(digests: Iterable[str]) -> str:
+    """
+    Value of a Digest or If-Digest header listing `digests`
+    """
+    return ", ".join(
+        f"{algorithm.name}={hex_digest}"
+        for (algorithm, hex_digest) in map(split_digest, digests)
+    )
+
+
+def digests_from_header(values: Mapping[str, Optional[str]]) -> Dict[str, str]:
+    """
+    Digests listed by a parsed Digest or If-Digest header, by algorithm name,
+    leaving out the unknown algorithms
+    """
+    digests = {}
+    for (name, hex_digest) in values.items():
+        algorithm = DIGEST_ALGORITHMS.get(name.lower())
+        if algorithm is not None and hex_digest:
+            digests[algorithm.name] = algorithm.format(hex_digest.lower())
+    return digests
+
+
+def hash_file(path: str, algorithm: DigestAlgorithm, block_size: int) -> str:
+    """
+    Digest of the content of the file at `path`
+    """
+    hasher = algorithm.new()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hasher.update(block)
+    return algorithm.format(hasher.hexdigest())
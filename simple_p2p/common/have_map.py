@@ -0,0 +1,74 @@
+import base64
+import binascii
+from bisect import bisect_right
+from itertools import accumulate
+from typing import List, Optional, Tuple
+
+
+class HaveMap:
+    """
+    Bitmap of the chunks of a file that were received and verified,
+    chunks being the content-defined chunks listed by the provider.
+    Does not perform locking.
+    """
+
+    def __init__(self, chunks: List[Tuple[int, bytes]], bits: Optional[bytes] = None):
+        self._chunks = chunks
+        # start offset of every chunk and the size of the file
+        self._offsets = [0] + list(accumulate(length for (length, _) in chunks))
+        size = (len(chunks) + 7) // 8
+        if bits is not None and len(bits) != size:
+            raise ValueError("Bitmap does not match the chunks")
+        self._bits = bytearray(bits) if bits is not None else bytearray(size)
+        self._verified_bytes = sum(
+            length for (index, (length, _)) in enumerate(chunks) if self.has(index)
+        )
+
+    @property
+    def chunks(self) -> List[Tuple[int, bytes]]:
+        return self._chunks
+
+    @property
+    def verified_bytes(self) -> int:
+        return self._verified_bytes
+
+    @property
+    def complete(self) -> bool:
+        return self._verified_bytes == self._offsets[-1]
+
+    def offset(self, index: int) -> int:
+        return self._offsets[index]
+
+    def has(self, index: int) -> bool:
+        return bool(self._bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def add(self, index: int):
+        if not self.has(index):
+            self._bits[index >> 3] |= 0x80 >> (index & 7)
+            self._verified_bytes += self._chunks[index][0]
+
+    def has_range(self, offset: int, length: int) -> bool:
+        """
+        Whether every byte from `offset` to `offset + length` was verified
+        """
+        if length <= 0:
+            return True
+        first = bisect_right(self._offsets, offset) - 1
+        last = bisect_right(self._offsets, offset + length - 1) - 1
+        if first < 0 or last >= len(self._chunks):
+            return False
+        return all(self.has(index) for index in range(first, last + 1))
+
+    def to_header(self) -> str:
+        return base64.b64encode(bytes(self._bits)).decode("ascii")
+
+    @classmethod
+    def from_header(cls, chunks: List[Tuple[int, bytes]], value: str) -> "HaveMap":
+        """
+        Raises `ValueError` if the header does not match the chunks
+        """
+        try:
+            bits = base64.b64decode(value, validate=True)
+        except binascii.Error as exc:
+            raise ValueError(f"Invalid have bitmap: {exc}")
+        return cls(chunks, bits)
@@ -1,6 +1,6 @@
 from abc import ABC
 from enum import Enum
-from typing import Optional
+from typing import List, Optional, Tuple
 
 
 class FileStatus(str, Enum):
@@ -51,6 +51,12 @@ class FileMetadata:
 class AbstractController(ABC):
     def get_file(self, name) -> FileMetadata:
         pass
+
+    def get_files_by_digest(self, digest: str) -> List[FileMetadata]:
+        pass
+
+    def get_chunks(self, name, compute=True) -> Optional[List[Tuple[int, bytes]]]:
+        pass
     
     def add_consumer(self, context):
         pass
@@ -58,6 +64,9 @@ class AbstractController(ABC):
     def remove_consumer(self, context, exc_type, exc_value):
         pass
 
+    def consumer_update(self, context, bytes_sent: int):
+        pass
+
     def add_provider(self, context):
         pass
 
@@ -67,6 +76,21 @@ class AbstractController(ABC):
     def provider_update(self, context, bytes_downloaded: int):
         pass
 
+    def provider_chunks(self, context, chunks: List[Tuple[int, bytes]]):
+        pass
+
+    def get_have(self, name):
+        pass
+
+    def get_peer_by_ip(self, ip):
+        pass
+
+    def accept_push(self, name: str, digest: str, size: int) -> Optional[FileMetadata]:
+        pass
+
+    async def complete_download(self, file: FileMetadata):
+        pass
+
 
 class Singleton(type):
     _instances = {}
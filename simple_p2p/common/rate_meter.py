@@ -0,0 +1,33 @@
+import math
+import threading
+import time
+
+from simple_p2p.common.config import UPLOAD_RATE_HALF_LIFE
+
+
+class RateMeter:
+    """
+    Exponentially weighted rate of a quantity per second, e.g. bytes sent,
+    past amounts losing half of their weight every `half_life` seconds.
+    Performs locking.
+    """
+
+    def __init__(self, half_life: float = UPLOAD_RATE_HALF_LIFE):
+        self._decay = math.log(2) / half_life
+        self._lock = threading.Lock()
+        self._rate = 0.0
+        self._updated = time.monotonic()
+
+    def _decayed(self, now: float) -> float:
+        return self._rate * math.exp(-self._decay * (now - self._updated))
+
+    def add(self, amount: float):
+        now = time.monotonic()
+        with self._lock:
+            self._rate = self._decayed(now) + amount * self._decay
+            self._updated = now
+
+    @property
+    def rate(self) -> float:
+        with self._lock:
+            return self._decayed(time.monotonic())
@@ -16,7 +16,8 @@ def in_background(future: asyncio.Future):
             tasks.remove(own_future)
     with tasks_lock:
         tasks.append(future)
-        future.add_done_callback(task_finished)
+    # the callback runs immediately if the future is already done
+    future.add_done_callback(task_finished)
     return future
 
 def coro_in_background(coroutine: Coroutine, loop: asyncio.AbstractEventLoop):
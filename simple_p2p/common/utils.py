@@ -1,6 +1,9 @@
 from functools import cache
 import hashlib
 import re
+import socket
+import time
+from typing import FrozenSet
 
 from netifaces import interfaces, ifaddresses, AF_INET
 from simple_p2p.common.config import *
@@ -21,6 +24,25 @@ def all_ip4_addresses():
     return ip_list
 
 
+_local_addresses: FrozenSet[str] = frozenset()
+_local_addresses_updated: float = None
+
+
+def local_ip4_addresses() -> FrozenSet[str]:
+    """
+    Cached `all_ip4_addresses`, refreshed every LOCAL_ADDRESSES_REFRESH_PERIOD seconds
+    """
+    global _local_addresses, _local_addresses_updated
+    now = time.monotonic()
+    if (
+        _local_addresses_updated is None
+        or now - _local_addresses_updated > LOCAL_ADDRESSES_REFRESH_PERIOD
+    ):
+        _local_addresses = frozenset(all_ip4_addresses())
+        _local_addresses_updated = now
+    return _local_addresses
+
+
 def all_ip4_broadcasts():
     ip_list = []
     for interface in interfaces():
@@ -46,5 +68,25 @@ def get_ip4_broadcast(iface: str) -> str:
     raise LogicError(f"Could not find broadcast address for interface '{iface}'")
 
 
+def get_ip4_address(iface: str) -> str:
+    """
+    IPv4 address of the interface, `iface` might also be an IPv4 address
+    """
+    if iface in ['', 'any', 'default']:
+        return '0.0.0.0'
+    try:
+        socket.inet_aton(iface)
+        return iface
+    except OSError:
+        pass
+    try:
+        if_addresses = ifaddresses(iface)
+        if AF_INET in if_addresses:
+            return if_addresses[AF_INET][0]["addr"]
+    except:
+        pass
+    raise LogicError(f"Could not find IPv4 address for interface '{iface}'")
+
+
 def is_sha256(hash_string: str) -> bool:
     return bool(re.match("^[a-fA-F0-9]{64}$", hash_string))
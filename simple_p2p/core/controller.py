@@ -1,12 +1,27 @@
 import asyncio
+import inspect
 import logging
+import os
 from asyncio import run_coroutine_threadsafe, start_server
 import random
 import threading
+from contextlib import aclosing
 from concurrent.futures import Future, ThreadPoolExecutor
-from typing import List, Optional, Tuple, Dict
-
-from simple_p2p.common.config import FILE_WATCHER_PERIOD, Config, MAX_FILENAME_LENGTH
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Set, Tuple, Dict
+
+from aiofile.utils import async_open
+
+from simple_p2p.bulk.receiver import BulkListener
+from simple_p2p.bulk.sender import BulkSender
+from simple_p2p.common.config import (
+    CHUNK_MAX_SIZE,
+    FILE_WATCHER_PERIOD,
+    Config,
+    MAX_FILENAME_LENGTH,
+    UPLOAD_SLOTS,
+)
+from simple_p2p.common.digests import check_digest
+from simple_p2p.common.have_map import HaveMap
 from simple_p2p.common.models import AbstractController, FileMetadata, FileStatus
 from simple_p2p.file_transfer.client import ClientHandler
 from simple_p2p.file_transfer.context import FileConsumerContext, FileProviderContext
@@ -14,10 +29,17 @@ from simple_p2p.common.exceptions import (
     FileDuplicateException,
     LogicError,
     FileNameTooLongException,
-    NotFoundError
+    NotFoundError,
+    UnsupportedError,
 )
+from simple_p2p.common.rate_meter import RateMeter
 from simple_p2p.common.tasks import coro_in_background, new_loop, in_background
-from simple_p2p.file_transfer.exceptions import InconsistentFileStateError
+from simple_p2p.file_transfer.exceptions import (
+    IncompleteProviderError,
+    InconsistentFileStateError,
+)
+from simple_p2p.file_transfer.push import push_file
+from simple_p2p.file_transfer.stream import ContentStream
 from simple_p2p.file_transfer.server import ServerHandler
 from simple_p2p.repository.repository import Repository
 from simple_p2p.udp.found_response import FoundResponse
@@ -31,6 +53,8 @@ class FileStateContext:
         self._lock = threading.Lock()
         self._provider: Optional[FileProviderContext] = None
         self._consumers: List[FileConsumerContext] = []
+        # verified chunks while the file downloads, to serve them meanwhile
+        self.have: Optional[HaveMap] = None
 
     @property
     def file_meta(self) -> FileMetadata:
@@ -53,7 +77,9 @@ class FileStateContext:
             self._provider = value
 
     def add_consumer(self, context):
-        if not self.file_meta.can_share:
+        if not self.file_meta.can_share and not (
+            self.file_meta.status == FileStatus.DOWNLOADING and self.have
+        ):
             raise NotFoundError("File is not accessible")
         with self._lock:
             self._consumers.append(context)
@@ -74,12 +100,18 @@ class Controller(AbstractController):
     def __init__(self):
         self._udp_controller = UdpController(self)
         self._state: Dict[str, FileStateContext] = {}
+        # names of the files by digest
+        self._digests: Dict[str, Set[str]] = {}
         self._repo = Repository()
         self._loop: asyncio.AbstractEventLoop = None
         self._lock = threading.Lock()
         self._executor = ThreadPoolExecutor()
         self._logger = logging.getLogger("Controller")
         self._tcp_server: asyncio.AbstractServer = None
+        # upload load, advertised to the searchers
+        self._upload_meter = RateMeter()
+        self._active_consumers = 0
+        self._bulk_listener: Optional[BulkListener] = None
 
     def start(self):
         cfg = Config()
@@ -105,6 +137,17 @@ class Controller(AbstractController):
         except Exception as exc:
             raise LogicError(f"Failed to start the TCP server")
 
+        if cfg.bulk_multicast:
+            self._bulk_listener = BulkListener(
+                self, (cfg.bulk_group, cfg.bulk_port), self._multicast_ifaces()
+            )
+            try:
+                run_coroutine_threadsafe(
+                    self._bulk_listener.start(), self._loop
+                ).result()
+            except Exception as exc:
+                raise LogicError(f"Failed to join the bulk multicast group: {exc}")
+
         self._server_task: Future = run_coroutine_threadsafe(
             self._serve_tcp(), self._loop
         )
@@ -134,6 +177,32 @@ class Controller(AbstractController):
                 self._logger.warning("Attempted to add duplicate file %s", meta.name)
                 raise FileDuplicateException(f"File '{meta.name}' already exists")
             self._state[meta.name] = FileStateContext(meta)
+            if meta.digest:
+                self._digests.setdefault(meta.digest, set()).add(meta.name)
+        self._udp_controller.catalog_add(meta.name, meta.digest)
+        self._sync_shared(meta)
+
+    def _sync_shared(self, meta: FileMetadata):
+        """
+        Internal function: publishes the file in the replicated catalog
+        if it can be shared, withdraws it otherwise.
+        Shared files are split into chunks in the background,
+        so that their content can be reused by later downloads.
+        """
+        if meta.can_share:
+            self._udp_controller.share_file(meta.name, meta.digest, meta.size)
+            self._executor.submit(self._index_chunks, meta.name)
+        else:
+            self._udp_controller.unshare_file(meta.name)
+
+    def _index_chunks(self, name: str):
+        """
+        Internal function: adds the chunks of file `name` to the chunk index
+        """
+        try:
+            self._repo.chunks(name)
+        except Exception as exc:
+            self._logger.debug("Cannot chunk file %s", name, exc_info=exc)
 
     def _get_file_state(self, name: str) -> FileStateContext:
         """
@@ -149,33 +218,83 @@ class Controller(AbstractController):
         handler = ServerHandler(self)
         await handler.handle_client(reader, writer)
 
-    async def _download_from(self, file: FileMetadata, endpoint: Tuple[str, int]):
+    async def _download_from(
+        self, file: FileMetadata, endpoint: Tuple[str, int], by_digest: bool = False
+    ):
         """
-        Internal function: Handles a scheduled download
+        Internal function: Handles a scheduled download,
+        asking for the content by digest instead of by name if `by_digest` is set
         """
+        if await self._link_local(file):
+            return
         try:
             self._logger.info(
                 "Starting download of file %s from %s", file.name, endpoint[0]
             )
-            streams = await asyncio.open_connection(*endpoint)
             with FileProviderContext(self, file, endpoint) as context:
-                handler = ClientHandler(context)
-                await handler.handle_connection(*streams)
+                handler = ClientHandler(context, by_digest)
+                streams = await asyncio.open_connection(*endpoint)
+                assembled = False
+                if file.digest and file.size > CHUNK_MAX_SIZE:
+                    # only the chunks missing locally are downloaded,
+                    # the verified ones are served while the rest arrives.
+                    # The peer reads the whole file to list its chunks the first time,
+                    # only worth it if some may be found locally; otherwise only
+                    # a list it already has is asked for, as the have map of a peer
+                    # still downloading the file
+                    assembled = await handler.handle_chunks(
+                        *streams, self._repo.find_chunk, not self._repo.has_chunks
+                    )
+                if not assembled:
+                    if streams[1].is_closing():
+                        streams = await asyncio.open_connection(*endpoint)
+                    await handler.handle_connection(*streams)
+
+                await self.complete_download(file)
+        except IncompleteProviderError as exc:
+            # the peer is still downloading the file, resume from another one later
+            self._logger.info("Download of %s paused: %s", file.name, exc)
+        except Exception as exc:
+            self._logger.warning("Download of %s failed", file.name, exc_info=exc)
+            self._udp_controller.remove_peer(endpoint[0])
 
-                await self._loop.run_in_executor(
-                    self._executor, self._repo.update_stat, file.name
-                )
+    async def complete_download(self, file: FileMetadata):
+        """
+        Checks the received content of `file` and shares it.
+        Raises `LogicError` if it does not match the digest.
+        """
+        await self._loop.run_in_executor(
+            self._executor, self._repo.update_stat, file.name
+        )
 
-                self._logger.info("Download of %s completed", file.name)
-                if not file.is_valid:
-                    raise LogicError("Invalid file download")
+        self._logger.info("Download of %s completed", file.name)
+        if not file.is_valid:
+            raise LogicError("Invalid file download")
 
-                await self._loop.run_in_executor(
-                    self._executor, self._repo.change_state, file.name, "READY"
-                )
+        await self._loop.run_in_executor(
+            self._executor, self._repo.change_state, file.name, "READY"
+        )
+        self._get_file_state(file.name).have = None
+        self._sync_shared(file)
+
+    async def _link_local(self, file: FileMetadata) -> bool:
+        """
+        Internal function: completes the download of `file`
+        from a local file with the same content, if there is one
+        """
+        if not file.digest:
+            return False
+        try:
+            linked = await self._loop.run_in_executor(
+                self._executor, self._repo.link_local, file.name
+            )
         except Exception as exc:
-            self._logger.warning("Download of %s failed", file.name, exc_info=exc)
-            self._udp_controller.remove_peer(endpoint[0])
+            self._logger.warning("Local copy of %s failed", file.name, exc_info=exc)
+            return False
+        if linked:
+            self._logger.info("Download of %s completed from a local copy", file.name)
+            self._sync_shared(file)
+        return linked
 
     async def _serve_tcp(self):
         """
@@ -198,17 +317,26 @@ class Controller(AbstractController):
                 ):
                     self._logger.warning("Truncating download %s", meta.name)
                     meta.current_size = 0
-                coro_in_background(self.retry_download(meta.name), self._loop)
+                return True
 
             elif meta.status == FileStatus.READY and not meta.is_valid:
                 self._logger.warning("Invalidating file %s", meta.name)
+                self._udp_controller.unshare_file(meta.name)
                 self._executor.submit(self._repo.change_state, meta.name, "INVALID")
+            return False
 
         while True:
             await asyncio.sleep(FILE_WATCHER_PERIOD)
             with self._lock:
-                for file in self._state.values():
-                    process_file(file)
+                to_retry = [
+                    file.file_meta.name
+                    for file in self._state.values()
+                    if process_file(file)
+                ]
+            if len(to_retry) == 1:
+                coro_in_background(self.retry_download(to_retry[0]), self._loop)
+            elif to_retry:
+                coro_in_background(self.retry_downloads(to_retry), self._loop)
 
     async def retry_download(self, name: str):
         """
@@ -216,31 +344,348 @@ class Controller(AbstractController):
         """
         self._logger.info("Retrying file %s", name)
         meta = self.get_file(name)
-        search_res = await self._udp_controller.search(meta.name, meta.digest)
-        responses = search_res.get(meta.digest, [])
-        if len(responses) == 0:
-            self._logger.warning("Cannot find hosts to resume file %s", name)
+        if await self._link_local(meta):
+            return
+        # resume from the first peer that answers with the right version
+        # and has more of it than we do
+        response = None
+        # closed at once so that the search drops our listener
+        async with aclosing(
+            self._udp_controller.search_stream(meta.name, meta.digest)
+        ) as candidates:
+            async for candidate in candidates:
+                if self._can_resume_from(meta, candidate):
+                    response = candidate
+                    break
+        if response is None:
+            await self._retry_by_digest(meta)
             return
-        response = random.choice(search_res[meta.digest])
         peer = self._udp_controller.get_peer_by_ip(response.provider_ip)
         peer_port = peer.tcp_port
         await self._download_from(meta, (response.provider_ip, peer_port))
 
+    async def _retry_by_digest(self, meta: FileMetadata):
+        """
+        Internal function: resumes file `meta` from a peer
+        holding the same content under another name
+        """
+        if not meta.digest:
+            self._logger.warning("Cannot find hosts to resume file %s", meta.name)
+            return
+        responses = [
+            response
+            for response in (
+                await self._udp_controller.search(None, meta.digest)
+            ).get(meta.digest, [])
+            if self._can_resume_from(meta, response)
+        ]
+        if len(responses) == 0:
+            self._logger.warning("Cannot find hosts to resume file %s", meta.name)
+            return
+        response = self.choose_provider(responses)
+        peer = self._udp_controller.get_peer_by_ip(response.provider_ip)
+        if peer is None:
+            return
+        self._logger.info(
+            "Resuming file %s from %s by digest", meta.name, response.provider_ip
+        )
+        await self._download_from(meta, (response.provider_ip, peer.tcp_port), True)
+
+    @staticmethod
+    def _can_resume_from(meta: FileMetadata, response: FoundResponse) -> bool:
+        """
+        Internal function: whether the provider of `response` has more
+        of file `meta` than downloaded so far
+        """
+        return not response.is_partial or response.available > meta.current_size
+
+    async def retry_downloads(self, names: List[str]):
+        """
+        Attempts to retry downloads of files `names`, searching for all of them at once
+        """
+        self._logger.info("Retrying %d files", len(names))
+        metas = []
+        for name in names:
+            meta = self.get_file(name)
+            if not await self._link_local(meta):
+                metas.append(meta)
+        if not metas:
+            return
+        results = await self._udp_controller.search_many(
+            [(meta.name, meta.digest) for meta in metas]
+        )
+        for meta in metas:
+            responses = [
+                response
+                for response in results[meta.name].get(meta.digest, [])
+                if self._can_resume_from(meta, response)
+            ]
+            if len(responses) == 0:
+                coro_in_background(self._retry_by_digest(meta), self._loop)
+                continue
+            response = self.choose_provider(responses)
+            peer = self._udp_controller.get_peer_by_ip(response.provider_ip)
+            if peer is None:
+                continue
+            coro_in_background(
+                self._download_from(meta, (response.provider_ip, peer.tcp_port)),
+                self._loop,
+            )
+
     def schedule_download(
-        self, name: str, digest: Optional[str], size: int, endpoint: Tuple[str, int]
+        self,
+        name: str,
+        digest: Optional[str],
+        size: int,
+        endpoint: Tuple[str, int],
+        by_digest: bool = False,
     ):
         """
         Schedule a file with given `name` and optionally `digest`
         to be downloaded from `endpoint`. Runs in background.
+        With `by_digest` set the peer is asked for the content by its digest,
+        so it may hold the file under a different name.
+        Raises `UnsupportedError` if the content cannot be verified against `digest`.
         """
+        if by_digest and not digest:
+            raise LogicError("Cannot download by digest without a digest")
+        if digest:
+            check_digest(digest)
+        if (
+            digest
+            and 0 < size <= self._udp_controller.inline_transfer_size()
+            and digest not in self._digests
+        ):
+            # small enough to be sent along the discovery datagrams
+            if name in self._state:
+                raise FileDuplicateException(f"File '{name}' already exists")
+            coro_in_background(
+                self._fetch_inline(name, digest, size, endpoint, by_digest), self._loop
+            )
+            return
         meta = self._repo.init_meta(name, digest, size)
         self._add_file(meta)
-        coro_in_background(self._download_from(meta, endpoint), self._loop)
+        coro_in_background(self._download_from(meta, endpoint, by_digest), self._loop)
+
+    async def _fetch_inline(
+        self,
+        name: str,
+        digest: str,
+        size: int,
+        endpoint: Tuple[str, int],
+        by_digest: bool,
+    ):
+        """
+        Internal function: downloads a small file in FETCHED datagrams
+        and stores it at once, falls back to a TCP download
+        if the peer does not send it
+        """
+        try:
+            content = await self._udp_controller.fetch(
+                endpoint[0], "" if by_digest else name, digest, size
+            )
+        except Exception as exc:
+            self._logger.warning("Inline download of %s failed", name, exc_info=exc)
+            content = None
+        try:
+            if content is not None:
+                meta = await self._loop.run_in_executor(
+                    self._executor, self._repo.store_content, name, digest, content
+                )
+                self._add_file(meta)
+                self._logger.info(
+                    "Download of %s completed inline from %s", name, endpoint[0]
+                )
+                return
+            self._logger.info(
+                "Inline download of %s from %s failed, using TCP", name, endpoint[0]
+            )
+            meta = self._repo.init_meta(name, digest, size)
+            self._add_file(meta)
+        except FileDuplicateException:
+            self._logger.warning("File %s was added during its download", name)
+            return
+        await self._download_from(meta, endpoint, by_digest)
+
+    async def stream_file(
+        self,
+        digest: str,
+        offset: int = 0,
+        length: Optional[int] = None,
+        endpoint: Optional[Tuple[str, int]] = None,
+        store_as: Optional[str] = None,
+    ) -> AsyncIterator[bytes]:
+        """
+        Yields the content `digest` block by block as it arrives from `endpoint`,
+        or from a provider found on the network, or the `length` bytes from `offset`.
+        The content is verified on the fly, see `ContentStream`, so the consumer
+        gets all of it only if it matches. It is not stored unless `store_as`
+        names the file to keep the whole content in, which then is not hashed again.
+        Runs on the loop of the caller.
+        """
+        if store_as is not None and (offset or length is not None):
+            raise LogicError("Only the whole content can be stored")
+        if endpoint is None:
+            endpoint = await self._find_provider(digest)
+        stream = ContentStream(endpoint, digest, offset, length)
+        await stream.open()
+        if store_as is None:
+            async for block in stream:
+                yield block
+            return
+
+        try:
+            meta = self._repo.init_meta(store_as, digest, stream.size)
+            self._add_file(meta)
+        except Exception:
+            stream.close()
+            raise
+        with FileProviderContext(self, meta, endpoint) as context:
+            received = 0
+            async with async_open(meta.path, "wb") as writer:
+                async for block in stream:
+                    if context.should_stop:
+                        raise LogicError(f"Expected {stream.size} bytes, got {received}")
+                    await writer.write(block)
+                    received += len(block)
+                    context.update(received)
+                    yield block
+        await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._repo.complete_verified, store_as
+        )
+        self._logger.info("Download of %s completed while streaming", store_as)
+        self._sync_shared(meta)
+
+    async def download_to(
+        self,
+        digest: str,
+        sink: Callable[[bytes], Optional[Awaitable]],
+        offset: int = 0,
+        length: Optional[int] = None,
+        endpoint: Optional[Tuple[str, int]] = None,
+        store_as: Optional[str] = None,
+    ) -> int:
+        """
+        Passes the blocks of `stream_file` to `sink`, awaiting its result
+        if it is awaitable, e.g. the write method of a decompressor or a file.
+        Returns the number of bytes passed.
+        """
+        passed = 0
+        async for block in self.stream_file(digest, offset, length, endpoint, store_as):
+            result = sink(block)
+            if inspect.isawaitable(result):
+                await result
+            passed += len(block)
+        return passed
+
+    async def _find_provider(self, digest: str) -> Tuple[str, int]:
+        """
+        Internal function: endpoint of a provider of the content `digest`
+        """
+        responses = (await self.search_file("", digest)).get(digest)
+        if not responses:
+            raise NotFoundError(f"No provider of content '{digest}'")
+        response = self.choose_provider(responses)
+        peer = self.get_peer_by_ip(response.provider_ip)
+        if peer is None:
+            raise NotFoundError(f"Provider {response.provider_ip} is gone")
+        return (response.provider_ip, peer.tcp_port)
+
+    def accept_push(self, name: str, digest: str, size: int) -> Optional[FileMetadata]:
+        """
+        File to store a file pushed to this peer into,
+        None if it is here already or another file has the name.
+        Raises `UnsupportedError` if the name is not a valid file name.
+        """
+        if (
+            len(name) > MAX_FILENAME_LENGTH
+            or os.path.basename(name) != name
+            or name in ("", ".", "..")
+        ):
+            raise UnsupportedError(f"Invalid file name: '{name}'")
+        try:
+            state = self._get_file_state(name)
+        except NotFoundError:
+            try:
+                meta = self._repo.init_meta(name, digest, size)
+                self._add_file(meta)
+            except FileDuplicateException:
+                return None
+            return meta
+        meta = state.file_meta
+        if (
+            meta.status == FileStatus.DOWNLOADING
+            and meta.digest == digest
+            and not state.provider
+        ):
+            # the push restarts the download from the beginning
+            return meta
+        return None
+
+    def publish(
+        self, name: str, peer_ips: Optional[List[str]] = None, chains: int = 1
+    ) -> Future:
+        """
+        Pushes the local file `name` to the peers `peer_ips`, all the known peers
+        by default, split into `chains` chains in which every peer
+        relays the file to the next one while receiving it.
+        The future results in the number of peers that stored the file.
+        """
+        return run_coroutine_threadsafe(
+            self._publish(name, peer_ips, chains), self._loop
+        )
+
+    async def _publish(
+        self, name: str, peer_ips: Optional[List[str]], chains: int
+    ) -> int:
+        file = self.get_file(name)
+        if not file.can_share or not file.digest:
+            raise NotFoundError("File is not accessible")
+        peers = self._udp_controller.known_peers
+        if peer_ips is None:
+            peer_ips = sorted(peers)
+        endpoints = [(ip, peers[ip].tcp_port) for ip in peer_ips if ip in peers]
+        if not endpoints:
+            return 0
+        chains = max(1, min(chains, len(endpoints)))
+        self._logger.info(
+            "Publishing %s to %d peers in %d chains", name, len(endpoints), chains
+        )
+        pushed = await asyncio.gather(
+            *(push_file(self, file, endpoints[index::chains]) for index in range(chains))
+        )
+        return sum(pushed)
+
+    def multicast_file(self, name: str) -> Future:
+        """
+        Sends the local file `name` once to the bulk multicast group,
+        received by the peers listening to it.
+        The future results in the numbers of data packets and repairs sent.
+        """
+        file = self.get_file(name)
+        if not file.can_share or not file.digest:
+            raise NotFoundError("File is not accessible")
+        cfg = Config()
+        sender = BulkSender(
+            self,
+            file,
+            (cfg.bulk_group, cfg.bulk_port),
+            self._multicast_ifaces()[0],
+            cfg.multicast_ttl,
+            bool(cfg.multicast_loop),
+            cfg.bulk_rate,
+        )
+        return run_coroutine_threadsafe(sender.run(), self._loop)
+
+    @staticmethod
+    def _multicast_ifaces() -> List[str]:
+        return [iface.strip() for iface in Config().multicast_ifaces.split(",")]
 
     def invalidate_file(self, name: str) -> Future:
         """
         Changes the state of file `name` to INVALID
         """
+        self._udp_controller.unshare_file(name)
         return in_background(
             self._loop.run_in_executor(
                 self._executor, self._repo.change_state, name, "INVALID"
@@ -258,6 +703,9 @@ class Controller(AbstractController):
             for state in self._state.values():
                 state.clear()
             self._state = {}
+            self._digests = {}
+            if self._bulk_listener:
+                self._loop.call_soon_threadsafe(self._bulk_listener.stop)
             self._logger.debug("Stopping UDP controller...")
             self._udp_controller.stop()
             self._logger.debug("Stopping Controller loop...")
@@ -270,11 +718,77 @@ class Controller(AbstractController):
         self, name: str = None, digest: str = None
     ) -> Dict[str, List[FoundResponse]]:
         """
-        Searches for a file `name` with optional `digest`.
+        Searches for a file `name` with optional `digest`,
+        or for any file with content `digest` if `name` is empty.
         This is a coroutine, it might take a few seconds to run.
         """
         return await self._udp_controller.search(name, digest)
 
+    async def search_files(
+        self, queries: List[Tuple[str, Optional[str]]]
+    ) -> Dict[str, Dict[str, List[FoundResponse]]]:
+        """
+        Searches for many files at once, `queries` being a list
+        of names with optional digests. Results are returned by file name.
+        """
+        return await self._udp_controller.search_many(queries)
+
+    def search_file_stream(
+        self,
+        name: str = None,
+        digest: str = None,
+        max_providers: Optional[int] = None,
+        first_match: bool = False,
+    ) -> AsyncIterator[FoundResponse]:
+        """
+        Searches for a file `name` with optional `digest`,
+        yielding the providers as they answer.
+        Stops after `max_providers` providers or the first one if `first_match` is set.
+        """
+        return self._udp_controller.search_stream(
+            name, digest, max_providers, first_match
+        )
+
+    def query_files(self, pattern: str) -> List[FoundResponse]:
+        """
+        Lists the files shared by the peers whose names match
+        the shell-style `pattern`, e.g. 'report-*' or '*.csv'.
+        Answered from the replicated peer catalogs, without network traffic.
+        """
+        return self._udp_controller.query_catalog(pattern)
+
+    def choose_provider(self, responses: List[FoundResponse]) -> FoundResponse:
+        """
+        Picks the less loaded of two random providers of a file,
+        so that the downloads spread over the providers instead of
+        all going to the one that looked idle a moment ago
+        """
+        if len(responses) == 1:
+            return responses[0]
+
+        def load_key(response: FoundResponse):
+            load = response.load
+            if load is None:
+                peer = self._udp_controller.get_peer_by_ip(response.provider_ip)
+                load = peer.load if peer else None
+            if load is None:
+                # no hints from older peers, assume they are idle
+                return (response.is_partial, False, 0, 0)
+            # peers still downloading the file come last
+            return (response.is_partial, load.free_slots == 0, load.active_consumers, load.upload_rate)
+
+        return min(random.sample(responses, 2), key=load_key)
+
+    def get_load(self) -> Tuple[int, int, int]:
+        """
+        Active uploads, upload throughput in bytes per second and free upload slots
+        """
+        active_consumers = self._active_consumers
+        return (
+            active_consumers,
+            int(self._upload_meter.rate),
+            max(UPLOAD_SLOTS - active_consumers, 0),
+        )
 
     def get_file(self, name) -> FileMetadata:
         if len(name) > MAX_FILENAME_LENGTH:
@@ -283,10 +797,46 @@ class Controller(AbstractController):
             )
         return self._get_file_state(name).file_meta
 
+    def get_chunks(
+        self, name: str, compute: bool = True
+    ) -> Optional[List[Tuple[int, bytes]]]:
+        """
+        Content-defined chunks of file `name` as (length, sha256).
+        Reads the whole file on first use, do not call it from the loop
+        unless `compute` is unset; None then if they were not computed yet.
+        """
+        return self._repo.chunks(name, compute)
+
+    def provider_chunks(self, context, chunks: List[Tuple[int, bytes]]) -> HaveMap:
+        state = self._get_file_state(context.file.name)
+        state.have = HaveMap(chunks)
+        return state.have
+
+    def get_have(self, name: str) -> Optional[HaveMap]:
+        """
+        Verified chunks of file `name` if it is downloading chunk by chunk
+        """
+        return self._get_file_state(name).have
+
+    def get_files_by_digest(self, digest: str) -> List[FileMetadata]:
+        """
+        Local files with content `digest`, whatever their names
+        """
+        with self._lock:
+            return [
+                self._state[name].file_meta for name in self._digests.get(digest, ())
+            ]
+
     def add_consumer(self, context):
-        return self._get_file_state(context.file.name).add_consumer(context)
+        self._get_file_state(context.file.name).add_consumer(context)
+        # consumers come and go on the TCP server loop only
+        self._active_consumers += 1
+
+    def consumer_update(self, context, bytes_sent: int):
+        self._upload_meter.add(bytes_sent)
 
     def remove_consumer(self, context, exc_type, exc_value):
+        self._active_consumers -= 1
         state = self._get_file_state(context.file.name)
         if exc_value and (exc_type in [InconsistentFileStateError, FileNotFoundError]):
             # Handle the case when the file state is corrupted
@@ -307,10 +857,11 @@ class Controller(AbstractController):
 
     def add_file(self, path):
         """
-        Adds external file from `path` into the repository
+        Adds external file from `path` into the repository,
+        hashed with the configured digest algorithm
         This method locks implicitly
         """
-        meta = self._repo.add_file(path)
+        meta = self._repo.add_file(path, Config().digest_alg)
         self._add_file(meta)
         return meta
 
@@ -324,6 +875,13 @@ class Controller(AbstractController):
             self._repo.remove_file(name)
             state.clear()
             del self._state[name]
+            names = self._digests.get(state.file_meta.digest)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._digests[state.file_meta.digest]
+        self._udp_controller.catalog_remove(name, state.file_meta.digest)
+        self._udp_controller.unshare_file(name)
 
     @property
     def state(self):
@@ -3,7 +3,8 @@ import logging.config
 from pathlib import Path
 import sys
 import yaml
-from simple_p2p.common.config import Config
+from simple_p2p.common.config import Config, DISCOVERY_MODES, INLINE_TRANSFER_MAX_SIZE
+from simple_p2p.common.digests import available_algorithms
 
 from simple_p2p.core.controller import Controller
 from simple_p2p.core.simple_shell import SimpleShell
@@ -27,6 +28,20 @@ def parse_cmdline():
     parser.add_argument("--broadcast-port", help="UDP port to broadcast on for peer/file discovery", type=int, default=cfg.broadcast_port)
     parser.add_argument("--broadcast-drop-chance", help="Percentage chance to drop incoming broadcast packet", type=int, default=cfg.broadcast_drop_chance)
     parser.add_argument("--broadcast-drop-in-row", help="Number of packets to be dropped at once",type=int, default=cfg.broadcast_drop_in_row)
+    parser.add_argument("--discovery-mode", help="Send peer/file discovery by subnet broadcast or IP multicast", type=str, choices=DISCOVERY_MODES, default=cfg.discovery_mode)
+    parser.add_argument("--multicast-group", help="Multicast group for peer/file discovery", type=str, default=cfg.multicast_group)
+    parser.add_argument("--multicast-ifaces", help="Comma separated interfaces to join the multicast group on, the first one sends, eg. eth0,lo", type=str, default=cfg.multicast_ifaces)
+    parser.add_argument("--multicast-ttl", help="TTL of multicast datagrams, more than 1 crosses routers", type=int, default=cfg.multicast_ttl)
+    parser.add_argument("--multicast-loop", help="Deliver multicast datagrams to this host as well (0 or 1)", type=int, choices=[0, 1], default=cfg.multicast_loop)
+    parser.add_argument("--bulk-multicast", help="Receive the files sent by multicast bulk transfer (0 or 1)", type=int, choices=[0, 1], default=cfg.bulk_multicast)
+    parser.add_argument("--bulk-group", help="Multicast group for bulk transfer, joined on the multicast interfaces", type=str, default=cfg.bulk_group)
+    parser.add_argument("--bulk-port", help="UDP port for multicast bulk transfer", type=int, default=cfg.bulk_port)
+    parser.add_argument("--bulk-rate", help="Bytes per second sent by multicast bulk transfer", type=int, default=cfg.bulk_rate)
+    parser.add_argument("--accept-push", help="Store and relay the files pushed by peers (0 or 1)", type=int, choices=[0, 1], default=cfg.accept_push)
+    parser.add_argument("--push-max-size", help="Largest file accepted by push or bulk multicast in bytes, 0 for any size", type=int, default=cfg.push_max_size)
+    parser.add_argument("--inline-transfer-size", help=f"Files of up to that many bytes are sent and fetched over UDP, without a TCP connection, 0 disables it (max {INLINE_TRANSFER_MAX_SIZE})", type=int, default=cfg.inline_transfer_size)
+    parser.add_argument("--transfer-compression", help="Compress the transfers of compressible files with zlib, or zstd when installed (0 or 1)", type=int, choices=[0, 1], default=cfg.transfer_compression)
+    parser.add_argument("--digest-alg", help="Digest algorithm identifying the content of the files added, blake3 and xxh3 when installed; peers only find each other's files by the same algorithm", type=str, choices=available_algorithms(), default=cfg.digest_alg)
     args = parser.parse_args()
     args_dict = {k: v for (k, v) in args._get_kwargs()}
     cfg.update(args_dict)
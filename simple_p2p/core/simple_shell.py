@@ -1,10 +1,10 @@
 import asyncio
-import random
 from cmd import Cmd
 
 from prettytable import PrettyTable
 
 from simple_p2p.common.config import FINGERPRINT_LENGTH
+from simple_p2p.common.digests import DIGEST_ALGORITHMS, DIGEST_SEPARATOR, split_digest
 from simple_p2p.common.exceptions import FileDuplicateException, NotFoundError
 from simple_p2p.common.models import FileStatus
 from simple_p2p.core.controller import FileStateContext, Controller
@@ -73,7 +73,7 @@ class SimpleShell(Cmd):
                 [
                     index,
                     meta.name,
-                    meta.digest[:FINGERPRINT_LENGTH],
+                    self._fingerprint(meta.digest),
                     meta.size,
                     status_msg,
                     status_progress,
@@ -83,10 +83,38 @@ class SimpleShell(Cmd):
 
         print(status_table)
 
+    @staticmethod
+    def _parse_query(inp):
+        """
+        Splits the input into a file name and a digest,
+        '<algorithm>:<digest>', e.g. 'sha256:<digest>',
+        searches for the content under any name
+        """
+        (prefix, separator, digest) = inp.partition(DIGEST_SEPARATOR)
+        algorithm = DIGEST_ALGORITHMS.get(prefix.lower())
+        if separator and algorithm is not None:
+            return None, algorithm.format(digest.lower())
+        return inp, None
+
+    @staticmethod
+    def _fingerprint(digest):
+        """
+        Start of the digest, with its algorithm unless a sha256 one
+        """
+        if not digest:
+            return ""
+        (algorithm, hex_digest) = split_digest(digest)
+        return algorithm.format(hex_digest[:FINGERPRINT_LENGTH])
+
     def _do_search(self, inp, check_duplicate=False):
+        (name, digest) = self._parse_query(inp)
         try:
-            self._controller.get_file(inp)
-            if check_duplicate:
+            if name is not None:
+                self._controller.get_file(name)
+                if check_duplicate:
+                    print("File already exists in your local repository")
+                    return
+            elif check_duplicate and self._controller.get_files_by_digest(digest):
                 print("File already exists in your local repository")
                 return
         except NotFoundError:
@@ -96,7 +124,11 @@ class SimpleShell(Cmd):
             print("Error searching file:", err)
             return
         print("Searching... please wait")
-        responses = asyncio.run(self._controller.search_file(inp))
+        try:
+            responses = asyncio.run(self._controller.search_file(name, digest))
+        except Exception as err:
+            print("Error searching file:", err)
+            return
         if len(responses) == 0:
             print("No files were found in the network")
             return
@@ -107,7 +139,7 @@ class SimpleShell(Cmd):
             name = providers[0].name
             size = providers[0].file_size
             search_table.add_row(
-                [index, name, digest[:FINGERPRINT_LENGTH], size, f"{len(providers)} peers"]
+                [index, name, self._fingerprint(digest), size, f"{len(providers)} peers"]
             )
 
         print("Files found in the network:")
@@ -115,11 +147,63 @@ class SimpleShell(Cmd):
         return responses
 
     def do_search(self, inp):
-        """search <file_name>: search for file in the network"""
+        """search <file_name> | <algorithm>:<digest>: search for file in the network"""
         self._do_search(inp)
 
+    def do_search_live(self, inp):
+        """search_live <file_name> [max_peers]: show peers as soon as they answer the search"""
+        name, max_providers = inp, None
+        args = inp.rsplit(" ", 1)
+        if len(args) == 2 and args[1].isdigit():
+            name, max_providers = args[0], int(args[1])
+
+        async def print_responses():
+            found = 0
+            async for response in self._controller.search_file_stream(
+                name, max_providers=max_providers
+            ):
+                found += 1
+                partial = (
+                    f" (downloading, {response.available} bytes)"
+                    if response.is_partial
+                    else ""
+                )
+                print(
+                    f"{found}. {response.name} | {self._fingerprint(response.digest)} | "
+                    f"{response.file_size} | from {response.provider_ip}{partial}"
+                )
+            return found
+
+        print("Searching... press Ctrl+C to stop")
+        try:
+            if asyncio.run(print_responses()) == 0:
+                print("No files were found in the network")
+        except KeyboardInterrupt:
+            print("Search stopped")
+        except Exception as err:
+            print("Error searching file:", err)
+
+    def do_catalog(self, inp):
+        """catalog <pattern>: list files shared by the peers matching a pattern, e.g. 'report-*'"""
+        responses = self._controller.query_files(inp or "*")
+        if len(responses) == 0:
+            print("No matching files in the peer catalogs")
+            return
+        catalog_table = PrettyTable()
+        catalog_table.field_names = ["Name", "Fingerprint", "Size", "From"]
+        for response in sorted(responses, key=lambda response: response.name):
+            catalog_table.add_row(
+                [
+                    response.name,
+                    self._fingerprint(response.digest),
+                    response.file_size,
+                    response.provider_ip,
+                ]
+            )
+        print(catalog_table)
+
     def do_download(self, inp):
-        """download <file_name>: download file with given name from the network"""
+        """download <file_name> | <algorithm>:<digest>: download file with given name or content from the network"""
         responses = self._do_search(inp, True)
         if responses is None:
             return
@@ -136,20 +220,43 @@ class SimpleShell(Cmd):
                 return
         # start the download
         print("Starting download...")
-        response: FoundResponse = random.choice(responses[target_digest])
+        # prefer a lightly loaded provider
+        response: FoundResponse = self._controller.choose_provider(responses[target_digest])
         target_ip = response.provider_ip
         peer = self._controller.get_peer_by_ip(target_ip)
         target_port = peer.tcp_port
         try:
+            # found by content, the providers may store it under different names
             self._controller.schedule_download(
                 response.name,
                 response.digest,
                 response.file_size,
                 (target_ip, target_port),
+                by_digest=self._parse_query(inp)[0] is None,
             )
         except FileDuplicateException as err:
             print(err)
 
+    def do_publish(self, inp):
+        """publish <file_name> [chains]: push a file to all known peers, relayed from peer to peer"""
+        name, chains = inp, 1
+        args = inp.rsplit(" ", 1)
+        if len(args) == 2 and args[1].isdigit():
+            name, chains = args[0], int(args[1])
+        try:
+            pushed = self._controller.publish(name, chains=chains).result()
+            print(f"Stored by {pushed} peers")
+        except Exception as err:
+            print("Cannot publish the file:", err)
+
+    def do_multicast(self, inp):
+        """multicast <file_name>: send a file once to all the peers listening to the bulk multicast group"""
+        try:
+            (packets, repairs) = self._controller.multicast_file(inp).result()
+            print(f"Sent {packets} packets and {repairs} repairs")
+        except Exception as err:
+            print("Cannot multicast the file:", err)
+
     def do_add(self, inp):
         """add <file_path>: add file to the local repository with absolute path"""
         try:
@@ -180,7 +287,7 @@ class SimpleShell(Cmd):
             table.add_row(
                 [
                     file.name,
-                    file.digest[:FINGERPRINT_LENGTH],
+                    self._fingerprint(file.digest),
                     file.status.name,
                     file.size,
                     file.path,
@@ -1,3 +1,4 @@
+import asyncio
 from asyncio import wait_for
 import logging
 from uuid import UUID, uuid4
@@ -6,15 +7,19 @@ from typing import *
 from logging import Logger
 from aiofile.utils import async_open
 
+from simple_p2p.common.chunking import hash_chunk, unpack_chunks
 from simple_p2p.common.config import (
-    DIGEST_ALG,
+    Config,
     FILE_CHUNK_SIZE,
     TCP_FILE_RECEIVE_TIMEOUT,
 )
+from simple_p2p.common.digests import digest_algorithm, digest_header, digest_uri
 from simple_p2p.common.exceptions import LogicError
+from simple_p2p.common.have_map import HaveMap
 from simple_p2p.common.models import AbstractController, FileMetadata
+from simple_p2p.file_transfer.encoding import accept_encoding, decoding_reader
 from simple_p2p.file_transfer.enums import KnownHeader, ProtoMethod, ProtoStatusCode
-from simple_p2p.file_transfer.exceptions import ProtoError
+from simple_p2p.file_transfer.exceptions import IncompleteProviderError, ProtoError
 from simple_p2p.file_transfer.models import (
     HeadersContainer,
     Request,
@@ -24,10 +29,12 @@ from simple_p2p.file_transfer.context import FileConsumerContext, FileProviderCo
 
 
 class ClientHandler:
-    def __init__(self, context: FileProviderContext) -> None:
+    def __init__(self, context: FileProviderContext, by_digest: bool = False) -> None:
         self._id = uuid4()
         self._logger = logging.getLogger("ClientHandler")
         self._context = context
+        # ask for the content instead of the name, the peer may store it as another file
+        self._by_digest = by_digest
         self.chunk_size = FILE_CHUNK_SIZE
 
     async def handle_content(self, response: Response, reader: StreamReader):
@@ -39,6 +46,7 @@ class ClientHandler:
             (unit, file_offset, file_until, content_length) = content_range
         else:
             file_offset = 0
+        reader = decoding_reader(reader, response.headers.content_encoding)
 
         open(file.path, "a").close()  # create if it doesn't exist
         with open(file.path, "rb+") as file_raw:
@@ -60,22 +68,37 @@ class ClientHandler:
             if file_offset < content_length:
                 raise LogicError(f"Expected {content_length} bytes, got {file_offset}")
 
+    @property
+    def _uri(self) -> str:
+        file = self._context.file
+        if self._by_digest:
+            return digest_uri(file.digest)
+        return file.name
+
+    def _headers(self) -> HeadersContainer:
+        headers = HeadersContainer()
+        file = self._context.file
+        if file.digest:
+            headers[KnownHeader.IF_DIGEST] = digest_header([file.digest])
+        if Config().transfer_compression:
+            headers[KnownHeader.ACCEPT_ENCODING] = accept_encoding()
+        return headers
+
     async def handle_connection(self, reader: StreamReader, writer: StreamWriter):
         context = self._context
-        log_extra = dict(id=self._id, method="GET", uri=context.file.name)
+        uri = self._uri
+        log_extra = dict(id=self._id, method="GET", uri=uri)
         (ip, port) = writer.get_extra_info("peername")
         self._logger.debug("New connection to %s:%s", ip, port, extra=log_extra)
 
         try:
             file = context.file
             file_offset = file.current_size
-            headers = HeadersContainer()
-            if file.digest:
-                headers[KnownHeader.IF_DIGEST] = f"{DIGEST_ALG}={file.digest}"
+            headers = self._headers()
             if file_offset:
                 headers[KnownHeader.RANGE] = f"bytes {file_offset}-"
 
-            request = Request(ProtoMethod.GET, file.name, headers)
+            request = Request(ProtoMethod.GET, uri, headers)
             await request.write_to(writer)
 
             (response, content_reader) = await Response.read_from(reader)
@@ -89,3 +112,194 @@ class ClientHandler:
             raise exc
         finally:
             writer.close()
+
+    async def handle_chunks(
+        self,
+        reader: StreamReader,
+        writer: StreamWriter,
+        find_chunk: Callable[[bytes], Optional[Tuple[str, int]]],
+        only_if_cached: bool = False,
+    ) -> bool:
+        """
+        Downloads the file chunk by chunk, copying the chunks `find_chunk`
+        locates in the local files and requesting only the others from the peer.
+        Every chunk is verified before it is written, so that the file
+        can be served by ranges while it downloads.
+        With `only_if_cached` the peer does not read the file to list its chunks.
+        Returns False if the peer does not list the chunks of the file,
+        the whole file has to be requested then, on the same connection
+        unless the peer closed it.
+        Raises `IncompleteProviderError` if the peer is still downloading the file
+        and has no more chunks to serve.
+        """
+        context = self._context
+        file = context.file
+        log_extra = dict(id=self._id, method="CHUNKS", uri=self._uri)
+        keep_open = False
+        try:
+            headers = self._headers()
+            if only_if_cached:
+                headers[KnownHeader.ONLY_IF_CACHED] = "1"
+            request = Request(ProtoMethod.CHUNKS, self._uri, headers)
+            await request.write_to(writer)
+            (response, content_reader) = await Response.read_from(reader)
+            if not ProtoStatusCode.is_success(response.status_code) or not content_reader:
+                # older peers do not know the method and close the connection
+                self._logger.debug(
+                    "Chunks not available: %s", response.status_code, extra=log_extra
+                )
+                keep_open = response.headers.get(KnownHeader.CONNECTION) == "keep-alive"
+                return False
+            chunks = unpack_chunks(
+                await wait_for(
+                    content_reader.readexactly(response.headers.content_length),
+                    TCP_FILE_RECEIVE_TIMEOUT,
+                )
+            )
+        finally:
+            if not keep_open:
+                writer.close()
+        if sum(length for (length, _) in chunks) != file.size:
+            raise LogicError("Chunks do not match the file size")
+        # a peer still downloading the file tells which chunks it has
+        provider_have = None
+        have_header = response.headers.get(KnownHeader.HAVE)
+        if have_header is not None:
+            provider_have = HaveMap.from_header(chunks, have_header)
+
+        have = context.listed(chunks)
+        sources = [find_chunk(chunk_digest) for (_, chunk_digest) in chunks]
+        try:
+            (local_bytes, remote_bytes) = await self._assemble(
+                have, sources, provider_have
+            )
+        except Exception as exc:
+            self._logger.warning("Download error", exc_info=exc, extra=log_extra)
+            raise exc
+        self._logger.info(
+            "Assembled %s from %d local and %d downloaded bytes",
+            file.name,
+            local_bytes,
+            remote_bytes,
+            extra=log_extra,
+        )
+        if not have.complete:
+            raise IncompleteProviderError(
+                f"Provider has {have.verified_bytes} of {file.size} bytes"
+            )
+        return True
+
+    async def _assemble(
+        self,
+        have: HaveMap,
+        sources: List[Optional[Tuple[str, int]]],
+        provider_have: Optional[HaveMap],
+    ) -> Tuple[int, int]:
+        """
+        Writes the file in order, marking the verified chunks in `have`.
+        Consecutive missing chunks are requested in a single range,
+        up to the first one `provider_have` lacks.
+        Returns the numbers of local and downloaded bytes.
+        """
+        context = self._context
+        file = context.file
+        chunks = have.chunks
+        # a previous attempt wrote the file up to the current size
+        resume_offset = file.current_size
+        local_bytes = 0
+        remote_bytes = 0
+        # consecutive chunks to request from the peer
+        missing: List[int] = []
+        end = file.size
+
+        open(file.path, "a").close()  # create if it doesn't exist
+        with open(file.path, "rb+") as file_raw:
+            async with async_open(file_raw) as writer:
+                for (index, (length, chunk_digest)) in enumerate(chunks):
+                    if context.should_stop:
+                        raise LogicError(f"Expected {file.size} bytes, got {have.offset(index)}")
+                    offset = have.offset(index)
+                    in_place = offset + length <= resume_offset and (
+                        await self._read_chunk((file.path, offset), length, chunk_digest)
+                        is not None
+                    )
+                    chunk = None
+                    if not in_place and sources[index] is not None:
+                        chunk = await self._read_chunk(sources[index], length, chunk_digest)
+                    if not in_place and chunk is None:
+                        if provider_have is not None and not provider_have.has(index):
+                            end = offset
+                            break
+                        missing.append(index)
+                        continue
+                    if missing:
+                        remote_bytes += await self._fetch_chunks(writer, have, missing)
+                        missing = []
+                    if chunk is not None:
+                        writer.seek(offset)
+                        await writer.write(chunk)
+                        local_bytes += length
+                    have.add(index)
+                    context.update(offset + length)
+                if missing:
+                    remote_bytes += await self._fetch_chunks(writer, have, missing)
+                file_raw.truncate(end)
+        return (local_bytes, remote_bytes)
+
+    async def _read_chunk(
+        self, source: Tuple[str, int], length: int, chunk_digest: bytes
+    ) -> Optional[bytes]:
+        """
+        Reads a chunk from a local file, None if it is no longer there
+        """
+        (path, offset) = source
+        try:
+            async with async_open(path, "rb") as reader:
+                reader.seek(offset)
+                chunk = await reader.read(length)
+        except OSError:
+            return None
+        algorithm = digest_algorithm(self._context.file.digest)
+        if hash_chunk(algorithm, chunk) != chunk_digest:
+            return None
+        return chunk
+
+    async def _fetch_chunks(self, writer, have: HaveMap, indexes: List[int]) -> int:
+        """
+        Requests the consecutive chunks `indexes` in a single range
+        on a new connection, verifies them and writes them in place
+        """
+        context = self._context
+        algorithm = digest_algorithm(context.file.digest)
+        chunks = have.chunks
+        start = have.offset(indexes[0])
+        end = have.offset(indexes[-1]) + chunks[indexes[-1]][0]
+        headers = self._headers()
+        headers[KnownHeader.RANGE] = f"bytes {start}-{end}"
+        (reader, connection) = await asyncio.open_connection(*context.endpoint)
+        try:
+            await Request(ProtoMethod.GET, self._uri, headers).write_to(connection)
+            (response, content_reader) = await Response.read_from(reader)
+            response.assert_ok()
+            if not content_reader or response.headers.content_length != end - start:
+                raise ProtoError(ProtoStatusCode.C416_INVALID_RANGE)
+            content_reader = decoding_reader(
+                content_reader, response.headers.content_encoding
+            )
+            for index in indexes:
+                if context.should_stop:
+                    raise LogicError(f"Expected {end - start} bytes")
+                (length, chunk_digest) = chunks[index]
+                chunk = await wait_for(
+                    content_reader.readexactly(length), TCP_FILE_RECEIVE_TIMEOUT
+                )
+                if hash_chunk(algorithm, chunk) != chunk_digest:
+                    raise LogicError(f"Chunk {index} does not match its digest")
+                offset = have.offset(index)
+                writer.seek(offset)
+                await writer.write(chunk)
+                have.add(index)
+                context.update(offset + length)
+        finally:
+            connection.close()
+        return end - start
@@ -1,5 +1,6 @@
 
-from typing import Tuple, Optional
+from typing import List, Tuple, Optional
+from simple_p2p.common.have_map import HaveMap
 from simple_p2p.common.models import AbstractController, FileMetadata
 from simple_p2p.file_transfer.exceptions import InconsistentFileStateError
 
@@ -45,6 +46,9 @@ class FileConsumerContext(FileContext):
         self._controller.add_consumer(self)
         return self
 
+    def sent(self, num_bytes: int):
+        self._controller.consumer_update(self, num_bytes)
+
     def __exit__(self, exc_type, exc_value, tb):
         self._controller.remove_consumer(self, exc_type, exc_value)
 
@@ -57,6 +61,13 @@ class FileProviderContext(FileContext):
     def update(self, bytes_downloaded: int):
         self._controller.provider_update(self, bytes_downloaded)
 
+    def listed(self, chunks: List[Tuple[int, bytes]]) -> HaveMap:
+        """
+        Called with the chunks of the file listed by the provider,
+        returns the map of the verified ones
+        """
+        return self._controller.provider_chunks(self, chunks)
+
     def __exit__(self, exc_type, exc_value, tb):
         self._controller.remove_provider(self, exc_type, exc_value)
         return super(FileProviderContext, self).__exit__(exc_type, exc_value, tb)
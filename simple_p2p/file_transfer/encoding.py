@@ -0,0 +1,231 @@
+import asyncio
+import struct
+import zlib
+from asyncio.streams import StreamReader
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Union
+
+from simple_p2p.common.config import (
+    COMPRESSION_CACHE_SIZE,
+    COMPRESSION_FRAME_SIZE,
+    COMPRESSION_MIN_RATIO,
+    COMPRESSION_SAMPLE_SIZE,
+    COMPRESSION_SAMPLES,
+)
+from simple_p2p.common.exceptions import UnsupportedError
+
+try:
+    import zstandard
+except ImportError:  # optional, zlib is always available
+    zstandard = None
+
+# flags, length of the decoded content, length of the payload
+FRAME_HEADER = struct.Struct("!BII")
+# the payload is compressed, otherwise it is sent as is
+FRAME_COMPRESSED = 0x01
+
+
+class Codec:
+    """
+    Compression of the frames of an encoded body,
+    every frame being compressed on its own
+    """
+
+    __slots__ = ("name", "_compress", "_decompress")
+
+    def __init__(
+        self,
+        name: str,
+        compress: Callable[[bytes], bytes],
+        decompress: Callable[[bytes, int], bytes],
+    ):
+        self.name = name
+        self._compress = compress
+        self._decompress = decompress
+
+    def encode_frame(self, block: bytes) -> bytes:
+        """
+        Frame carrying `block`, left uncompressed if that does not make it smaller
+        """
+        payload = self._compress(block)
+        if len(payload) >= len(block):
+            return FRAME_HEADER.pack(0, len(block), len(block)) + block
+        return FRAME_HEADER.pack(FRAME_COMPRESSED, len(block), len(payload)) + payload
+
+    def decode_payload(self, payload: bytes, length: int) -> bytes:
+        """
+        Decompresses at most `length` bytes, as announced by the frame.
+        Raises `UnsupportedError` if the payload does not decompress to them.
+        """
+        try:
+            block = self._decompress(payload, length)
+        except Exception as exc:
+            raise UnsupportedError(f"Invalid {self.name} frame: {exc}")
+        if len(block) != length:
+            raise UnsupportedError(f"Invalid {self.name} frame length")
+        return block
+
+
+def _zlib_decompress(payload: bytes, length: int) -> bytes:
+    decompressor = zlib.decompressobj()
+    # a frame never decodes to more than it announces
+    block = decompressor.decompress(payload, length)
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise UnsupportedError("Frame longer than announced")
+    return block
+
+
+# supported encodings, the preferred first
+CODECS: Dict[str, Codec] = OrderedDict()
+if zstandard is not None:
+    CODECS["zstd"] = Codec(
+        "zstd",
+        zstandard.ZstdCompressor(level=3).compress,
+        lambda payload, length: zstandard.ZstdDecompressor().decompress(
+            payload, max_output_size=length
+        ),
+    )
+CODECS["zlib"] = Codec("zlib", lambda block: zlib.compress(block, 1), _zlib_decompress)
+
+
+def accept_encoding() -> str:
+    """
+    Value of the Accept-Encoding header, the supported encodings
+    """
+    return ", ".join(CODECS)
+
+
+def choose_codec(accepted: Optional[str]) -> Optional[Codec]:
+    """
+    First encoding of the Accept-Encoding value `accepted` supported here
+    """
+    if not accepted:
+        return None
+    for name in accepted.split(","):
+        codec = CODECS.get(name.strip().lower())
+        if codec is not None:
+            return codec
+    return None
+
+
+def get_codec(name: str) -> Codec:
+    """
+    Raises `UnsupportedError` if the Content-Encoding `name` is not supported
+    """
+    codec = CODECS.get(name.strip().lower())
+    if codec is None:
+        raise UnsupportedError(f"Unsupported content encoding '{name}'")
+    return codec
+
+
+def compression_ratio(path: str, size: int) -> float:
+    """
+    Ratio of the compressed to the original size of a few samples
+    spread over the file, 1 if nothing is gained
+    """
+    sample_size = COMPRESSION_SAMPLE_SIZE // COMPRESSION_SAMPLES
+    step = max(size // COMPRESSION_SAMPLES, sample_size)
+    original = 0
+    compressed = 0
+    with open(path, "rb") as file:
+        for offset in range(0, size, step):
+            file.seek(offset)
+            sample = file.read(sample_size)
+            original += len(sample)
+            compressed += len(zlib.compress(sample, 1))
+    if not original:
+        return 1
+    return min(compressed / original, 1)
+
+
+class CompressibilityCache:
+    """
+    Whether the files are worth compressing, by digest,
+    forgetting the least recently used ones.
+    Does not perform locking.
+    """
+
+    def __init__(self, max_entries: int = COMPRESSION_CACHE_SIZE):
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[str, bool]" = OrderedDict()
+
+    def get(self, digest: str) -> Optional[bool]:
+        value = self._entries.get(digest)
+        if value is not None:
+            self._entries.move_to_end(digest)
+        return value
+
+    def put(self, digest: str, ratio: float) -> bool:
+        compressible = ratio <= COMPRESSION_MIN_RATIO
+        self._entries[digest] = compressible
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        return compressible
+
+
+class DecodingReader:
+    """
+    Reads the frames of an encoded body from `reader`,
+    giving the decoded content as the `StreamReader` methods would
+    """
+
+    def __init__(self, reader: StreamReader, codec: Codec):
+        self._reader = reader
+        self._codec = codec
+        self._buffer = b""
+        self._offset = 0
+
+    async def _next_frame(self) -> bool:
+        """
+        Decodes the next frame into the buffer, False at the end of the stream
+        """
+        try:
+            header = await self._reader.readexactly(FRAME_HEADER.size)
+        except asyncio.IncompleteReadError as exc:
+            if exc.partial:
+                raise
+            return False
+        (flags, length, payload_length) = FRAME_HEADER.unpack(header)
+        if length > COMPRESSION_FRAME_SIZE or payload_length > length:
+            raise UnsupportedError("Invalid frame length")
+        payload = await self._reader.readexactly(payload_length)
+        if flags & FRAME_COMPRESSED:
+            payload = self._codec.decode_payload(payload, length)
+        elif payload_length != length:
+            raise UnsupportedError("Invalid frame length")
+        self._buffer = payload
+        self._offset = 0
+        return True
+
+    async def read(self, n: int = -1) -> bytes:
+        if self._offset >= len(self._buffer) and not await self._next_frame():
+            return b""
+        end = len(self._buffer) if n < 0 else self._offset + n
+        data = self._buffer[self._offset : end]
+        self._offset += len(data)
+        return data
+
+    async def readexactly(self, n: int) -> bytes:
+        parts: List[bytes] = []
+        missing = n
+        while missing > 0:
+            data = await self.read(missing)
+            if not data:
+                partial = b"".join(parts)
+                raise asyncio.IncompleteReadError(partial, n)
+            parts.append(data)
+            missing -= len(data)
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+
+def decoding_reader(
+    reader: StreamReader, content_encoding: Optional[str]
+) -> Union[StreamReader, DecodingReader]:
+    """
+    Reader of the decoded body sent with the Content-Encoding `content_encoding`.
+    Raises `UnsupportedError` if the encoding is not supported.
+    """
+    if not content_encoding:
+        return reader
+    return DecodingReader(reader, get_codec(content_encoding))
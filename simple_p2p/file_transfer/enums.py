@@ -5,8 +5,10 @@ STATUS_DESCRIPTIONS = {
     200: "OK",
     206: "Partial content",
     400: "Bad request",
+    403: "Forbidden",
     404: "Not found",
     412: "Precondition failed",
+    413: "Content too large",
     416: "Invalid range",
     500: "Server error",
 }
@@ -16,8 +18,10 @@ class ProtoStatusCode(int, Enum):
     C200_OK = 200
     C206_PARTIAL_CONTENT = 206
     C400_BAD_REQUEST = 400
+    C403_FORBIDDEN = 403
     C404_NOT_FOUND = 404
     C412_PRECONDITION_FAILED = 412
+    C413_CONTENT_TOO_LARGE = 413
     C416_INVALID_RANGE = 416
     C500_SERVER_ERROR = 500
 
@@ -54,6 +58,10 @@ class ValidatingEnum(Enum):
 class ProtoMethod(str, ValidatingEnum):
     GET = "GET"
     HEAD = "HEAD"
+    # content-defined chunks of the file, see `simple_p2p.common.chunking`
+    CHUNKS = "CHUNKS"
+    # file sent by the client, relayed along a chain of peers, see `push`
+    PUSH = "PUSH"
 
     @classmethod
     def sanitize(cls, method: str) -> str:
@@ -67,6 +75,21 @@ class KnownHeader(str, ValidatingEnum):
     IF_DIGEST = "if-digest"
     DIGEST = "digest"
     RANGE = "range"
+    # encodings of the body the client can decode, as a comma-separated list
+    ACCEPT_ENCODING = "accept-encoding"
+    # the body is sent in frames compressed with that encoding, see `encoding`;
+    # the content length and range still refer to the decoded content
+    CONTENT_ENCODING = "content-encoding"
+    # base64 bitmap of the chunks a provider still downloading can serve
+    HAVE = "have"
+    # set on a CHUNKS request, only a list the provider already has is sent
+    ONLY_IF_CACHED = "only-if-cached"
+    # "keep-alive" if the provider reads another request on the connection
+    CONNECTION = "connection"
+    # remaining hops of a PUSH, as comma-separated ip:port
+    CHAIN = "chain"
+    # peers that stored a pushed file, this one and the rest of the chain
+    PUSHED = "pushed"
 
     @classmethod
     def sanitize(cls, header: str) -> str:
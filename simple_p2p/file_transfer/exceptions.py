@@ -14,4 +14,20 @@ class InvalidRangeError(LogicError):
     pass
 
 class InconsistentFileStateError(LogicError):
-    pass
\ No newline at end of file
+    pass
+
+
+class IncompleteProviderError(LogicError):
+    """
+    The provider is still downloading the file and has no more chunks to serve
+    """
+
+    pass
+
+
+class DigestMismatchError(LogicError):
+    """
+    The received content does not match its digest
+    """
+
+    pass
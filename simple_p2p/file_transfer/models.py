@@ -1,3 +1,4 @@
+import asyncio
 from abc import ABC, abstractmethod
 from asyncio.streams import StreamReader, StreamWriter
 from asyncio import wait_for
@@ -7,6 +8,7 @@ from typing import *
 
 from aiofile.utils import async_open
 from simple_p2p.file_transfer.exceptions import InconsistentFileStateError, InvalidRangeError, ProtoError
+from simple_p2p.file_transfer.encoding import Codec
 from simple_p2p.file_transfer.io_utils import calc_range_len
 from simple_p2p.file_transfer.parse_utils import *
 from simple_p2p.file_transfer.enums import (
@@ -15,7 +17,12 @@ from simple_p2p.file_transfer.enums import (
     ProtoMethod,
     ProtoStatusCode,
 )
-from simple_p2p.common.config import FILE_CHUNK_SIZE, TCP_FILE_SEND_TIMEOUT
+from simple_p2p.common.config import (
+    COMPRESSION_FRAME_SIZE,
+    FILE_CHUNK_SIZE,
+    TCP_FILE_SEND_TIMEOUT,
+)
+from simple_p2p.common.digests import digest_header
 from simple_p2p.common.models import FileMetadata
 from simple_p2p.common.exceptions import LogicError
 
@@ -91,6 +98,10 @@ class HeadersContainer(SanitizingDict):
         value = self.get(KnownHeader.RANGE, None)
         return None if value is None else parse_range_header(value)
 
+    @property
+    def content_encoding(self) -> Optional[str]:
+        return self.get(KnownHeader.CONTENT_ENCODING)
+
     @property
     def content_range(self) -> Optional[Tuple[str, int, int, int]]:
         value = self.get(KnownHeader.CONTENT_RANGE)
@@ -204,6 +215,23 @@ class Response:
         return (response, content_stream)
 
 
+class BytesResponse(Response):
+    """
+    `Response` with a small in-memory body
+    """
+
+    def __init__(self, body: bytes, headers=None, **kwargs):
+        headers = headers or HeadersContainer()
+        self.body = body
+        headers[KnownHeader.CONTENT_LENGTH] = str(len(body))
+        headers.set_default(KnownHeader.CONTENT_TYPE, ContentType.OCTET_STREAM)
+        super().__init__(status_code=ProtoStatusCode.C200_OK, headers=headers, **kwargs)
+
+    async def _write_body(self, writer: StreamWriter):
+        writer.write(self.body)
+        await wait_for(writer.drain(), TCP_FILE_SEND_TIMEOUT)
+
+
 class FileProvider(ABC):
     """
     Provides a file to be written into the output stream
@@ -221,6 +249,12 @@ class FileProvider(ABC):
     def stop(self) -> None:
         pass
 
+    def sent(self, num_bytes: int) -> None:
+        """
+        Called after each chunk of `num_bytes` is written into the stream
+        """
+        pass
+
 
 class ByteRange:
     """
@@ -267,6 +301,7 @@ class FileResponse(Response):
         range: ByteRange = None,
         chunk_size=FILE_CHUNK_SIZE,
         headers=None,
+        codec: Optional[Codec] = None,
         **kwargs,
     ):
         headers = headers or HeadersContainer()
@@ -275,6 +310,8 @@ class FileResponse(Response):
         self.file_provider = file_provider
         self.range = range
         self.chunk_size = chunk_size
+        # compresses the body in frames, the headers describe the decoded content
+        self.codec = codec
 
         file = file_provider.file
         range_length = range.get_effective_length(file.size)
@@ -290,11 +327,15 @@ class FileResponse(Response):
             ] = f"bytes {self.range.offset}-{self.range.offset + range_length}/{file.size}"
             status_code = ProtoStatusCode.C206_PARTIAL_CONTENT
         if file.digest:
-            headers[KnownHeader.DIGEST] = file.digest
+            headers[KnownHeader.DIGEST] = digest_header([file.digest])
+        if codec is not None:
+            headers[KnownHeader.CONTENT_ENCODING] = codec.name
 
         super().__init__(status_code=status_code, headers=headers, **kwargs)
 
     async def _write_body(self, writer: StreamWriter):
+        if self.codec is not None:
+            return await self._write_frames(writer)
         fp: FileProvider
         content_length = self.headers.content_length
         with self.file_provider as fp:
@@ -309,8 +350,44 @@ class FileResponse(Response):
                     to_read -= num_read_bytes
                     writer.write(read_bytes)
                     await wait_for(writer.drain(), TCP_FILE_SEND_TIMEOUT)
+                    fp.sent(num_read_bytes)
                 if to_read > 0:
                     raise InconsistentFileStateError(
                         f"Expected {content_length} bytes, got {content_length - to_read}"
                     )
         await writer.drain()
+
+    async def _write_frames(self, writer: StreamWriter):
+        """
+        Writes the body in frames of COMPRESSION_FRAME_SIZE bytes compressed
+        in an executor, the next frame being compressed while one is sent
+        """
+        fp: FileProvider
+        loop = asyncio.get_running_loop()
+        content_length = self.headers.content_length
+        with self.file_provider as fp:
+            to_read = content_length
+            pending: Optional[asyncio.Future] = None
+            async with async_open(fp.file.path, "rb") as file:
+                file.seek(self.range.offset)
+                while to_read > 0 and not fp.should_stop:
+                    block = await file.read(min(COMPRESSION_FRAME_SIZE, to_read))
+                    if not block:
+                        break
+                    to_read -= len(block)
+                    encoding = loop.run_in_executor(None, self.codec.encode_frame, block)
+                    if pending is not None:
+                        await self._write_frame(writer, await pending)
+                    pending = encoding
+                if pending is not None:
+                    await self._write_frame(writer, await pending)
+                if to_read > 0:
+                    raise InconsistentFileStateError(
+                        f"Expected {content_length} bytes, got {content_length - to_read}"
+                    )
+        await writer.drain()
+
+    async def _write_frame(self, writer: StreamWriter, frame: bytes):
+        writer.write(frame)
+        await wait_for(writer.drain(), TCP_FILE_SEND_TIMEOUT)
+        self.file_provider.sent(len(frame))
@@ -70,9 +70,9 @@ def parse_content_range_header(value: str) -> Tuple[str, int, int, int]:
 def parse_kv_header(value: str) -> dict[str, Optional[str]]:
     """
     Parses a key-value header of form
-    `key=value`
+    `key=value`, the pairs separated by commas or spaces
     """
-    pattern = r"(\S+)=(\S*)"
+    pattern = r"([^\s,=]+)=([^\s,]*)"
     matches = re.finditer(pattern, value)
     result = {match[1]: match[2] for match in matches}
     return result
@@ -0,0 +1,274 @@
+import asyncio
+import logging
+from asyncio import wait_for
+from asyncio.streams import StreamReader, StreamWriter
+from contextlib import AsyncExitStack, ExitStack
+from ipaddress import ip_address
+from typing import List, Optional, Tuple
+
+from aiofile.utils import async_open
+
+from simple_p2p.common.config import (
+    Config,
+    FILE_CHUNK_SIZE,
+    TCP_FILE_RECEIVE_TIMEOUT,
+    TCP_FILE_SEND_TIMEOUT,
+    TCP_PUSH_ACK_TIMEOUT,
+)
+from simple_p2p.common.digests import digest_header, digests_from_header
+from simple_p2p.common.exceptions import LogicError, UnsupportedError
+from simple_p2p.common.models import AbstractController, FileMetadata
+from simple_p2p.file_transfer.context import FileConsumerContext, FileProviderContext
+from simple_p2p.file_transfer.enums import KnownHeader, ProtoMethod, ProtoStatusCode
+from simple_p2p.file_transfer.models import (
+    HeadersContainer,
+    Request,
+    Response,
+)
+
+# bytes read at once, the default limit of the stream readers
+PUSH_BLOCK_SIZE = 4 * FILE_CHUNK_SIZE
+
+_logger = logging.getLogger("Push")
+
+
+def format_chain(chain: List[Tuple[str, int]]) -> str:
+    return ",".join(f"{ip}:{port}" for (ip, port) in chain)
+
+
+def parse_chain(value: str) -> List[Tuple[str, int]]:
+    """
+    Raises `UnsupportedError` if `value` is not a list of ip:port
+    """
+    chain = []
+    for hop in filter(None, value.split(",")):
+        (ip, _, port) = hop.strip().rpartition(":")
+        try:
+            ip_address(ip)
+        except ValueError:
+            raise UnsupportedError(f"Invalid chain hop: '{hop}'")
+        if not port.isdigit() or not 0 < int(port) < 65536:
+            raise UnsupportedError(f"Invalid chain hop: '{hop}'")
+        chain.append((ip, int(port)))
+    return chain
+
+
+def unknown_hop(
+    controller: AbstractController, chain: List[Tuple[str, int]]
+) -> Optional[Tuple[str, int]]:
+    """
+    First hop of `chain` that is not the TCP endpoint of a discovered peer,
+    a push is only relayed inside the network
+    """
+    for (ip, port) in chain:
+        peer = controller.get_peer_by_ip(ip)
+        if peer is None or peer.tcp_port != port:
+            return (ip, port)
+    return None
+
+
+async def open_push(
+    name: str, digest: str, size: int, chain: List[Tuple[str, int]]
+) -> Optional[Tuple[StreamReader, StreamWriter]]:
+    """
+    Sends the PUSH request to the first reachable peer of `chain`,
+    with the peers after it as the rest of the chain.
+    Returns None if none of them answers.
+    """
+    for (index, endpoint) in enumerate(chain):
+        try:
+            (reader, writer) = await asyncio.open_connection(*endpoint)
+        except OSError as exc:
+            _logger.warning("Skipping unreachable peer %s: %s", endpoint[0], exc)
+            continue
+        headers = HeadersContainer()
+        headers[KnownHeader.CONTENT_LENGTH] = str(size)
+        headers[KnownHeader.DIGEST] = digest_header([digest])
+        headers[KnownHeader.CHAIN] = format_chain(chain[index + 1 :])
+        await Request(ProtoMethod.PUSH, name, headers).write_to(writer)
+        return (reader, writer)
+    return None
+
+
+async def finish_push(
+    streams: Optional[Tuple[StreamReader, StreamWriter]],
+    answer: Optional[asyncio.Future] = None,
+) -> int:
+    """
+    Waits for the answer of the next peer, read by `answer` if already awaited,
+    returns the number of peers that stored the file
+    """
+    if streams is None:
+        return 0
+    (reader, writer) = streams
+    try:
+        if answer is None:
+            answer = Response.read_from(reader)
+        (response, _) = await wait_for(answer, TCP_PUSH_ACK_TIMEOUT)
+        if not ProtoStatusCode.is_success(response.status_code):
+            _logger.warning("Push refused: %s", response.status_code)
+            return 0
+        return int(response.headers.get(KnownHeader.PUSHED, "0"))
+    finally:
+        writer.close()
+
+
+async def push_file(
+    controller: AbstractController, file: FileMetadata, chain: List[Tuple[str, int]]
+) -> int:
+    """
+    Sends the local `file` to the first peer of `chain`, which stores
+    every block while relaying it to the next peer, and so on.
+    All the peers receive at the same time, so the whole chain
+    takes about as long as a single transfer.
+    Returns the number of peers that stored the file.
+    """
+    streams = await open_push(file.name, file.digest, file.size, chain)
+    if streams is None:
+        return 0
+    (reader, writer) = streams
+    # a refused push is answered before its body is read
+    answer = asyncio.ensure_future(Response.read_from(reader))
+    try:
+        with FileConsumerContext(controller, file, chain[0]) as context:
+            async with async_open(file.path, "rb") as source:
+                while not context.should_stop and not answer.done():
+                    block = await source.read(PUSH_BLOCK_SIZE)
+                    if not block:
+                        break
+                    writer.write(block)
+                    await wait_for(writer.drain(), TCP_FILE_SEND_TIMEOUT)
+                    context.sent(len(block))
+    except ConnectionError:
+        # the connection is reset after the answer to a refused push
+        if not answer.done():
+            writer.close()
+            raise
+    except BaseException:
+        answer.cancel()
+        writer.close()
+        raise
+    return await finish_push(streams, answer)
+
+
+class PushHandler:
+    """
+    Receives a pushed file, storing it unless it is here already,
+    while relaying every block to the next peer of the chain as it arrives.
+    Pushes are refused unless enabled by `Config.accept_push`,
+    and when the chain goes through peers that were not discovered.
+    """
+
+    def __init__(
+        self, controller: AbstractController, endpoint: Optional[Tuple[str, int]]
+    ) -> None:
+        self._controller = controller
+        self._endpoint = endpoint
+
+    async def handle(self, request: Request, reader: StreamReader) -> Response:
+        size = request.headers.content_length
+        # any of the digests identifies the content, the first one is kept
+        digest = next(iter(digests_from_header(request.headers.digest or {}).values()), None)
+        if size is None or not digest:
+            raise UnsupportedError("Push requires the content length and digest")
+        cfg = Config()
+        if not cfg.accept_push:
+            _logger.info("Refusing push of %s, not accepting pushes", request.uri)
+            return Response(ProtoStatusCode.C403_FORBIDDEN)
+        if cfg.push_max_size and size > cfg.push_max_size:
+            _logger.info("Refusing push of %s, %d bytes is too large", request.uri, size)
+            return Response(ProtoStatusCode.C413_CONTENT_TOO_LARGE)
+        chain = parse_chain(request.headers.get(KnownHeader.CHAIN, ""))
+        hop = unknown_hop(self._controller, chain)
+        if hop is not None:
+            _logger.info("Refusing push of %s, unknown peer %s:%d", request.uri, *hop)
+            return Response(ProtoStatusCode.C403_FORBIDDEN)
+
+        file = self._controller.accept_push(request.uri, digest, size)
+        downstream = None
+        if chain:
+            downstream = await open_push(request.uri, digest, size, chain)
+        try:
+            with ExitStack() as stack:
+                context = None
+                if file is not None:
+                    context = stack.enter_context(
+                        FileProviderContext(self._controller, file, self._endpoint)
+                    )
+                downstream = await self._relay(reader, size, context, downstream)
+            # the rest of the chain checks its copies meanwhile
+            (stored, relayed) = await asyncio.gather(
+                self._complete(file), finish_push(downstream), return_exceptions=True
+            )
+        except BaseException:
+            if downstream is not None:
+                downstream[1].close()
+            raise
+        if isinstance(relayed, Exception):
+            _logger.warning("Push relay of %s failed", request.uri, exc_info=relayed)
+            relayed = 0
+        headers = HeadersContainer()
+        headers[KnownHeader.PUSHED] = str(int(stored is True) + relayed)
+        return Response(ProtoStatusCode.C200_OK, headers=headers)
+
+    async def _relay(
+        self,
+        reader: StreamReader,
+        size: int,
+        context: Optional[FileProviderContext],
+        downstream: Optional[Tuple[StreamReader, StreamWriter]],
+    ) -> Optional[Tuple[StreamReader, StreamWriter]]:
+        """
+        Copies the body of the request into the file of `context`, if any,
+        and to the `downstream` peer, if it keeps up.
+        Returns the `downstream` streams, None once it failed.
+        """
+        next_writer = downstream[1] if downstream is not None else None
+        received = 0
+        async with AsyncExitStack() as stack:
+            writer = None
+            if context is not None:
+                file_raw = stack.enter_context(open(context.file.path, "wb"))
+                writer = await stack.enter_async_context(async_open(file_raw))
+            while received < size:
+                if context is not None and context.should_stop:
+                    break
+                block = await wait_for(
+                    reader.read(min(PUSH_BLOCK_SIZE, size - received)),
+                    TCP_FILE_RECEIVE_TIMEOUT,
+                )
+                if not block:
+                    break
+                # the next peer gets the block before it is written here
+                if next_writer is not None:
+                    next_writer.write(block)
+                if writer is not None:
+                    await writer.write(block)
+                received += len(block)
+                if context is not None:
+                    context.update(received)
+                if next_writer is not None:
+                    try:
+                        await wait_for(next_writer.drain(), TCP_FILE_SEND_TIMEOUT)
+                    except (ConnectionError, asyncio.TimeoutError) as exc:
+                        _logger.warning("Push relay stopped: %s", exc)
+                        next_writer.close()
+                        next_writer = None
+        if received < size:
+            if next_writer is not None:
+                next_writer.close()
+            raise LogicError(f"Expected {size} bytes, got {received}")
+        return downstream if next_writer is not None else None
+
+    async def _complete(self, file: Optional[FileMetadata]) -> bool:
+        """
+        Whether the pushed `file` was stored and is valid
+        """
+        if file is None:
+            return False
+        try:
+            await self._controller.complete_download(file)
+        except Exception as exc:
+            _logger.warning("Pushed file %s is invalid", file.name, exc_info=exc)
+            return False
+        return True
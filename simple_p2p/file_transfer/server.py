@@ -1,3 +1,4 @@
+import asyncio
 from asyncio import CancelledError
 from cmath import log
 import logging
@@ -7,19 +8,35 @@ from typing import *
 from xmlrpc.client import Transport
 import socket
 
-from simple_p2p.common.config import DIGEST_ALG
-from simple_p2p.common.models import AbstractController, FileMetadata
-from simple_p2p.file_transfer.enums import ProtoMethod, ProtoStatusCode
+from simple_p2p.common.chunking import pack_chunks
+from simple_p2p.common.config import (
+    COMPRESSION_MIN_SIZE,
+    Config,
+)
+from simple_p2p.common.digests import digests_from_header, parse_digest_uri
+from simple_p2p.common.models import AbstractController, FileMetadata, FileStatus
+from simple_p2p.file_transfer.enums import KnownHeader, ProtoMethod, ProtoStatusCode
+from simple_p2p.file_transfer.encoding import (
+    Codec,
+    CompressibilityCache,
+    choose_codec,
+    compression_ratio,
+)
 from simple_p2p.file_transfer.exceptions import InvalidRangeError
 from simple_p2p.common.exceptions import FileNameTooLongException, ParseError, UnsupportedError, NotFoundError
 from simple_p2p.file_transfer.models import (
     ByteRange,
-    DigestContainer,
+    BytesResponse,
     FileResponse,
+    HeadersContainer,
     Request,
     Response,
 )
 from simple_p2p.file_transfer.context import FileConsumerContext
+from simple_p2p.file_transfer.push import PushHandler
+
+# whether the shared files are worth compressing, used by the server loop only
+_compressibility = CompressibilityCache()
 
 
 class ServerHandler:
@@ -37,10 +54,37 @@ class ServerHandler:
     ) -> FileConsumerContext:
         return FileConsumerContext(self._controller, file, endpoint)
 
-    async def handle_request(self, request: Request, endpoint: Tuple[str, int]):
+    def resolve_file(self, uri: str) -> FileMetadata:
+        """
+        Resolves the request `uri`, either a file name
+        or the `digest_uri` of the content
         """
-        Main function that handles the request; it should return a `Response`
+        digest = parse_digest_uri(uri)
+        if digest is None:
+            return self._controller.get_file(uri)
+        files = self._controller.get_files_by_digest(digest)
+        for file in files:
+            if file.can_share:
+                return file
+        # otherwise a file still downloading, which serves what it has
+        for file in files:
+            if self._controller.get_have(file.name) is not None:
+                return file
+        raise NotFoundError(f"No shareable file with digest '{digest}'")
+
+    async def handle_request(
+        self,
+        request: Request,
+        endpoint: Tuple[str, int],
+        reader: Optional[StreamReader] = None,
+    ):
         """
+        Main function that handles the request; it should return a `Response`.
+        The body of a PUSH is read from `reader`.
+        """
+        if request.method == ProtoMethod.PUSH:
+            return await PushHandler(self._controller, endpoint).handle(request, reader)
+
         range: ByteRange = None
         digest: str = None
         range_raw = request.headers.range
@@ -51,20 +95,81 @@ class ServerHandler:
             range = ByteRange.from_interval(start, end)
 
         try:
-            file = self._controller.get_file(request.uri)
+            file = self.resolve_file(request.uri)
         except FileNameTooLongException:
             return Response(ProtoStatusCode.C400_BAD_REQUEST)
 
         if_digest = request.headers.if_digest
         if if_digest:
-            digest = DigestContainer(if_digest).get(DIGEST_ALG, None)
-            if not digest:
+            digests = digests_from_header(if_digest)
+            if not digests:
                 raise UnsupportedError(f"No supported algorithm found in if-digest.")
-            if digest != file.digest:
+            # the content is only known by the digest of the file,
+            # the ones of the other algorithms cannot be checked
+            if file.digest not in digests.values():
                 return Response(ProtoStatusCode.C412_PRECONDITION_FAILED)
 
+        have = None
+        if file.status == FileStatus.DOWNLOADING:
+            # only the chunks verified so far can be served
+            have = self._controller.get_have(file.name)
+            if have is None:
+                raise NotFoundError("File is not accessible")
+
+        if request.method == ProtoMethod.CHUNKS:
+            # the client may ask for the file on the same connection next
+            headers = HeadersContainer()
+            headers[KnownHeader.CONNECTION] = "keep-alive"
+            if have is not None:
+                headers[KnownHeader.HAVE] = have.to_header()
+                return BytesResponse(pack_chunks(have.chunks), headers)
+            if request.headers.get(KnownHeader.ONLY_IF_CACHED) is not None:
+                chunks = self._controller.get_chunks(file.name, False)
+                if chunks is None:
+                    return Response(
+                        ProtoStatusCode.C412_PRECONDITION_FAILED, headers=headers
+                    )
+                return BytesResponse(pack_chunks(chunks), headers)
+            # chunked on first use, which reads the whole file
+            chunks = await asyncio.get_running_loop().run_in_executor(
+                None, self._controller.get_chunks, file.name
+            )
+            return BytesResponse(pack_chunks(chunks), headers)
+
+        if have is not None:
+            range = range or ByteRange()
+            if not have.has_range(range.offset, range.get_effective_length(file.size)):
+                raise InvalidRangeError("Range not downloaded yet")
+
+        codec = None
+        if have is None and request.method == ProtoMethod.GET:
+            codec = await self._choose_codec(request, file, range)
         provider = self.new_consumer(file, endpoint)
-        return FileResponse(provider, range)
+        return FileResponse(provider, range, codec=codec)
+
+    async def _choose_codec(
+        self, request: Request, file: FileMetadata, range: Optional[ByteRange]
+    ) -> Optional[Codec]:
+        """
+        Encoding to compress the response with, if the client accepts one
+        and a sample of the file shows it is worth it
+        """
+        codec = choose_codec(request.headers.get(KnownHeader.ACCEPT_ENCODING))
+        if codec is None or not Config().transfer_compression or not file.digest:
+            return None
+        length = (range or ByteRange()).get_effective_length(file.size)
+        if length < COMPRESSION_MIN_SIZE:
+            return None
+        compressible = _compressibility.get(file.digest)
+        if compressible is None:
+            ratio = await asyncio.get_running_loop().run_in_executor(
+                None, compression_ratio, file.path, file.size
+            )
+            compressible = _compressibility.put(file.digest, ratio)
+            self._logger.debug(
+                "File %s compresses to %.2f of its size", file.name, ratio
+            )
+        return codec if compressible else None
 
     async def handle_client(self, reader: StreamReader, writer: StreamWriter):
         """
@@ -91,28 +196,33 @@ class ServerHandler:
         request: Request = None
         response: Response = None
         try:
-
-            try:
-                request = await Request.read_from(reader)
-            except (ValueError, ParseError) as e:
-                return await error_response(ProtoStatusCode.C400_BAD_REQUEST, e)
-            except Exception as e:
-                return await error_response(ProtoStatusCode.C500_SERVER_ERROR, e)
-            log_extra["method"] = request.method.value
-            log_extra["uri"] = request.uri
-            try:
-                response = await self.handle_request(request, (ip, port))
-            except UnsupportedError as e:
-                return await error_response(ProtoStatusCode.C400_BAD_REQUEST, e)
-            except InvalidRangeError as e:
-                return await error_response(ProtoStatusCode.C416_INVALID_RANGE, e)
-            except (FileNotFoundError, NotFoundError) as e:
-                return await error_response(ProtoStatusCode.C404_NOT_FOUND, e)
-            except Exception as e:
-                return await error_response(ProtoStatusCode.C500_SERVER_ERROR, e)
-
-            include_body = request.method == ProtoMethod.GET
-            await write_response(response, include_body=include_body)
+            while True:
+                try:
+                    request = await Request.read_from(reader)
+                except (ValueError, ParseError) as e:
+                    if response is not None and reader.at_eof():
+                        # the client closed a kept-alive connection
+                        return
+                    return await error_response(ProtoStatusCode.C400_BAD_REQUEST, e)
+                except Exception as e:
+                    return await error_response(ProtoStatusCode.C500_SERVER_ERROR, e)
+                log_extra["method"] = request.method.value
+                log_extra["uri"] = request.uri
+                try:
+                    response = await self.handle_request(request, (ip, port), reader)
+                except UnsupportedError as e:
+                    return await error_response(ProtoStatusCode.C400_BAD_REQUEST, e)
+                except InvalidRangeError as e:
+                    return await error_response(ProtoStatusCode.C416_INVALID_RANGE, e)
+                except (FileNotFoundError, NotFoundError) as e:
+                    return await error_response(ProtoStatusCode.C404_NOT_FOUND, e)
+                except Exception as e:
+                    return await error_response(ProtoStatusCode.C500_SERVER_ERROR, e)
+
+                include_body = request.method != ProtoMethod.HEAD
+                await write_response(response, include_body=include_body)
+                if response.headers.get(KnownHeader.CONNECTION) != "keep-alive":
+                    return
 
         except (ConnectionError, TimeoutError, CancelledError) as exc:
             self._logger.error("Connection error", exc_info=exc, extra=log_extra)
@@ -0,0 +1,216 @@
+import asyncio
+from asyncio import wait_for
+from asyncio.streams import StreamReader, StreamWriter
+from typing import AsyncIterator, List, Optional, Tuple, Union
+
+from simple_p2p.common.chunking import hash_chunk, unpack_chunks
+from simple_p2p.common.config import (
+    Config,
+    FILE_CHUNK_SIZE,
+    TCP_FILE_RECEIVE_TIMEOUT,
+)
+from simple_p2p.common.digests import check_digest, digest_header, digest_uri
+from simple_p2p.common.exceptions import LogicError, UnsupportedError
+from simple_p2p.file_transfer.encoding import (
+    DecodingReader,
+    accept_encoding,
+    decoding_reader,
+)
+from simple_p2p.file_transfer.enums import KnownHeader, ProtoMethod, ProtoStatusCode
+from simple_p2p.file_transfer.exceptions import (
+    DigestMismatchError,
+    InvalidRangeError,
+    ProtoError,
+)
+from simple_p2p.file_transfer.models import HeadersContainer, Request, Response
+
+class ContentStream:
+    """
+    Streams the content `digest` from the peer at `endpoint`, or the
+    `length` bytes of it from `offset`, without storing it anywhere.
+    The whole content is hashed while it passes and its last block
+    is only yielded once it matches the digest. A range is read in the
+    content-defined chunks listed by the peer, every chunk being verified
+    before any byte of it is yielded.
+    Raises `DigestMismatchError` if the content does not match,
+    `UnsupportedError` if it cannot be verified against `digest` here.
+    """
+
+    def __init__(
+        self,
+        endpoint: Tuple[str, int],
+        digest: str,
+        offset: int = 0,
+        length: Optional[int] = None,
+        block_size: int = FILE_CHUNK_SIZE,
+    ):
+        if offset < 0 or (length is not None and length < 0):
+            raise InvalidRangeError("Range specifiers cannot be negative")
+        self._endpoint = endpoint
+        self._digest = digest
+        self._algorithm = check_digest(digest)
+        self._offset = offset
+        self._length = length
+        self._block_size = block_size
+        self._size: Optional[int] = None
+        self._streams: Optional[Tuple[StreamReader, StreamWriter]] = None
+        self._content_reader: Optional[Union[StreamReader, DecodingReader]] = None
+        self._response_length = 0
+        # chunks of the file and the ones covering the range, for a range only
+        self._chunks: List[Tuple[int, bytes]] = []
+        self._first_chunk = 0
+        self._chunks_offset = 0
+
+    @property
+    def size(self) -> Optional[int]:
+        """
+        Size of the whole file, known once the stream is open
+        """
+        return self._size
+
+    @property
+    def is_whole(self) -> bool:
+        return not self._offset and (self._length is None or self._length == self._size)
+
+    @property
+    def uri(self) -> str:
+        return digest_uri(self._digest)
+
+    def _headers(self) -> HeadersContainer:
+        headers = HeadersContainer()
+        headers[KnownHeader.IF_DIGEST] = digest_header([self._digest])
+        if Config().transfer_compression:
+            headers[KnownHeader.ACCEPT_ENCODING] = accept_encoding()
+        return headers
+
+    async def open(self) -> int:
+        """
+        Sends the request, returns the size of the whole file
+        """
+        try:
+            return await self._open()
+        except Exception:
+            self.close()
+            raise
+
+    async def _open(self) -> int:
+        if not self._offset and self._length is None:
+            await self._request(None)
+            self._size = self._response_length
+            return self._size
+        # a range can only be verified by the chunks it covers
+        self._chunks = await self._list_chunks()
+        self._size = sum(length for (length, _) in self._chunks)
+        end = self._size if self._length is None else self._offset + self._length
+        if end > self._size:
+            raise InvalidRangeError(f"Range ends past the file size {self._size}")
+        if self.is_whole:
+            await self._request(None)
+            return self._size
+        # the chunks overlapping [offset, end)
+        chunk_offset = 0
+        last = 0
+        for (index, (length, _)) in enumerate(self._chunks):
+            if chunk_offset + length <= self._offset:
+                self._first_chunk = index + 1
+                self._chunks_offset = chunk_offset + length
+            if chunk_offset < end:
+                last = index
+            chunk_offset += length
+        self._chunks = self._chunks[self._first_chunk : last + 1] if end > self._offset else []
+        chunks_end = self._chunks_offset + sum(length for (length, _) in self._chunks)
+        if self._chunks:
+            await self._request((self._chunks_offset, chunks_end))
+            if self._response_length != chunks_end - self._chunks_offset:
+                raise ProtoError(ProtoStatusCode.C416_INVALID_RANGE)
+        return self._size
+
+    async def _list_chunks(self) -> List[Tuple[int, bytes]]:
+        (reader, writer) = await asyncio.open_connection(*self._endpoint)
+        try:
+            await Request(ProtoMethod.CHUNKS, self.uri, self._headers()).write_to(writer)
+            (response, content_reader) = await Response.read_from(reader)
+            if not ProtoStatusCode.is_success(response.status_code) or not content_reader:
+                raise UnsupportedError(
+                    f"Peer {self._endpoint[0]} does not list the chunks to verify a range"
+                )
+            return unpack_chunks(
+                await wait_for(
+                    content_reader.readexactly(response.headers.content_length),
+                    TCP_FILE_RECEIVE_TIMEOUT,
+                )
+            )
+        finally:
+            writer.close()
+
+    async def _request(self, byte_range: Optional[Tuple[int, int]]):
+        headers = self._headers()
+        if byte_range is not None:
+            headers[KnownHeader.RANGE] = f"bytes {byte_range[0]}-{byte_range[1]}"
+        self._streams = await asyncio.open_connection(*self._endpoint)
+        (reader, writer) = self._streams
+        await Request(ProtoMethod.GET, self.uri, headers).write_to(writer)
+        (response, content_reader) = await Response.read_from(reader)
+        response.assert_ok()
+        if not content_reader:
+            raise ProtoError(ProtoStatusCode.C404_NOT_FOUND)
+        self._content_reader = decoding_reader(
+            content_reader, response.headers.content_encoding
+        )
+        self._response_length = response.headers.content_length
+
+    def close(self):
+        if self._streams is not None:
+            self._streams[1].close()
+            self._streams = None
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        if self._size is None:
+            await self.open()
+        try:
+            if self.is_whole:
+                async for block in self._whole():
+                    yield block
+            else:
+                async for block in self._range():
+                    yield block
+        finally:
+            self.close()
+
+    async def _whole(self) -> AsyncIterator[bytes]:
+        hasher = self._algorithm.new()
+        to_read = self._size
+        held: Optional[bytes] = None
+        while to_read > 0:
+            block = await wait_for(
+                self._content_reader.read(min(self._block_size, to_read)),
+                TCP_FILE_RECEIVE_TIMEOUT,
+            )
+            if not block:
+                raise LogicError(f"Expected {self._size} bytes, got {self._size - to_read}")
+            to_read -= len(block)
+            hasher.update(block)
+            if held is not None:
+                yield held
+            held = block
+        if self._algorithm.format(hasher.hexdigest()) != self._digest:
+            raise DigestMismatchError(f"Content does not match the digest {self._digest}")
+        if held is not None:
+            yield held
+
+    async def _range(self) -> AsyncIterator[bytes]:
+        end = self._size if self._length is None else self._offset + self._length
+        chunk_offset = self._chunks_offset
+        for (index, (length, chunk_digest)) in enumerate(self._chunks):
+            chunk = await wait_for(
+                self._content_reader.readexactly(length), TCP_FILE_RECEIVE_TIMEOUT
+            )
+            if hash_chunk(self._algorithm, chunk) != chunk_digest:
+                raise DigestMismatchError(
+                    f"Chunk {self._first_chunk + index} does not match its digest"
+                )
+            start = max(self._offset - chunk_offset, 0)
+            stop = min(end - chunk_offset, length)
+            if start < stop:
+                yield chunk[start:stop]
+            chunk_offset += length
@@ -0,0 +1,153 @@
+import errno
+import os
+import shutil
+from typing import Dict, Iterable, Optional, Tuple
+
+from simple_p2p.common.digests import digest_filename, parse_digest_filename
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+# ioctl cloning a file on Linux filesystems with copy-on-write, e.g. btrfs or xfs
+FICLONE = 0x40049409
+
+
+def _stat_key(path: str) -> Tuple[int, int, int, int]:
+    stat = os.stat(path)
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _reflink(source_path: str, target_path: str):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported")
+    with open(source_path, "rb") as source, open(target_path, "wb") as target:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+
+
+def place_file(source_path: str, target_path: str) -> bool:
+    """
+    Puts a copy of the content of `source_path` at `target_path`, replacing it,
+    as a reflink if the filesystem supports it or a plain copy otherwise.
+    Never a hard link, later edits of either file must not change the other.
+    Returns False if neither succeeds.
+    """
+    for place in (_reflink, shutil.copyfile):
+        _remove(target_path)
+        try:
+            place(source_path, target_path)
+            return True
+        except OSError:
+            continue
+    _remove(target_path)
+    return False
+
+
+class BlobStore:
+    """
+    Content-addressed store of the repository files, so that a content
+    can be put under another name without downloading or hashing it again.
+    The blob of a digest is a reflink `<root>/<alg>-<hex>` of a file with that
+    content, unaffected by later edits of the file, or on filesystems without
+    reflinks the file itself. The files are never hard linked, as users may
+    edit them in place, so the blob is discarded once its size or
+    modification time differ from the ones seen when it was added.
+    Does not perform locking.
+    """
+
+    def __init__(self, root: str):
+        self._root = root
+        # path and stat of the blob of every digest
+        self._blobs: Dict[str, Tuple[str, Tuple[int, int, int, int]]] = {}
+        # digests of the files the blobs were made from, by their stat
+        self._digests: Dict[Tuple[int, int, int, int], str] = {}
+        self._sources: Dict[str, Tuple[int, int, int, int]] = {}
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self._root, digest_filename(digest))
+
+    def add(self, digest: str, path: str) -> bool:
+        """
+        Makes the file at `path` with content `digest` its blob,
+        unless there is one already.
+        Returns False if the file cannot be read.
+        """
+        if self.get(digest) is not None:
+            return True
+        blob_path = self.path(digest)
+        try:
+            source_key = _stat_key(path)
+            try:
+                _remove(blob_path)
+                _reflink(path, blob_path)
+            except OSError:
+                _remove(blob_path)
+                blob_path = path
+            stat_key = _stat_key(blob_path)
+        except OSError:
+            return False
+        self._blobs[digest] = (blob_path, stat_key)
+        self._sources[digest] = source_key
+        self._digests[source_key] = digest
+        return True
+
+    def get(self, digest: str) -> Optional[str]:
+        """
+        Path of the blob with content `digest`,
+        None if there is none or it changed since it was added
+        """
+        blob = self._blobs.get(digest)
+        if blob is None:
+            return None
+        (blob_path, stat_key) = blob
+        try:
+            if _stat_key(blob_path) == stat_key:
+                return blob_path
+        except OSError:
+            pass
+        self.discard(digest)
+        return None
+
+    def is_file(self, digest: str, path: str) -> bool:
+        """
+        Whether the blob of `digest` is the file at `path` itself
+        """
+        blob = self._blobs.get(digest)
+        return blob is not None and blob[0] == path
+
+    def find(self, path: str) -> Optional[str]:
+        """
+        Digest of the file at `path` if a blob was made from it and it is unchanged
+        """
+        try:
+            return self._digests.get(_stat_key(path))
+        except OSError:
+            return None
+
+    def discard(self, digest: str):
+        self._blobs.pop(digest, None)
+        source_key = self._sources.pop(digest, None)
+        if source_key is not None:
+            self._digests.pop(source_key, None)
+        _remove(self.path(digest))
+
+    def prune(self, digests: Iterable[str]):
+        """
+        Removes the blobs of content other than `digests`,
+        e.g. the ones left over by a previous run
+        """
+        keep = set(digests)
+        for name in os.listdir(self._root):
+            digest = parse_digest_filename(name)
+            if digest is None:
+                _remove(os.path.join(self._root, name))
+            elif digest not in keep or digest not in self._blobs:
+                self.discard(digest)
@@ -1,18 +1,38 @@
 from curses import meta
 from threading import Lock
 import os, yaml
-import hashlib
 import logging
 from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
 
-from simple_p2p.common.config import MAX_FILENAME_LENGTH, YAML_EXTENSION, METADATA_FOLDER_NAME
+from simple_p2p.common.config import (
+    BLOBS_FOLDER_NAME,
+    CHUNKS_FOLDER_NAME,
+    DIGEST_ALG,
+    HASH_BLOCK_SIZE,
+    MAX_FILENAME_LENGTH,
+    YAML_EXTENSION,
+    METADATA_FOLDER_NAME,
+)
 from simple_p2p.common.exceptions import (
     LogicError,
     FileDuplicateException,
     FileNameTooLongException,
-    NotFoundError
+    NotFoundError,
+    UnsupportedError,
+)
+from simple_p2p.common.chunking import chunk_file, pack_chunks, unpack_chunks
+from simple_p2p.common.digests import (
+    DigestAlgorithm,
+    check_digest,
+    digest_algorithm,
+    digest_filename,
+    get_algorithm,
+    hash_file,
+    parse_digest_filename,
 )
 from simple_p2p.common.models import FileMetadata, FileStatus
+from simple_p2p.repository.blob_store import BlobStore, place_file
 
 
 class LoadingRepositoryError(LogicError):
@@ -30,6 +50,12 @@ class RepositoryModificationError(LogicError):
 class Repository:
 
     _files: dict
+    _digests: Dict[str, Set[str]]
+    _blobs: BlobStore
+    # content-defined chunks of the files by digest,
+    # indexed by chunk digest as (file digest, offset)
+    _chunks: Dict[str, List[Tuple[int, bytes]]]
+    _chunk_index: Dict[bytes, Tuple[str, int]]
     _path: str
     _meta_path: str
     _lock: Lock
@@ -42,11 +68,17 @@ class Repository:
             self._path = config["path"]
             self.logger.info("Custom path set: %s", config["path"])
         self._lock = Lock()
+        self._files = dict()
+        self._digests = dict()
         self.__check_and_create()
+        self._blobs = BlobStore(self._blobs_path)
+        self._chunks = dict()
+        self._chunk_index = dict()
 
     def load(self):
         with self._lock:
             self._files = dict()
+            self._digests = dict()
             files = [
                 f
                 for f in os.listdir(self._meta_path)
@@ -83,9 +115,20 @@ class Repository:
                 self.__persist_filedata(metadata)
 
                 self._files[metadata.name] = metadata
+                self.__index_digest(metadata)
+                if metadata.status == FileStatus.READY:
+                    self._blobs.add(metadata.digest, metadata.path)
+            # the files changed while we were not running are not linked again
+            self._blobs.prune(self._digests.keys())
+            self.__load_chunks()
             self.logger.info("Repository loaded successfully.")
 
-    def add_file(self, path: str) -> FileMetadata:
+    def add_file(self, path: str, digest_alg: str = DIGEST_ALG) -> FileMetadata:
+        """
+        Adds the local file at `path`, its content identified
+        by a digest of algorithm `digest_alg`
+        """
+        algorithm = get_algorithm(digest_alg)
         with self._lock:
             if not os.path.isfile(path):
                 raise RepositoryModificationError("Is not a file")
@@ -102,18 +145,25 @@ class Repository:
 
             filesize = os.path.getsize(path)
 
-            data = self.__update_metadata(
-                FileMetadata(
-                    dict(
-                        size=filesize,
-                        name=filename,
-                        path=path,
-                        status=FileStatus.READY,
-                    )
+            data = FileMetadata(
+                dict(
+                    size=filesize,
+                    name=filename,
+                    path=path,
+                    status=FileStatus.READY,
                 )
             )
+            # a file a blob was made from does not have to be hashed again
+            known_digest = self._blobs.find(path)
+            if known_digest and digest_algorithm(known_digest) is algorithm:
+                data.current_digest = known_digest
+                data.current_size = filesize
+            else:
+                data = self.__update_metadata(data, algorithm)
             data.digest = data.current_digest
             self._files[filename] = data
+            self.__index_digest(data)
+            self._blobs.add(data.digest, path)
             self.__persist_filedata(data)
             return data
 
@@ -121,7 +171,20 @@ class Repository:
         with self._lock:
             if filename not in self._files.keys():
                 raise RepositoryModificationError("No such file in repository")
-            del self._files[filename]
+            data = self._files.pop(filename)
+            self.__unindex_digest(data)
+            if data.digest and data.digest not in self._digests:
+                # the last file with the content
+                self._blobs.discard(data.digest)
+                self.__unindex_chunks(data.digest)
+            elif data.digest and self._blobs.is_file(data.digest, data.path):
+                # the blob was the removed file, another one with the content takes over
+                self._blobs.discard(data.digest)
+                for name in self._digests[data.digest]:
+                    other = self._files[name]
+                    if other.status == FileStatus.READY and other.is_valid:
+                        self._blobs.add(other.digest, other.path)
+                        break
             yaml_path = os.path.join(self._meta_path, filename + YAML_EXTENSION)
             if os.path.exists(yaml_path):
                 os.remove(yaml_path)
@@ -134,6 +197,13 @@ class Repository:
     def get_files(self):
         return self._files
 
+    def find_by_digest(self, digest: str) -> List[FileMetadata]:
+        """
+        Files with content `digest`, whatever their names
+        """
+        with self._lock:
+            return [self._files[name] for name in self._digests.get(digest, ())]
+
     def find(self, filename: str) -> FileMetadata:
         if filename not in self._files.keys():
             raise NotFoundError("File not found")
@@ -146,6 +216,8 @@ class Repository:
             file_data: FileMetadata = self._files[filename]
             if new_status:
                 file_data.status = FileStatus[new_status]
+            if file_data.status == FileStatus.READY and file_data.is_valid:
+                self._blobs.add(file_data.digest, file_data.path)
             self._files[filename] = file_data
             self.__persist_filedata(self._files[filename])
         self.logger.info("File %s changed state to %s", filename, new_status)
@@ -155,8 +227,14 @@ class Repository:
         return self.__update_metadata(meta)
 
     def init_meta(self, name, digest, size):
+        """
+        Adds file `name` to be downloaded.
+        Raises `UnsupportedError` if its content cannot be verified against `digest`.
+        """
         if name in self._files:
             raise FileDuplicateException("File already exists")
+        if digest:
+            check_digest(digest)
         meta = FileMetadata(
             dict(
                 name=name,
@@ -170,8 +248,140 @@ class Repository:
             self.__update_metadata(meta)
             self.__persist_filedata(meta)
             self._files[name] = meta
+            self.__index_digest(meta)
         return meta
 
+    def store_content(self, name: str, digest: str, content: bytes) -> FileMetadata:
+        """
+        Adds file `name` downloaded at once as `content`, already checked
+        against `digest`, so it is neither hashed again nor
+        persisted while it is downloading.
+        """
+        if name in self._files:
+            raise FileDuplicateException("File already exists")
+        path = os.path.join(self._path, name)
+        meta = FileMetadata(
+            dict(
+                name=name,
+                digest=digest,
+                size=len(content),
+                path=path,
+                status=FileStatus.READY,
+                current_digest=digest,
+                current_size=len(content),
+            )
+        )
+        with self._lock:
+            if name in self._files:
+                raise FileDuplicateException("File already exists")
+            with open(path, "wb") as f:
+                f.write(content)
+            self._files[name] = meta
+            self.__index_digest(meta)
+            self._blobs.add(digest, path)
+            self.__persist_filedata(meta)
+        return meta
+
+    def complete_verified(self, filename: str) -> FileMetadata:
+        """
+        Marks the downloading file `filename` as READY, its content having been
+        checked against the digest while it was written, so it is not hashed again
+        """
+        with self._lock:
+            meta = self.find(filename)
+            if meta.status != FileStatus.DOWNLOADING or not meta.digest:
+                raise LogicError("File is not downloading")
+            meta.current_digest = meta.digest
+            meta.current_size = os.path.getsize(meta.path)
+            meta.status = FileStatus.READY
+            if meta.is_valid:
+                self._blobs.add(meta.digest, meta.path)
+            self.__persist_filedata(meta)
+        self.logger.info("File %s changed state to READY", filename)
+        return meta
+
+    def link_local(self, filename: str) -> bool:
+        """
+        Completes the download of `filename` from a local file with the same content,
+        as a reflink or a copy of its blob, never a hard link.
+        Returns False if there is no such file.
+        """
+        with self._lock:
+            meta = self.find(filename)
+            if meta.status != FileStatus.DOWNLOADING or not meta.digest:
+                return False
+            blob_path = self._blobs.get(meta.digest)
+        # a copy might take a while, the repository stays available meanwhile
+        if blob_path is None or not place_file(blob_path, meta.path):
+            return False
+        with self._lock:
+            if self._files.get(filename) is not meta:
+                # removed in the meantime
+                return False
+            meta.current_digest = meta.digest
+            meta.current_size = os.path.getsize(meta.path)
+            if not meta.size:
+                meta.size = meta.current_size
+            meta.status = FileStatus.READY
+            self._blobs.add(meta.digest, meta.path)
+            self.__persist_filedata(meta)
+        self.logger.info("File %s linked from a local copy", filename)
+        return True
+
+    def chunks(
+        self, filename: str, compute: bool = True
+    ) -> Optional[List[Tuple[int, bytes]]]:
+        """
+        Content-defined chunks of file `filename` as (length, chunk digest),
+        computed on first use and added to the chunk index.
+        Without `compute` only a list computed before is returned, None otherwise.
+        Raises `HashingError` if the file no longer matches its digest.
+        """
+        with self._lock:
+            meta = self.find(filename)
+            if meta.status != FileStatus.READY or not meta.digest:
+                raise LogicError("File is not ready")
+            chunks = self._chunks.get(meta.digest)
+        if chunks is not None or not compute:
+            return chunks
+        # chunked and hashed in a single read, the file might have changed
+        (chunks, digest) = chunk_file(meta.path, digest_algorithm(meta.digest))
+        if digest != meta.digest:
+            raise HashingError("File changed since it was hashed")
+        with self._lock:
+            if meta.digest in self._digests and meta.digest not in self._chunks:
+                self.__index_chunks(meta.digest, chunks)
+                path = os.path.join(self._chunks_path, digest_filename(meta.digest))
+                with open(path, "wb") as f:
+                    f.write(pack_chunks(chunks))
+        self.logger.debug("File %s split into %d chunks", filename, len(chunks))
+        return chunks
+
+    def find_chunk(self, chunk_digest: bytes) -> Optional[Tuple[str, int]]:
+        """
+        Path and offset of a local file containing the chunk `chunk_digest`
+        """
+        with self._lock:
+            entry = self._chunk_index.get(chunk_digest)
+            if entry is None:
+                return None
+            (digest, offset) = entry
+            path = self._blobs.get(digest)
+            if path is None:
+                path = next(
+                    (
+                        self._files[name].path
+                        for name in self._digests.get(digest, ())
+                        if self._files[name].can_share
+                    ),
+                    None,
+                )
+        return None if path is None else (path, offset)
+
+    @property
+    def has_chunks(self) -> bool:
+        return bool(self._chunk_index)
+
     def __check_and_create(self, mode=0o777) -> None:
         if not os.path.isdir(self._path):
             try:
@@ -190,6 +400,73 @@ class Repository:
                     self._meta_path,
                 )
                 raise RepositoryModificationError("Could not create metadata folder")
+        if not os.path.isdir(self._blobs_path):
+            try:
+                os.mkdir(self._blobs_path)
+            except Exception as e:
+                self.logger.error(
+                    "Could not create application blobs folder in %s",
+                    self._blobs_path,
+                )
+                raise RepositoryModificationError("Could not create blobs folder")
+        if not os.path.isdir(self._chunks_path):
+            try:
+                os.mkdir(self._chunks_path)
+            except Exception as e:
+                self.logger.error(
+                    "Could not create application chunks folder in %s",
+                    self._chunks_path,
+                )
+                raise RepositoryModificationError("Could not create chunks folder")
+
+    def __index_digest(self, data: FileMetadata) -> None:
+        if data.digest:
+            self._digests.setdefault(data.digest, set()).add(data.name)
+
+    def __unindex_digest(self, data: FileMetadata) -> None:
+        names = self._digests.get(data.digest)
+        if names is None:
+            return
+        names.discard(data.name)
+        if not names:
+            del self._digests[data.digest]
+
+    def __index_chunks(self, digest: str, chunks: List[Tuple[int, bytes]]) -> None:
+        self._chunks[digest] = chunks
+        offset = 0
+        for (length, chunk_digest) in chunks:
+            self._chunk_index.setdefault(chunk_digest, (digest, offset))
+            offset += length
+
+    def __unindex_chunks(self, digest: str) -> None:
+        if self._chunks.pop(digest, None) is None:
+            return
+        # chunks shared with the other files are indexed again
+        self._chunk_index = dict()
+        for (other_digest, chunks) in list(self._chunks.items()):
+            self.__index_chunks(other_digest, chunks)
+        path = os.path.join(self._chunks_path, digest_filename(digest))
+        if os.path.exists(path):
+            os.remove(path)
+
+    def __load_chunks(self) -> None:
+        """
+        Indexes the chunks computed in the previous runs
+        for the files that are still valid
+        """
+        self._chunks = dict()
+        self._chunk_index = dict()
+        valid_digests = set(
+            meta.digest for meta in self._files.values() if meta.status == FileStatus.READY
+        )
+        for filename in os.listdir(self._chunks_path):
+            path = os.path.join(self._chunks_path, filename)
+            digest = parse_digest_filename(filename)
+            if digest not in valid_digests:
+                os.remove(path)
+                continue
+            with open(path, "rb") as f:
+                self.__index_chunks(digest, unpack_chunks(f.read()))
 
     def __persist_filedata(self, data: FileMetadata) -> None:
         filename: str = data.name + YAML_EXTENSION
@@ -198,32 +475,49 @@ class Repository:
             yaml.dump(data.as_dict(), f)
         self.logger.debug("Metadata %s persisted successfully", data.name)
 
-    def __update_metadata(self, data: FileMetadata) -> FileMetadata:
+    def __update_metadata(
+        self, data: FileMetadata, algorithm: Optional[DigestAlgorithm] = None
+    ) -> FileMetadata:
+        """
+        Hashes the file with `algorithm`, by default the one of its digest
+        """
+        if algorithm is None:
+            algorithm = get_algorithm(DIGEST_ALG)
+            if data.digest:
+                algorithm = digest_algorithm(data.digest)
         try:
             new_size = os.path.getsize(data.path)
-            new_hash = self.__calculate_hash(data.path)
+            new_hash = self.__calculate_hash(data.path, algorithm)
         except OSError:
             new_size = 0
             new_hash = None
+        except UnsupportedError as exc:
+            # e.g. its algorithm is no longer installed, it cannot be verified
+            self.logger.warning("File %s cannot be hashed: %s", data.name, exc)
+            new_hash = None
         data.current_digest = new_hash
         data.current_size = new_size
         if not data.size:
             data.size = data.current_size
         return data
 
-    def __calculate_hash(self, path: str) -> str:
-        sha256_hash = hashlib.sha256()
+    def __calculate_hash(self, path: str, algorithm: DigestAlgorithm) -> str:
         if not os.path.isfile(path):
             raise HashingError("Is not a file")
-        with open(path, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-            return sha256_hash.hexdigest()
+        return hash_file(path, algorithm, HASH_BLOCK_SIZE)
 
     @property
     def _meta_path(self):
         return os.path.join(self._path, METADATA_FOLDER_NAME)
     
+    @property
+    def _blobs_path(self):
+        return os.path.join(self._path, BLOBS_FOLDER_NAME)
+
+    @property
+    def _chunks_path(self):
+        return os.path.join(self._path, CHUNKS_FOLDER_NAME)
+
     @property
     def path(self):
         return self._path
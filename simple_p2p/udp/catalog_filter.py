@@ -0,0 +1,148 @@
+import hashlib
+import struct
+import threading
+from collections import Counter
+from typing import Iterator, List, Optional
+
+from simple_p2p.common.config import (
+    CATALOG_FILTER_BITS_PER_ITEM,
+    CATALOG_FILTER_HASHES,
+    CATALOG_FILTER_MAX_BYTES,
+    ENCODING,
+)
+
+NAME_KEY_PREFIX = "n:"
+DIGEST_KEY_PREFIX = "d:"
+
+
+def _bit_indexes(key: str, num_bits: int, num_hashes: int) -> Iterator[int]:
+    """
+    Positions of the `key` in a filter of `num_bits` bits (double hashing)
+    """
+    key_hash = hashlib.blake2b(key.encode(ENCODING), digest_size=16).digest()
+    h1, h2 = struct.unpack("!QQ", key_hash)
+    for i in range(num_hashes):
+        yield (h1 + i * h2) % num_bits
+
+
+def _catalog_keys(name: Optional[str], digest: Optional[str]) -> List[str]:
+    keys = []
+    if name:
+        keys.append(NAME_KEY_PREFIX + name)
+    if digest:
+        keys.append(DIGEST_KEY_PREFIX + digest.lower())
+    return keys
+
+
+class BloomFilter:
+    """
+    Immutable Bloom filter of the names and digests shared by a peer,
+    as advertised in HERE messages
+    """
+
+    FORMAT = "!B"
+
+    def __init__(self, bits: bytes, num_hashes: int = CATALOG_FILTER_HASHES):
+        self._bits = bytes(bits)
+        self._num_hashes = num_hashes
+
+    @property
+    def num_bits(self) -> int:
+        return len(self._bits) * 8
+
+    def _has_key(self, key: str) -> bool:
+        num_bits = self.num_bits
+        for index in _bit_indexes(key, num_bits, self._num_hashes):
+            if not self._bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+    def might_contain(self, name: Optional[str], digest: Optional[str] = None) -> bool:
+        """
+        Returns False only if the peer definitely does not have the file
+        """
+        if not self._bits:
+            return False
+        return all(self._has_key(key) for key in _catalog_keys(name, digest))
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, BloomFilter):
+            return NotImplemented
+        return self._num_hashes == other._num_hashes and self._bits == other._bits
+
+    __hash__ = None
+
+    def to_bytes(self) -> bytes:
+        return struct.pack(self.FORMAT, self._num_hashes) + self._bits
+
+    @classmethod
+    def from_bytes(cls, filter_bytes: bytes) -> "BloomFilter":
+        (num_hashes,) = struct.unpack_from(cls.FORMAT, filter_bytes)
+        return cls(filter_bytes[struct.calcsize(cls.FORMAT):], num_hashes)
+
+
+class CatalogFilter:
+    """
+    Counting Bloom filter of the local catalog, updated incrementally
+    as files are added and removed.
+    The filter grows with the catalog, up to CATALOG_FILTER_MAX_BYTES.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys: Counter = Counter()
+        self._counters: List[int] = []
+        self._snapshot: Optional[BloomFilter] = None
+        self._resize(1)
+
+    def _resize(self, capacity: int):
+        """
+        Rebuilds the counters for `capacity` keys.
+        Does not perform locking.
+        """
+        num_bytes = -(-capacity * CATALOG_FILTER_BITS_PER_ITEM // 8)
+        num_bytes = min(max(num_bytes, 8), CATALOG_FILTER_MAX_BYTES)
+        self._counters = [0] * (num_bytes * 8)
+        for (key, count) in self._keys.items():
+            self._update_key(key, count)
+
+    def _update_key(self, key: str, delta: int):
+        """
+        Does not perform locking.
+        """
+        for index in _bit_indexes(key, len(self._counters), CATALOG_FILTER_HASHES):
+            self._counters[index] += delta
+        self._snapshot = None
+
+    def add(self, name: Optional[str], digest: Optional[str] = None):
+        with self._lock:
+            for key in _catalog_keys(name, digest):
+                self._keys[key] += 1
+                self._update_key(key, 1)
+            capacity = len(self._counters) // CATALOG_FILTER_BITS_PER_ITEM
+            if len(self._keys) > capacity and len(self._counters) < CATALOG_FILTER_MAX_BYTES * 8:
+                self._resize(2 * len(self._keys))
+
+    def remove(self, name: Optional[str], digest: Optional[str] = None):
+        with self._lock:
+            for key in _catalog_keys(name, digest):
+                if self._keys[key] <= 0:
+                    continue
+                self._keys[key] -= 1
+                if self._keys[key] == 0:
+                    del self._keys[key]
+                self._update_key(key, -1)
+
+    @property
+    def snapshot(self) -> BloomFilter:
+        """
+        The Bloom filter to be advertised, rebuilt only after changes
+        """
+        with self._lock:
+            if self._snapshot is None:
+                bits = bytearray(len(self._counters) // 8)
+                for (index, counter) in enumerate(self._counters):
+                    if counter:
+                        bits[index >> 3] |= 1 << (index & 7)
+                self._snapshot = BloomFilter(bits)
+            return self._snapshot
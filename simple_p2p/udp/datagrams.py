@@ -1,22 +1,45 @@
 # STRUCTS
+import struct
+import threading
 from abc import abstractmethod
-from typing import Optional
+from typing import Dict, Optional, Union
 
 from simple_p2p.common.config import *
 from simple_p2p.udp.structs import (
     MessageType,
     HereStruct,
     HelloStruct,
+    LoadStruct,
+    PeerListStruct,
     HeaderStruct,
     FileDataStruct,
+    FileBatchStruct,
+    CatalogSyncStruct,
+    CatalogDeltaStruct,
+    FetchStruct,
+    FetchedStruct,
     InvalidHeaderException,
+    MESSAGE_STRUCTS,
     Struct,
 )
 
 
+# per-thread buffer the outgoing datagrams are packed into
+_send_buffers = threading.local()
+
+
+def _send_buffer() -> bytearray:
+    buffer = getattr(_send_buffers, "buffer", None)
+    if buffer is None:
+        buffer = _send_buffers.buffer = bytearray(UDP_BUFFER_SIZE)
+    return buffer
+
+
 class Datagram:
-    def __init__(self, message_type: MessageType):
-        self._header: HeaderStruct = HeaderStruct(message_type)
+    __slots__ = ("_header", "_message")
+
+    def __init__(self, message_type: MessageType, proto_version: int = MIN_PROTO_VERSION):
+        self._header: HeaderStruct = HeaderStruct(message_type, proto_version)
         self._message = None
 
     @property
@@ -34,22 +57,7 @@ class Datagram:
 
     @staticmethod
     def msg_type_to_datagram(message_type):
-        if message_type == MessageType.HELLO:
-            return HelloDatagram
-        if message_type == MessageType.HERE:
-            return HereDatagram
-        if message_type == MessageType.FIND:
-            return FindDatagram
-        if message_type == MessageType.FOUND:
-            return FoundDatagram
-        if message_type == MessageType.NOTFOUND:
-            return NotFoundDatagram
-
-    @staticmethod
-    def _msg_type_from_datagram_bytes(datagram_bytes):
-        header: HeaderStruct = HeaderStruct.from_bytes(datagram_bytes)
-        message_type = header.message_type
-        return message_type
+        return DATAGRAM_TYPES.get(message_type)
 
     @classmethod
     def from_bytes(cls, datagram_bytes: bytes):
@@ -61,31 +69,62 @@ class Datagram:
         """
 
         try:
-            message_type = cls._msg_type_from_datagram_bytes(datagram_bytes)
-            if cls.msg_type_to_datagram(message_type) != cls:
+            header: HeaderStruct = HeaderStruct.from_bytes(datagram_bytes)
+            if cls.msg_type_to_datagram(header.message_type) != cls:
                 raise InvalidHeaderException(
-                    f"Message id {message_type} does not match cls {cls}"
+                    f"Message id {header.message_type} does not match cls {cls}"
                 )
-        except InvalidHeaderException:
+            return cls.from_header(header, datagram_bytes)
+        except (InvalidHeaderException, struct.error):
             return None
+
+    @staticmethod
+    def from_header(header: HeaderStruct, datagram_bytes) -> "Datagram":
+        """
+        Rebuilds the datagram of the type given by the already parsed `header`,
+        `datagram_bytes` might be a memoryview.
+        Raises `InvalidHeaderException` or `struct.error` if the message is malformed.
+        """
+        message_type = header.message_type
         # shift datagram_bytes by header size to message_bytes
         message_bytes = HeaderStruct.shift_bytes_by_struct_size(datagram_bytes)
 
-        # rebuild Datagram from message_bytes
-        message_struct_cls = Struct.msg_type_to_struct(message_type)
-        message_struct = message_struct_cls.from_bytes(message_bytes)
-        return cls(message_struct)
+        # rebuild Datagram from message_bytes, the layout depends on the version
+        message_struct_cls = MESSAGE_STRUCTS[(message_type, header.proto_version)]
+        datagram_cls = DATAGRAM_TYPES[message_type]
+        datagram = datagram_cls.__new__(datagram_cls)
+        datagram._header = header
+        datagram._message = message_struct_cls.from_bytes(message_bytes)
+        return datagram
+
+    def pack_into(self, buffer: bytearray, offset: int = 0) -> int:
+        """
+        Writes the datagram into `buffer` at `offset`, returns the offset past it.
+        Raises `struct.error` if the buffer is too small.
+        """
+        offset = self._header.pack_into(buffer, offset)
+        return self.message.pack_into(buffer, offset)
 
     def to_bytes(self) -> bytes:
-        header_bytes = self.header.to_bytes()
-        message_bytes = self.message.to_bytes()
-        return header_bytes + message_bytes
+        message = self._message
+        if message.FIXED_LAYOUT:
+            # small enough for a plain concatenation
+            return self._header.to_bytes() + message.to_bytes()
+        buffer = _send_buffer()
+        try:
+            size = self.pack_into(buffer)
+        except struct.error:
+            # larger than a UDP buffer
+            return self._header.to_bytes() + self.message.to_bytes()
+        return bytes(memoryview(buffer)[:size])
 
 
 class HelloDatagram(Datagram):
-    def __init__(self, hello_struct: HelloStruct = HelloStruct()):
+    __slots__ = ()
+
+    def __init__(self, hello_struct: Optional[HelloStruct] = None):
         super().__init__(MessageType.HELLO)
-        self._message: HelloStruct = hello_struct
+        self._message: HelloStruct = hello_struct or HelloStruct(Config().udp_port)
 
     @property
     def message(self) -> HelloStruct:
@@ -93,40 +132,142 @@ class HelloDatagram(Datagram):
 
 
 class HereDatagram(Datagram):
+    __slots__ = ()
+
     def __init__(self, here_struct: Optional[HereStruct] = None):
         super().__init__(MessageType.HERE)
         self._message = here_struct or HereStruct(Config().udp_port, Config().tcp_port)
 
+    @classmethod
+    def with_catalog(
+        cls,
+        catalog_filter: bytes,
+        catalog_incarnation: int,
+        catalog_version: int,
+        load: Optional[LoadStruct] = None,
+    ) -> "HereDatagram":
+        options = {
+            HereStruct.CATALOG_FILTER_OPTION: catalog_filter,
+            HereStruct.CATALOG_VERSION_OPTION: HereStruct.encode_catalog_version(
+                catalog_incarnation, catalog_version
+            ),
+        }
+        if load is not None:
+            options[HereStruct.LOAD_OPTION] = load.to_bytes()
+        return cls(
+            HereStruct(Config().udp_port, Config().tcp_port, PROTO_VERSION, options)
+        )
+
     @property
     def message(self) -> HereStruct:
         return self._message
 
 
+class PeerListDatagram(Datagram):
+    __slots__ = ()
+
+    def __init__(self, peers_struct: PeerListStruct):
+        super().__init__(MessageType.PEERS, peers_struct.PROTO_VERSION)
+        self._message: PeerListStruct = peers_struct
+
+    @property
+    def message(self) -> PeerListStruct:
+        return self._message
+
+
 class FindDatagram(Datagram):
-    def __init__(self, find_struct: FileDataStruct):
-        super().__init__(MessageType.FIND)
-        self._message: FileDataStruct = find_struct
+    __slots__ = ()
+
+    def __init__(self, find_struct: Union[FileDataStruct, FileBatchStruct]):
+        super().__init__(MessageType.FIND, find_struct.PROTO_VERSION)
+        self._message: Union[FileDataStruct, FileBatchStruct] = find_struct
 
     @property
-    def message(self) -> FileDataStruct:
+    def message(self) -> Union[FileDataStruct, FileBatchStruct]:
         return self._message
 
 
 class FoundDatagram(Datagram):
-    def __init__(self, found_struct: FileDataStruct):
-        super().__init__(MessageType.FOUND)
-        self._message: FileDataStruct = found_struct
+    __slots__ = ()
+
+    def __init__(self, found_struct: Union[FileDataStruct, FileBatchStruct]):
+        super().__init__(MessageType.FOUND, found_struct.PROTO_VERSION)
+        self._message: Union[FileDataStruct, FileBatchStruct] = found_struct
 
     @property
-    def message(self) -> FileDataStruct:
+    def message(self) -> Union[FileDataStruct, FileBatchStruct]:
         return self._message
 
 
 class NotFoundDatagram(Datagram):
-    def __init__(self, notfound_struct: FileDataStruct):
-        super().__init__(MessageType.NOTFOUND)
-        self._message: FileDataStruct = notfound_struct
+    __slots__ = ()
+
+    def __init__(self, notfound_struct: Union[FileDataStruct, FileBatchStruct]):
+        super().__init__(MessageType.NOTFOUND, notfound_struct.PROTO_VERSION)
+        self._message: Union[FileDataStruct, FileBatchStruct] = notfound_struct
+
+    @property
+    def message(self) -> Union[FileDataStruct, FileBatchStruct]:
+        return self._message
+
+
+class CatalogSyncDatagram(Datagram):
+    __slots__ = ()
+
+    def __init__(self, sync_struct: CatalogSyncStruct):
+        super().__init__(MessageType.CATALOG_SYNC, sync_struct.PROTO_VERSION)
+        self._message: CatalogSyncStruct = sync_struct
+
+    @property
+    def message(self) -> CatalogSyncStruct:
+        return self._message
+
+
+class CatalogDeltaDatagram(Datagram):
+    __slots__ = ()
+
+    def __init__(self, delta_struct: CatalogDeltaStruct):
+        super().__init__(MessageType.CATALOG_DELTA, delta_struct.PROTO_VERSION)
+        self._message: CatalogDeltaStruct = delta_struct
 
     @property
-    def message(self) -> FileDataStruct:
+    def message(self) -> CatalogDeltaStruct:
         return self._message
+
+
+class FetchDatagram(Datagram):
+    __slots__ = ()
+
+    def __init__(self, fetch_struct: FetchStruct):
+        super().__init__(MessageType.FETCH, fetch_struct.PROTO_VERSION)
+        self._message: FetchStruct = fetch_struct
+
+    @property
+    def message(self) -> FetchStruct:
+        return self._message
+
+
+class FetchedDatagram(Datagram):
+    __slots__ = ()
+
+    def __init__(self, fetched_struct: FetchedStruct):
+        super().__init__(MessageType.FETCHED, fetched_struct.PROTO_VERSION)
+        self._message: FetchedStruct = fetched_struct
+
+    @property
+    def message(self) -> FetchedStruct:
+        return self._message
+
+
+DATAGRAM_TYPES: Dict[MessageType, type] = {
+    MessageType.HELLO: HelloDatagram,
+    MessageType.HERE: HereDatagram,
+    MessageType.PEERS: PeerListDatagram,
+    MessageType.FIND: FindDatagram,
+    MessageType.FOUND: FoundDatagram,
+    MessageType.NOTFOUND: NotFoundDatagram,
+    MessageType.CATALOG_SYNC: CatalogSyncDatagram,
+    MessageType.CATALOG_DELTA: CatalogDeltaDatagram,
+    MessageType.FETCH: FetchDatagram,
+    MessageType.FETCHED: FetchedDatagram,
+}
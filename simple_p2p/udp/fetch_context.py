@@ -0,0 +1,68 @@
+import time
+from concurrent.futures import Future
+from typing import Dict, Optional
+
+from simple_p2p.common.digests import split_digest
+from simple_p2p.udp.structs import FetchedStruct
+
+
+class FetchContext:
+    """
+    State of a single in-flight FETCH of a small file from a peer,
+    reassembling the fragments of the content in any order.
+    The caller awaits `result`: the content matching the digest,
+    or None if the peer does not send the file.
+    Does not perform locking.
+    """
+
+    def __init__(self, peer_ip: str, file_digest: str, file_size: int):
+        self._peer_ip = peer_ip
+        self._file_digest = file_digest
+        self._file_size = file_size
+        self._fragments: Dict[int, bytes] = {}
+        self._count: Optional[int] = None
+        self._result: Future = Future()
+        self._sent_at: float = None
+        self._attempts = 0
+
+    @property
+    def peer_ip(self) -> str:
+        return self._peer_ip
+
+    @property
+    def result(self) -> Future:
+        return self._result
+
+    def sent(self):
+        self._sent_at = time.monotonic()
+        self._attempts += 1
+
+    def add_fragment(self, fetched: FetchedStruct) -> Optional[float]:
+        """
+        Adds a received fragment, sets the result once the content is complete.
+        Returns the round-trip time of the request on the first fragment,
+        unless it was sent again since the answer might be to an earlier attempt.
+        """
+        if self._result.done():
+            return None
+        if not fetched.count or fetched.size != self._file_size:
+            # refused, or another version of the file
+            self._result.set_result(None)
+            return None
+        if self._count is None:
+            self._count = fetched.count
+        if fetched.count != self._count or fetched.index >= self._count:
+            return None
+        rtt = None
+        if not self._fragments and self._attempts == 1:
+            rtt = time.monotonic() - self._sent_at
+        self._fragments.setdefault(fetched.index, fetched.fragment)
+        if len(self._fragments) == self._count:
+            content = b"".join(self._fragments[index] for index in range(self._count))
+            (algorithm, hex_digest) = split_digest(self._file_digest)
+            valid = (
+                len(content) == self._file_size
+                and algorithm.digest(content).hex() == hex_digest
+            )
+            self._result.set_result(content if valid else None)
+        return rtt
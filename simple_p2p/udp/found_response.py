@@ -1,11 +1,22 @@
-from simple_p2p.udp.structs import FileDataStruct
+from typing import Optional
+
+from simple_p2p.udp.structs import FileDataStruct, LoadStruct
 
 
 class FoundResponse:  # todo maybe move this somewhere else
-    def __init__(self, found_struct: FileDataStruct, provider_ip, is_found: bool):
+    def __init__(
+        self,
+        found_struct: FileDataStruct,
+        provider_ip,
+        is_found: bool,
+        load: Optional[LoadStruct] = None,
+        available: Optional[int] = None,
+    ):
         self._found_struct = found_struct
         self._provider_ip = provider_ip
         self._is_found = is_found
+        self._load = load
+        self._available = available
 
     @property
     def is_found(self) -> bool:
@@ -30,3 +41,22 @@ class FoundResponse:  # todo maybe move this somewhere else
     @property
     def file_size(self) -> int:
         return self.found_struct.file_size
+
+    @property
+    def load(self) -> Optional[LoadStruct]:
+        """
+        Load hints of the provider sent with the answer, if any
+        """
+        return self._load
+
+    @property
+    def available(self) -> Optional[int]:
+        """
+        Verified bytes of a provider still downloading the file,
+        None if it has the whole file
+        """
+        return self._available
+
+    @property
+    def is_partial(self) -> bool:
+        return self._available is not None
@@ -4,6 +4,11 @@ from enum import IntEnum
 class MessageType(IntEnum):
     HELLO = 0x01
     HERE = 0x02
+    PEERS = 0x03
     FIND = 0x11
     FOUND = 0x12
     NOTFOUND = 0x13
+    FETCH = 0x14
+    FETCHED = 0x15
+    CATALOG_SYNC = 0x21
+    CATALOG_DELTA = 0x22
@@ -1,10 +1,42 @@
 
+import datetime
+import time
+from typing import Optional
+
+from simple_p2p.common.config import MIN_PROTO_VERSION
+from simple_p2p.udp.catalog_filter import BloomFilter
+from simple_p2p.udp.structs import LoadStruct
+
+
 class Peer:
-    def __init__(self, ip_address: str, tcp_port: int, unicast_port: int, last_updated):
+    __slots__ = (
+        "_ip_address",
+        "_tcp_port",
+        "_unicast_port",
+        "_last_seen",
+        "_proto_version",
+        "_catalog_filter",
+        "_load",
+    )
+
+    def __init__(
+        self,
+        ip_address: str,
+        tcp_port: int,
+        unicast_port: int,
+        last_seen: float,
+        proto_version: int = MIN_PROTO_VERSION,
+        catalog_filter: Optional[BloomFilter] = None,
+        load: Optional[LoadStruct] = None,
+    ):
         self._ip_address = ip_address
         self._tcp_port = tcp_port
         self._unicast_port = unicast_port
-        self._last_updated = last_updated
+        # time.monotonic() of the last datagram received from the peer
+        self._last_seen = last_seen
+        self._proto_version = proto_version
+        self._catalog_filter = catalog_filter
+        self._load = load
 
     @property
     def ip_address(self):
@@ -19,9 +51,44 @@ class Peer:
         return self._unicast_port
 
     @property
-    def last_updated(self):
-        return self._last_updated
+    def proto_version(self) -> int:
+        return self._proto_version
+
+    @property
+    def catalog_filter(self) -> Optional[BloomFilter]:
+        return self._catalog_filter
+
+    @property
+    def load(self) -> Optional[LoadStruct]:
+        """
+        Load hints of the last HERE message, updated in place
+        """
+        return self._load
+
+    @load.setter
+    def load(self, load: Optional[LoadStruct]):
+        self._load = load
 
-    @last_updated.setter
-    def last_updated(self, date):
-        self._last_updated = date
+    def may_have(self, name: Optional[str], digest: Optional[str] = None) -> bool:
+        """
+        Returns False only if the peer advertised that it does not have the file
+        """
+        if self._catalog_filter is None:
+            return True
+        return self._catalog_filter.might_contain(name, digest)
+
+    @property
+    def last_seen(self) -> float:
+        return self._last_seen
+
+    def touch(self):
+        self._last_seen = time.monotonic()
+
+    @property
+    def last_updated(self) -> datetime.datetime:
+        """
+        Wall clock time of `last_seen`, for display
+        """
+        return datetime.datetime.now() - datetime.timedelta(
+            seconds=time.monotonic() - self._last_seen
+        )
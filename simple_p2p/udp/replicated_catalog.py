@@ -0,0 +1,312 @@
+import fnmatch
+import random
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from simple_p2p.common.config import CATALOG_STALE_AFTER
+
+
+class CatalogEntry:
+    """
+    A single file shared by a peer, `version` being the catalog version
+    of its last change. Removed files are kept as `deleted` tombstones.
+    """
+
+    __slots__ = ("name", "digest", "size", "version", "deleted")
+
+    def __init__(
+        self, name: str, digest: str, size: int, version: int, deleted: bool = False
+    ):
+        self.name = name
+        self.digest = digest
+        self.size = size
+        self.version = version
+        self.deleted = deleted
+
+
+class ReplicatedCatalog:
+    """
+    Index of the files shared by this node and by every peer,
+    kept in sync with delta-based anti-entropy gossip.
+    Each catalog (origin) has a version incremented on every change,
+    only comparable within its incarnation, drawn at random on every start;
+    `version_vector` holds the incarnation and version replicated so far
+    for each origin. The tombstones are purged once every peer replicated them.
+    Performs locking.
+    """
+
+    def __init__(self, incarnation: Optional[int] = None):
+        self._lock = threading.Lock()
+        self._own: Dict[str, CatalogEntry] = {}
+        self._own_incarnation = (
+            random.getrandbits(32) if incarnation is None else incarnation
+        )
+        self._own_version = 0
+        self._origins: Dict[str, Dict[str, CatalogEntry]] = {}
+        self._incarnations: Dict[str, int] = {}
+        self._versions: Dict[str, int] = {}
+        self._advertised: Dict[str, Tuple[int, int]] = {}
+        self._synced_at: Dict[str, float] = {}
+        # (incarnation, version) of the catalogs replicated by each peer,
+        # the own catalog under None
+        self._peer_versions: Dict[str, Dict[Optional[str], Tuple[int, int]]] = {}
+        # highest version of the purged tombstones of each catalog
+        self._purged: Dict[Optional[str], int] = {}
+        # seconds after which a replica not advertised again is stale
+        self.stale_after: float = CATALOG_STALE_AFTER
+
+    @property
+    def own_incarnation(self) -> int:
+        return self._own_incarnation
+
+    @property
+    def own_version(self) -> int:
+        return self._own_version
+
+    # local catalog
+
+    def share(self, name: str, digest: str, size: int):
+        with self._lock:
+            entry = self._own.get(name)
+            if entry and not entry.deleted and entry.digest == digest and entry.size == size:
+                return
+            self._own_version += 1
+            self._own[name] = CatalogEntry(name, digest, size, self._own_version)
+
+    def unshare(self, name: str):
+        with self._lock:
+            entry = self._own.get(name)
+            if entry is None or entry.deleted:
+                return
+            self._own_version += 1
+            self._own[name] = CatalogEntry(
+                name, entry.digest, entry.size, self._own_version, deleted=True
+            )
+
+    # replication
+
+    def version_vector(self) -> Dict[str, Tuple[int, int]]:
+        with self._lock:
+            return {
+                origin: (self._incarnations[origin], version)
+                for (origin, version) in self._versions.items()
+            }
+
+    def replicated_version(self, origin: str) -> int:
+        with self._lock:
+            return self._versions.get(origin, 0)
+
+    def delta(
+        self, origin: Optional[str], incarnation: int, since: int
+    ) -> Optional[Tuple[int, int, int, List[CatalogEntry]]]:
+        """
+        Changes of the `origin` catalog (own catalog if None) missing in a
+        replica at version `since` of `incarnation`: the current incarnation,
+        the version they start from, the current version and the entries
+        ordered by version. They start from version 0, i.e. hold the whole
+        catalog, if the replica is of another incarnation or older than
+        purged tombstones. Returns None if the replica is up to date.
+        """
+        with self._lock:
+            if origin is None:
+                entries = self._own
+                (current_incarnation, version) = (self._own_incarnation, self._own_version)
+            else:
+                entries = self._origins.get(origin, {})
+                current_incarnation = self._incarnations.get(origin)
+                version = self._versions.get(origin, 0)
+            if current_incarnation is None or (origin is not None and version == 0):
+                return None
+            if incarnation != current_incarnation or since < self._purged.get(origin, 0):
+                since = 0
+            elif version <= since:
+                return None
+            changed = [entry for entry in entries.values() if entry.version > since]
+        changed.sort(key=lambda entry: entry.version)
+        return (current_incarnation, since, version, changed)
+
+    def apply(
+        self,
+        origin: str,
+        incarnation: int,
+        from_version: int,
+        to_version: int,
+        entries: List[CatalogEntry],
+        relayed: bool = False,
+    ) -> bool:
+        """
+        Applies the changes of `origin` between versions `from_version`
+        and `to_version` of `incarnation`, a delta from version 0 replacing
+        the replica. Returns False if the delta does not connect to
+        the replicated version, e.g. because a previous one was lost,
+        or if a `relayed` delta is of another incarnation or newer than
+        the origin advertised, i.e. it comes from before a restart of the origin.
+        """
+        with self._lock:
+            advertised = self._advertised.get(origin)
+            if relayed and advertised is not None and (
+                incarnation != advertised[0] or to_version > advertised[1]
+            ):
+                return False
+            if self._incarnations.get(origin) != incarnation:
+                # the origin restarted, the replica is of its previous catalog
+                self._reset(origin, incarnation)
+            current = self._versions.get(origin, 0)
+            if from_version > current:
+                return False
+            if to_version <= current:
+                return True
+            if from_version == 0:
+                self._reset(origin, incarnation)
+            catalog = self._origins.setdefault(origin, {})
+            for entry in entries:
+                known = catalog.get(entry.name)
+                if known is None or known.version < entry.version:
+                    catalog[entry.name] = entry
+            self._versions[origin] = to_version
+            self._synced_at[origin] = time.monotonic()
+            return True
+
+    def advertise(self, origin: str, incarnation: int, version: int) -> bool:
+        """
+        Records the catalog incarnation and version advertised by `origin`.
+        Returns True if the replica of that catalog is behind.
+        """
+        with self._lock:
+            self._advertised[origin] = (incarnation, version)
+            if (
+                self._incarnations.get(origin) != incarnation
+                or self._versions.get(origin, 0) > version
+            ):
+                # the origin restarted with a new catalog
+                self._reset(origin, incarnation)
+            if self._versions.get(origin, 0) < version:
+                return True
+            self._synced_at[origin] = time.monotonic()
+            return False
+
+    def _reset(self, origin: str, incarnation: int):
+        """
+        Empties the replica of `origin` for a catalog of `incarnation`.
+        Does not perform locking.
+        """
+        self._origins.pop(origin, None)
+        self._versions.pop(origin, None)
+        self._purged.pop(origin, None)
+        self._incarnations[origin] = incarnation
+
+    def drop(self, origin: str):
+        with self._lock:
+            self._origins.pop(origin, None)
+            self._incarnations.pop(origin, None)
+            self._versions.pop(origin, None)
+            self._purged.pop(origin, None)
+            self._advertised.pop(origin, None)
+            self._synced_at.pop(origin, None)
+            self._peer_versions.pop(origin, None)
+
+    def record_sync(
+        self,
+        peer: str,
+        your_incarnation: int,
+        your_version: int,
+        versions: Dict[str, Tuple[int, int]],
+    ):
+        """
+        Records the catalog versions replicated by `peer`, as sent in its sync request
+        """
+        with self._lock:
+            replicated = self._peer_versions.setdefault(peer, {})
+            replicated.update(versions)
+            replicated[None] = (your_incarnation, your_version)
+
+    def purge(self, peers: Iterable[str]):
+        """
+        Forgets the tombstones that every one of `peers` replicated;
+        a replica older than them is then resent whole
+        """
+        with self._lock:
+            peers = list(peers)
+            catalogs = [(None, self._own_incarnation, self._own_version, self._own)] + [
+                (origin, self._incarnations.get(origin), self._versions.get(origin, 0), catalog)
+                for (origin, catalog) in self._origins.items()
+            ]
+            for (origin, incarnation, version, catalog) in catalogs:
+                replicated = min(
+                    (
+                        self._replicated_by(peer, origin, incarnation)
+                        for peer in peers
+                        if peer != origin
+                    ),
+                    default=version,
+                )
+                purged = [
+                    name
+                    for (name, entry) in catalog.items()
+                    if entry.deleted and entry.version <= replicated
+                ]
+                for name in purged:
+                    entry = catalog.pop(name)
+                    self._purged[origin] = max(self._purged.get(origin, 0), entry.version)
+
+    def _replicated_by(self, peer: str, origin: Optional[str], incarnation: int) -> int:
+        """
+        Version of the `origin` catalog of `incarnation` replicated by `peer`.
+        Does not perform locking.
+        """
+        (replicated_incarnation, version) = self._peer_versions.get(peer, {}).get(
+            origin, (None, 0)
+        )
+        return version if replicated_incarnation == incarnation else 0
+
+    def is_fresh(self, origin: str) -> bool:
+        """
+        Whether the replica of `origin` is up to date with its last advertisement
+        """
+        with self._lock:
+            if origin not in self._advertised:
+                return False
+            (incarnation, version) = self._advertised[origin]
+            if self._incarnations.get(origin) != incarnation:
+                return False
+            if self._versions.get(origin, 0) < version:
+                return False
+            synced_at = self._synced_at.get(origin)
+            return synced_at is not None and time.monotonic() - synced_at < self.stale_after
+
+    # queries
+
+    def lookup(self, name: str, digest: str = "") -> List[Tuple[str, CatalogEntry]]:
+        """
+        Peers sharing file `name` with optional `digest`,
+        or any file with `digest` if `name` is empty
+        """
+        with self._lock:
+            if not name:
+                return [
+                    (origin, entry)
+                    for (origin, catalog) in self._origins.items()
+                    for entry in catalog.values()
+                    if not entry.deleted and entry.digest == digest
+                ]
+            return [
+                (origin, catalog[name])
+                for (origin, catalog) in self._origins.items()
+                if name in catalog
+                and not catalog[name].deleted
+                and (not digest or catalog[name].digest == digest)
+            ]
+
+    def query(self, pattern: str) -> List[Tuple[str, CatalogEntry]]:
+        """
+        Peers sharing files whose names match the shell-style `pattern`,
+        e.g. 'report-*' or '*.csv'
+        """
+        with self._lock:
+            return [
+                (origin, entry)
+                for (origin, catalog) in self._origins.items()
+                for entry in catalog.values()
+                if not entry.deleted and fnmatch.fnmatchcase(entry.name, pattern)
+            ]
@@ -0,0 +1,37 @@
+from simple_p2p.common.config import FINDING_TIME, SEARCH_MIN_TIMEOUT
+
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+RTT_K = 4
+
+
+class RttEstimator:
+    """
+    Smoothed round-trip time of FIND requests to a single peer,
+    the retransmission timeout is computed as in TCP (RFC 6298)
+    """
+
+    def __init__(self):
+        self._srtt: float = None
+        self._rttvar: float = None
+
+    @property
+    def srtt(self) -> float:
+        return self._srtt
+
+    @property
+    def rto(self) -> float:
+        if self._srtt is None:
+            return FINDING_TIME
+        rto = self._srtt + RTT_K * self._rttvar
+        return min(max(rto, SEARCH_MIN_TIMEOUT), FINDING_TIME)
+
+    def update(self, sample: float):
+        if self._srtt is None:
+            self._srtt = sample
+            self._rttvar = sample / 2
+            return
+        self._rttvar = (1 - RTT_BETA) * self._rttvar + RTT_BETA * abs(
+            self._srtt - sample
+        )
+        self._srtt = (1 - RTT_ALPHA) * self._srtt + RTT_ALPHA * sample
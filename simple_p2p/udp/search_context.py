@@ -0,0 +1,214 @@
+import asyncio
+import random
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from simple_p2p.common.digests import digest_uri
+from simple_p2p.udp.found_response import FoundResponse
+
+
+class SearchContext:
+    """
+    State of a single in-flight search for a file name,
+    or for a digest alone when the name is empty.
+    Shared by every caller searching for that name at the same time;
+    the callers await `result` or subscribe to the positive responses.
+    Does not perform locking.
+    """
+
+    def __init__(self, file_name: str, file_digest: str = ""):
+        self._file_name = file_name
+        self._file_digest = file_digest
+        self._responses: Dict[str, FoundResponse] = {}
+        self._result: Future = Future()
+        self._callers = 1
+        self._expected_peers: Set[str] = set()
+        self._sent_at: float = None
+        # tells the peers the retries of this search from a new search
+        self._search_id = random.getrandbits(32)
+        self._attempts = 0
+        self._loop: asyncio.AbstractEventLoop = None
+        self._answered: asyncio.Event = None
+        self._listeners: List[Callable[[Optional[FoundResponse]], None]] = []
+
+    @staticmethod
+    def search_key(file_name: str, file_digest: str = "") -> str:
+        """
+        Key of a search among the ones in progress,
+        the `digest_uri` of the content when searching for a digest alone
+        """
+        return file_name or digest_uri(file_digest)
+
+    @property
+    def key(self) -> str:
+        return self.search_key(self._file_name, self._file_digest)
+
+    @property
+    def file_name(self) -> str:
+        return self._file_name
+
+    @property
+    def file_digest(self) -> str:
+        """
+        The digest sent in FIND requests; empty when callers
+        are interested in different versions of the file
+        """
+        return self._file_digest
+
+    @property
+    def search_id(self) -> int:
+        return self._search_id
+
+    @property
+    def attempts(self) -> int:
+        """
+        Number of FIND requests sent so far
+        """
+        return self._attempts
+
+    @property
+    def responses(self) -> Dict[str, FoundResponse]:
+        return self._responses
+
+    @property
+    def result(self) -> Future:
+        return self._result
+
+    @property
+    def callers(self) -> int:
+        return self._callers
+
+    @property
+    def started(self) -> bool:
+        return self._loop is not None
+
+    @property
+    def expected_peers(self) -> Set[str]:
+        return self._expected_peers
+
+    def expect(self, peers: Iterable[str]):
+        """
+        Adds `peers` to the peers expected to answer
+        """
+        new_peers = set(peers).difference(self._expected_peers)
+        if not new_peers:
+            return
+        self._expected_peers.update(new_peers)
+        if self._answered is not None and self.missing_peers:
+            # set when the previously expected peers had all answered
+            self._loop.call_soon_threadsafe(self._answered.clear)
+
+    @property
+    def missing_peers(self) -> Set[str]:
+        return self._expected_peers.difference(self._responses.keys())
+
+    def start(self, expected_peers: Iterable[str]):
+        """
+        Called by the searching coroutine before the first FIND is sent
+        """
+        self._expected_peers = set(expected_peers)
+        self._loop = asyncio.get_running_loop()
+        self._answered = asyncio.Event()
+
+    def mark_sent(self):
+        """
+        Records the (re)transmission of the FIND request
+        """
+        self._attempts += 1
+        self._sent_at = time.monotonic()
+
+    async def wait_answered(self, timeout: float) -> bool:
+        """
+        Waits until all expected peers answer, at most `timeout` seconds.
+        Returns False on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while self.missing_peers:
+            try:
+                await asyncio.wait_for(
+                    self._answered.wait(), max(deadline - time.monotonic(), 0)
+                )
+            except asyncio.TimeoutError:
+                return False
+            # more peers might have been expected since the event was set
+            self._answered.clear()
+        return True
+
+    def join(self, file_digest: str) -> bool:
+        """
+        Attaches another caller to the search.
+        Returns True if the search had to be widened to all digests.
+        """
+        self._callers += 1
+        if self._file_digest and self._file_digest != file_digest:
+            self._file_digest = ""
+            # ask again the peers which might only have the other digest
+            self._responses = {
+                provider_ip: response
+                for (provider_ip, response) in self._responses.items()
+                if response.is_found
+            }
+            return True
+        return False
+
+    def subscribe(self, listener: Callable[[Optional[FoundResponse]], None]):
+        """
+        Registers a listener called with every positive response,
+        including the ones received so far, and with None when the search is over
+        """
+        self._listeners.append(listener)
+        for response in self._responses.values():
+            if response.is_found:
+                listener(response)
+
+    def unsubscribe(self, listener: Callable[[Optional[FoundResponse]], None]):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def finish(self):
+        """
+        Notifies the listeners that the search is over
+        """
+        for listener in self._listeners:
+            listener(None)
+        self._listeners = []
+
+    def add_response(self, response: FoundResponse) -> Optional[float]:
+        """
+        Stores the response of a provider; a positive response
+        always replaces a negative one.
+        Returns the round-trip time of the peer if it can be measured,
+        i.e. the first answer of the peer to an unrepeated FIND (Karn's rule).
+        """
+        provider_ip = response.provider_ip
+        previous = self._responses.get(provider_ip)
+        is_first = previous is None
+        if response.is_found or is_first:
+            self._responses[provider_ip] = response
+        if response.is_found and (is_first or not previous.is_found):
+            for listener in self._listeners:
+                listener(response)
+        answered = self._answered
+        if answered is not None and not self.missing_peers:
+            self._loop.call_soon_threadsafe(answered.set)
+        if is_first and self._attempts == 1:
+            return time.monotonic() - self._sent_at
+        return None
+
+    @staticmethod
+    def group_by_digest(
+        responses: Dict[str, FoundResponse], file_digest: str = ""
+    ) -> Dict[str, List[FoundResponse]]:
+        """
+        Groups positive `responses` by digest,
+        keeping only `file_digest` when specified
+        """
+        results_dict = dict()
+        for response in responses.values():
+            if not response.is_found:
+                continue
+            if file_digest and response.digest != file_digest:
+                continue
+            results_dict.setdefault(response.digest, []).append(response)
+        return results_dict
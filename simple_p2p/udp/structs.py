@@ -1,8 +1,24 @@
+import binascii
+import socket
 import struct
 from abc import abstractmethod
+from typing import Dict, List, Optional, Tuple
 
 from simple_p2p.common.config import *
+from simple_p2p.common.digests import (
+    DIGEST_ALGORITHMS,
+    DIGEST_SEPARATOR,
+    algorithm_by_id,
+    split_digest,
+)
 from simple_p2p.udp.message_type import MessageType
+from simple_p2p.udp.replicated_catalog import CatalogEntry
+
+# message types by id, looked up for every received datagram
+MESSAGE_TYPES: Dict[int, MessageType] = {
+    message_type.value: message_type for message_type in MessageType
+}
+VALID_MESSAGE_IDS = frozenset(MESSAGE_TYPES)
 
 
 class InvalidHeaderException(Exception):
@@ -13,7 +29,23 @@ class InvalidHeaderException(Exception):
 
 
 class Struct:
+    """
+    Base of the message structs. The FORMAT of every subclass
+    is compiled once into the `_codec` struct.Struct.
+    """
+
     FORMAT = None
+    PROTO_VERSION = MIN_PROTO_VERSION
+    # set when the layout is entirely described by FORMAT
+    FIXED_LAYOUT = False
+    _codec: struct.Struct = None
+
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if "FORMAT" in cls.__dict__ and cls.FORMAT is not None:
+            cls._codec = struct.Struct(cls.FORMAT)
 
     def __init__(self, *args):
         pass
@@ -22,6 +54,18 @@ class Struct:
     def to_bytes(self):
         pass
 
+    def pack_into(self, buffer: bytearray, offset: int = 0) -> int:
+        """
+        Writes the struct into `buffer` at `offset`, returns the offset past it.
+        Raises `struct.error` if the buffer is too small.
+        """
+        data = self.to_bytes()
+        end = offset + len(data)
+        if end > len(buffer):
+            raise struct.error("Buffer too small")
+        buffer[offset:end] = data
+        return end
+
     @classmethod
     @property
     def format(cls):
@@ -30,37 +74,29 @@ class Struct:
     @classmethod
     @property
     def struct_size(cls):
-        return struct.calcsize(cls.FORMAT)
+        return cls._codec.size
 
     @classmethod
     def shift_bytes_by_struct_size(cls, struct_bytes):
-        return struct_bytes[cls.struct_size:]
+        return struct_bytes[cls._codec.size:]
 
     @classmethod
     def from_bytes(cls, struct_bytes):
         """
         returns class created from retrieved struct
         """
-        cut_bytes = struct_bytes[0:cls.struct_size]
-        unpacked = struct.unpack(cls.FORMAT, cut_bytes)
-        return cls(*unpacked)
+        return cls(*cls._codec.unpack_from(struct_bytes))
 
     @staticmethod
-    def msg_type_to_struct(message_type):
-        if message_type == MessageType.HELLO:
-            return HelloStruct
-        if message_type == MessageType.HERE:
-            return HereStruct
-        if message_type == MessageType.FIND:
-            return FileDataStruct
-        if message_type == MessageType.FOUND:
-            return FileDataStruct
-        if message_type == MessageType.NOTFOUND:
-            return FileDataStruct
+    def msg_type_to_struct(message_type, proto_version: int = MIN_PROTO_VERSION):
+        return MESSAGE_STRUCTS.get((message_type, proto_version))
 
 
 class HeaderStruct(Struct):
     FORMAT = "!HBB"
+    FIXED_LAYOUT = True
+
+    __slots__ = ("_message_id", "_proto_version", "_magic_number")
 
     def __init__(self, message_id: int, proto_version: int = PROTO_VERSION, magic_number: int = MAGIC_NUMBER):
         super().__init__()
@@ -82,10 +118,16 @@ class HeaderStruct(Struct):
 
     @property
     def message_type(self) -> MessageType:
-        return MessageType(self._message_id)
+        return MESSAGE_TYPES[self._message_id]
 
     def to_bytes(self) -> bytes:
-        return struct.pack(self.FORMAT, self._magic_number, self._proto_version, self._message_id)
+        return self._codec.pack(self._magic_number, self._proto_version, self._message_id)
+
+    def pack_into(self, buffer: bytearray, offset: int = 0) -> int:
+        self._codec.pack_into(
+            buffer, offset, self._magic_number, self._proto_version, self._message_id
+        )
+        return offset + self._codec.size
 
     @classmethod
     def from_bytes(cls, struct_bytes):
@@ -93,36 +135,141 @@ class HeaderStruct(Struct):
         we must overload that method,
         because the arguments are in the different order than struct data
         """
-        cut_bytes = struct_bytes[0:cls.struct_size]
-        magick_number, proto_version, message_id = struct.unpack(cls.FORMAT, cut_bytes)
+        magick_number, proto_version, message_id = cls._codec.unpack_from(struct_bytes)
 
         if magick_number != MAGIC_NUMBER:
             raise InvalidHeaderException("Unknown magic number")
-        if proto_version != PROTO_VERSION:
+        if not MIN_PROTO_VERSION <= proto_version <= PROTO_VERSION:
             raise InvalidHeaderException("Invalid protocol")
-        if message_id not in set(message_type.value for message_type in MessageType):
+        if message_id not in VALID_MESSAGE_IDS:
             raise InvalidHeaderException("Unknown message type")
 
-        return cls(message_id, proto_version, magick_number)
+        header = cls.__new__(cls)
+        header._message_id = message_id
+        header._proto_version = proto_version
+        header._magic_number = magick_number
+        return header
 
 
 class HelloStruct(Struct):
-    FORMAT = "!"
+    """
+    Empty in version 1. Since version 2 it carries the unicast port
+    of the joiner, so that the peers can answer by unicast, and flags.
+    Version 1 peers ignore the trailing bytes.
+    """
+
+    FORMAT = "!HB"
+    FIXED_LAYOUT = True
+    # the joiner asks a few peers for the whole peer list
+    FLAG_WANTS_PEERS = 0x01
 
-    def __init__(self):
+    __slots__ = ("_unicast_port", "_flags")
+
+    def __init__(self, unicast_port: Optional[int] = None, flags: int = 0):
         super().__init__()
+        self._unicast_port = unicast_port
+        self._flags = flags
+
+    @property
+    def unicast_port(self) -> Optional[int]:
+        """
+        None if the joiner is a version 1 peer
+        """
+        return self._unicast_port
+
+    @property
+    def wants_peers(self) -> bool:
+        return bool(self._flags & self.FLAG_WANTS_PEERS)
 
     def to_bytes(self) -> bytes:
-        return struct.pack(self.FORMAT)
+        if self._unicast_port is None:
+            return b""
+        return self._codec.pack(self._unicast_port, self._flags)
+
+    def pack_into(self, buffer: bytearray, offset: int = 0) -> int:
+        if self._unicast_port is None:
+            return offset
+        self._codec.pack_into(buffer, offset, self._unicast_port, self._flags)
+        return offset + self._codec.size
+
+    @classmethod
+    def from_bytes(cls, struct_bytes):
+        if len(struct_bytes) < cls._codec.size:
+            # sent by a version 1 peer
+            return cls()
+        return cls(*cls._codec.unpack_from(struct_bytes))
+
+
+class LoadStruct(Struct):
+    """
+    Load hints of a provider: active uploads, upload throughput
+    in bytes per second and free upload slots
+    """
+
+    FORMAT = "!HIH"
+    FIXED_LAYOUT = True
+    MAX_RATE = 0xFFFFFFFF
+
+    __slots__ = ("_active_consumers", "_upload_rate", "_free_slots")
+
+    def __init__(self, active_consumers: int, upload_rate: int, free_slots: int):
+        super().__init__()
+        self._active_consumers = min(active_consumers, 0xFFFF)
+        self._upload_rate = min(upload_rate, self.MAX_RATE)
+        self._free_slots = min(free_slots, 0xFFFF)
+
+    @property
+    def active_consumers(self) -> int:
+        return self._active_consumers
+
+    @property
+    def upload_rate(self) -> int:
+        return self._upload_rate
+
+    @property
+    def free_slots(self) -> int:
+        return self._free_slots
+
+    def to_bytes(self) -> bytes:
+        return self._codec.pack(self._active_consumers, self._upload_rate, self._free_slots)
 
 
 class HereStruct(Struct):
     FORMAT = "!HH"
+    # appended after the ports, ignored by version 1 peers:
+    # the protocol version followed by type-length-value options
+    VERSION_FORMAT = "!B"
+    OPTION_FORMAT = "!BH"
+    CATALOG_FILTER_OPTION = 0x01
+    CATALOG_VERSION_OPTION = 0x02
+    LOAD_OPTION = 0x03
+    # incarnation, version
+    CATALOG_VERSION_FORMAT = "!IQ"
+    _version_codec = struct.Struct(VERSION_FORMAT)
+    _option_codec = struct.Struct(OPTION_FORMAT)
+    _catalog_version_codec = struct.Struct(CATALOG_VERSION_FORMAT)
 
-    def __init__(self, unicast_port: int, tcp_port: int):
+    __slots__ = ("_unicast_port", "_tcp_port", "_proto_version", "_options")
+
+    def __init__(
+        self,
+        unicast_port: int,
+        tcp_port: int,
+        proto_version: int = PROTO_VERSION,
+        options: Dict[int, bytes] = None,
+    ):
         super().__init__()
         self._unicast_port = unicast_port
         self._tcp_port = tcp_port
+        self._proto_version = proto_version
+        self._options: Dict[int, bytes] = options or {}
+
+    @property
+    def proto_version(self) -> int:
+        """
+        The highest protocol version supported by the peer
+        """
+        return self._proto_version
 
     @property
     def tcp_port(self) -> int:
@@ -132,18 +279,150 @@ class HereStruct(Struct):
     def unicast_port(self) -> int:
         return self._unicast_port
 
+    @property
+    def catalog_filter(self) -> Optional[bytes]:
+        """
+        Encoded Bloom filter of the files shared by the peer
+        """
+        return self._options.get(self.CATALOG_FILTER_OPTION)
+
+    @property
+    def catalog_version(self) -> Optional[Tuple[int, int]]:
+        """
+        Incarnation and version of the replicated catalog of the peer
+        """
+        value = self._options.get(self.CATALOG_VERSION_OPTION)
+        if value is None or len(value) != self._catalog_version_codec.size:
+            return None
+        return self._catalog_version_codec.unpack(value)
+
+    @classmethod
+    def encode_catalog_version(cls, incarnation: int, version: int) -> bytes:
+        return cls._catalog_version_codec.pack(incarnation, version)
+
+    @property
+    def load(self) -> Optional[LoadStruct]:
+        """
+        Load hints of the peer
+        """
+        value = self._options.get(self.LOAD_OPTION)
+        if value is None or len(value) != LoadStruct.struct_size:
+            return None
+        return LoadStruct.from_bytes(value)
+
+    def to_bytes(self) -> bytes:
+        parts = [
+            self._codec.pack(self._unicast_port, self._tcp_port),
+            self._version_codec.pack(self._proto_version),
+        ]
+        for (option, value) in self._options.items():
+            parts.append(self._option_codec.pack(option, len(value)))
+            parts.append(value)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, struct_bytes):
+        unicast_port, tcp_port = cls._codec.unpack_from(struct_bytes)
+        offset = cls._codec.size
+        if len(struct_bytes) < offset + cls._version_codec.size:
+            # sent by a version 1 peer
+            return cls(unicast_port, tcp_port, MIN_PROTO_VERSION)
+        (proto_version,) = cls._version_codec.unpack_from(struct_bytes, offset)
+        offset += cls._version_codec.size
+        options = {}
+        option_size = cls._option_codec.size
+        while len(struct_bytes) >= offset + option_size:
+            option, length = cls._option_codec.unpack_from(struct_bytes, offset)
+            offset += option_size
+            value = bytes(struct_bytes[offset:offset + length])
+            if len(value) != length:
+                raise InvalidHeaderException("Truncated HERE option")
+            # unknown options are kept, but ignored
+            options[option] = value
+            offset += length
+        return cls(unicast_port, tcp_port, proto_version, options)
+
+
+class PeerListStruct(Struct):
+    """
+    Version 2 reply to a HELLO asking for the peer list, sent by unicast.
+    Layout: count, followed by the peers:
+    IPv4 address, unicast port, TCP port, protocol version.
+    """
+
+    PROTO_VERSION = 2
+    FORMAT = "!B"
+    ENTRY_FORMAT = "!4sHHB"
+    _entry_codec = struct.Struct(ENTRY_FORMAT)
+    MAX_ENTRIES = 255
+
+    __slots__ = ("_peers",)
+
+    def __init__(self, peers: List[Tuple[str, int, int, int]]):
+        super().__init__()
+        if len(peers) > self.MAX_ENTRIES:
+            raise ValueError("Too many peers in a single datagram")
+        self._peers = peers
+
+    @property
+    def peers(self) -> List[Tuple[str, int, int, int]]:
+        """
+        (ip address, unicast port, TCP port, protocol version) of each peer
+        """
+        return self._peers
+
+    @classmethod
+    def max_entries(cls, max_size: int) -> int:
+        return min((max_size - cls._codec.size) // cls._entry_codec.size, cls.MAX_ENTRIES)
+
     def to_bytes(self) -> bytes:
-        return struct.pack(self.FORMAT, self._unicast_port, self._tcp_port)
+        parts = [self._codec.pack(len(self._peers))]
+        for (ip_address, unicast_port, tcp_port, proto_version) in self._peers:
+            parts.append(
+                self._entry_codec.pack(
+                    socket.inet_aton(ip_address), unicast_port, tcp_port, proto_version
+                )
+            )
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, struct_bytes):
+        try:
+            (count,) = cls._codec.unpack_from(struct_bytes)
+            offset = cls._codec.size
+            peers = []
+            for _ in range(count):
+                ip_address, unicast_port, tcp_port, proto_version = cls._entry_codec.unpack_from(
+                    struct_bytes, offset
+                )
+                offset += cls._entry_codec.size
+                peers.append(
+                    (socket.inet_ntoa(ip_address), unicast_port, tcp_port, proto_version)
+                )
+        except struct.error:
+            raise InvalidHeaderException("Malformed peer list")
+        return cls(peers)
+
+
+_DIGEST_SEPARATOR = bytes(DIGEST_SEPARATOR, ENCODING)
 
 
 class FileDataStruct(Struct):
     FORMAT = f"!{str(MAX_FILENAME_LENGTH + 1)}p64sQ"  # first byte of name contains size of string
+    FIXED_LAYOUT = True
+
+    # the string fields are decoded on first access
+    __slots__ = ("_file_name", "_file_hash", "_file_size", "_name_str", "_digest_str")
 
     def __init__(self, file_name, file_hash, file_size: int = 0):
         super().__init__()
+        self._name_str: Optional[str] = None
+        self._digest_str: Optional[str] = None
         if type(file_name) == str:
+            self._name_str = file_name
             file_name = bytes(file_name, ENCODING)
         if type(file_hash) == str:
+            self._digest_str = file_hash
             file_hash = bytes(file_hash, ENCODING)
         if type(file_name) != bytes or type(file_hash) != bytes:
             raise TypeError("Invalid file_name or file_hash type")
@@ -151,6 +430,23 @@ class FileDataStruct(Struct):
         self._file_hash: bytes = file_hash
         self._file_size: int = file_size
 
+    @classmethod
+    def from_encoded(cls, file_name: bytes, file_hash: bytes, file_size: int) -> "FileDataStruct":
+        """
+        Builds the struct from already encoded fields, without validation
+        """
+        file_struct = cls.__new__(cls)
+        file_struct._file_name = file_name
+        file_struct._file_hash = file_hash
+        file_struct._file_size = file_size
+        file_struct._name_str = None
+        file_struct._digest_str = None
+        return file_struct
+
+    @classmethod
+    def from_bytes(cls, struct_bytes):
+        return cls.from_encoded(*cls._codec.unpack_from(struct_bytes))
+
     @property
     def file_digest_encoded(self) -> bytes:
         return self._file_hash
@@ -161,17 +457,29 @@ class FileDataStruct(Struct):
 
     @property
     def file_digest(self) -> str:
-        if self.digest_is_empty:
-            return ""  # TODO: BRO PLS FIX ME
-        return str(self._file_hash, ENCODING)
+        if self._digest_str is None:
+            if self.digest_is_empty:
+                self._digest_str = ""  # TODO: BRO PLS FIX ME
+            else:
+                self._digest_str = str(self._file_hash, ENCODING)
+        return self._digest_str
 
     @property
     def file_name(self) -> str:
-        return str(self._file_name, ENCODING)
+        if self._name_str is None:
+            self._name_str = str(self._file_name, ENCODING)
+        return self._name_str
 
     @property
     def digest_is_empty(self):
-        return self.file_digest_encoded[0] == 0
+        return len(self._file_hash) == 0 or self._file_hash[0] == 0
+
+    @property
+    def fits_version_1(self) -> bool:
+        """
+        Whether the digest is empty or a DIGEST_ALG one, the only ones in version 1
+        """
+        return _DIGEST_SEPARATOR not in self._file_hash
 
     @property
     def file_size(self):
@@ -179,7 +487,694 @@ class FileDataStruct(Struct):
 
     @property
     def name_is_empty(self):
-        return len(self.file_name) == 0
+        return len(self._file_name) == 0
+
+    @property
+    def entries(self) -> List["FileDataStruct"]:
+        return [self]
 
     def to_bytes(self):
-        return struct.pack(self.FORMAT, self._file_name, self._file_hash, self._file_size)
+        return self._codec.pack(self._file_name, self._file_hash, self._file_size)
+
+    def pack_into(self, buffer: bytearray, offset: int = 0) -> int:
+        self._codec.pack_into(
+            buffer, offset, self._file_name, self._file_hash, self._file_size
+        )
+        return offset + self._codec.size
+
+
+class FileBatchStruct(Struct):
+    """
+    Version 2 payload of FIND/FOUND/NOTFOUND, carrying many files.
+    Layout: flags and entry count, followed by the entries:
+    name length, name, digest algorithm id, raw digest, file size.
+    FOUND may end with the load hints of the provider, see FLAG_LOAD,
+    then with the verified bytes of every entry, see FLAG_PARTIAL.
+    FIND may end with the search id and attempt, see FLAG_SEARCH_ID.
+    """
+
+    PROTO_VERSION = 2
+    FORMAT = "!BB"
+    # set when the searcher only awaits answers from the peers
+    # whose catalog filter matches, others may skip NOTFOUND
+    FLAG_FILTERED = 0x01
+    # set when the load hints follow the entries, older parsers ignore them
+    FLAG_LOAD = 0x02
+    # set on FIND when the searcher accepts peers still downloading the files
+    FLAG_ACCEPTS_PARTIAL = 0x04
+    # set on FOUND when the provider is still downloading the files,
+    # the verified bytes of every entry follow the load hints
+    FLAG_PARTIAL = 0x08
+    # set on FIND when the search id and the attempt number follow the entries,
+    # telling the retries of a search apart from new searches
+    FLAG_SEARCH_ID = 0x10
+    NAME_FORMAT = "!B"
+    DIGEST_FORMAT = "!B"
+    SIZE_FORMAT = "!Q"
+    AVAILABLE_FORMAT = "!Q"
+    SEARCH_ID_FORMAT = "!IB"
+    _available_codec = struct.Struct(AVAILABLE_FORMAT)
+    _search_id_codec = struct.Struct(SEARCH_ID_FORMAT)
+    _name_codec = struct.Struct(NAME_FORMAT)
+    _digest_codec = struct.Struct(DIGEST_FORMAT)
+    _size_codec = struct.Struct(SIZE_FORMAT)
+    # digest algorithm id of the entries without a digest,
+    # the others are listed in `simple_p2p.common.digests`
+    NO_DIGEST = 0
+    # prepended to the hex digests by algorithm id
+    _digest_prefixes: Dict[int, bytes] = {
+        algorithm.alg_id: bytes(algorithm.format(""), ENCODING)
+        for algorithm in DIGEST_ALGORITHMS.values()
+    }
+    MAX_ENTRIES = 255
+    _entry_codecs: Dict[Tuple[int, int], struct.Struct] = {}
+
+    __slots__ = ("_entries", "_flags", "_load", "_available", "_search_id", "_attempt")
+
+    def __init__(
+        self,
+        entries: List[FileDataStruct],
+        flags: int = 0,
+        load: Optional[LoadStruct] = None,
+        available: Optional[List[int]] = None,
+        search_id: Optional[int] = None,
+        attempt: int = 0,
+    ):
+        super().__init__()
+        if len(entries) > self.MAX_ENTRIES:
+            raise ValueError("Too many entries in a single datagram")
+        if available is not None and len(available) != len(entries):
+            raise ValueError("Available bytes do not match the entries")
+        self._entries = entries
+        self._load = load
+        self._available = available
+        self._search_id = search_id
+        self._attempt = attempt
+        flags = flags | self.FLAG_LOAD if load else flags & ~self.FLAG_LOAD
+        if available is not None:
+            flags |= self.FLAG_PARTIAL
+        else:
+            flags &= ~self.FLAG_PARTIAL
+        if search_id is not None:
+            flags |= self.FLAG_SEARCH_ID
+        else:
+            flags &= ~self.FLAG_SEARCH_ID
+        self._flags = flags
+
+    @property
+    def entries(self) -> List[FileDataStruct]:
+        return self._entries
+
+    @property
+    def flags(self) -> int:
+        return self._flags
+
+    @property
+    def load(self) -> Optional[LoadStruct]:
+        return self._load
+
+    @property
+    def available(self) -> Optional[List[int]]:
+        """
+        Verified bytes of every entry if the provider is still downloading them
+        """
+        return self._available
+
+    @property
+    def search_id(self) -> Optional[int]:
+        """
+        Id of the search a FIND belongs to, None if sent by an older searcher
+        """
+        return self._search_id
+
+    @property
+    def attempt(self) -> int:
+        """
+        Number of times the searcher sent a FIND for the search, this one included
+        """
+        return self._attempt
+
+    @classmethod
+    def entry_size(cls, entry: FileDataStruct) -> int:
+        digest_size = 0 if entry.digest_is_empty else split_digest(entry.file_digest)[0].size
+        return (
+            cls._name_codec.size
+            + len(entry.file_name_encoded)
+            + cls._digest_codec.size
+            + digest_size
+            + cls._size_codec.size
+        )
+
+    @classmethod
+    def pack_entries(
+        cls,
+        entries: List[FileDataStruct],
+        max_size: int,
+        flags: int = 0,
+        load: Optional[LoadStruct] = None,
+        available: Optional[List[int]] = None,
+        search_id: Optional[int] = None,
+        attempt: int = 0,
+    ) -> List["FileBatchStruct"]:
+        """
+        Splits `entries` into as few batches as possible,
+        each at most `max_size` bytes long.
+        `available` lists the verified bytes of every entry, if partial.
+        """
+        batches = []
+        start = 0
+        empty_size = (
+            cls._codec.size
+            + (LoadStruct.struct_size if load else 0)
+            + (cls._search_id_codec.size if search_id is not None else 0)
+        )
+        available_size = cls._available_codec.size if available is not None else 0
+        batch_size = empty_size
+        for (index, entry) in enumerate(entries):
+            size = cls.entry_size(entry) + available_size
+            if index > start and (
+                batch_size + size > max_size or index - start == cls.MAX_ENTRIES
+            ):
+                batches.append(
+                    cls._slice(
+                        entries, start, index, flags, load, available, search_id, attempt
+                    )
+                )
+                start = index
+                batch_size = empty_size
+            batch_size += size
+        if start < len(entries):
+            batches.append(
+                cls._slice(
+                    entries, start, len(entries), flags, load, available, search_id, attempt
+                )
+            )
+        return batches
+
+    @classmethod
+    def _slice(
+        cls, entries, start, end, flags, load, available, search_id, attempt
+    ) -> "FileBatchStruct":
+        return cls(
+            entries[start:end],
+            flags,
+            load,
+            available[start:end] if available is not None else None,
+            search_id,
+            attempt,
+        )
+
+    def to_bytes(self) -> bytes:
+        buffer = bytearray(
+            self._codec.size
+            + sum(self.entry_size(entry) for entry in self._entries)
+            + (LoadStruct.struct_size if self._load else 0)
+            + (
+                self._available_codec.size * len(self._available)
+                if self._available is not None
+                else 0
+            )
+            + (self._search_id_codec.size if self._search_id is not None else 0)
+        )
+        self.pack_into(buffer)
+        return bytes(buffer)
+
+    def pack_into(self, buffer: bytearray, offset: int = 0) -> int:
+        self._codec.pack_into(buffer, offset, self._flags, len(self._entries))
+        offset += self._codec.size
+        for entry in self._entries:
+            offset = self.pack_entry_into(entry, buffer, offset)
+        if self._load:
+            offset = self._load.pack_into(buffer, offset)
+        if self._available is not None:
+            for available in self._available:
+                self._available_codec.pack_into(buffer, offset, available)
+                offset += self._available_codec.size
+        if self._search_id is not None:
+            self._search_id_codec.pack_into(buffer, offset, self._search_id, self._attempt)
+            offset += self._search_id_codec.size
+        return offset
+
+    @classmethod
+    def pack_entry(cls, entry: FileDataStruct) -> bytes:
+        buffer = bytearray(cls.entry_size(entry))
+        cls.pack_entry_into(entry, buffer, 0)
+        return bytes(buffer)
+
+    @classmethod
+    def pack_entry_into(cls, entry: FileDataStruct, buffer: bytearray, offset: int) -> int:
+        """
+        Writes the entry into `buffer` at `offset`, returns the offset past it.
+        Raises `struct.error` if the buffer is too small.
+        """
+        name = entry.file_name_encoded
+        if entry.digest_is_empty:
+            (digest_alg, digest) = (cls.NO_DIGEST, b"")
+        else:
+            (algorithm, hex_digest) = split_digest(entry.file_digest)
+            digest_alg = algorithm.alg_id
+            digest = binascii.unhexlify(hex_digest)
+        codec = cls._entry_codec(len(name), len(digest))
+        codec.pack_into(
+            buffer, offset, len(name), name, digest_alg, digest, entry.file_size
+        )
+        return offset + codec.size
+
+    @classmethod
+    def _entry_codec(cls, name_size: int, digest_size: int) -> struct.Struct:
+        """
+        Compiled layout of an entry with the given field sizes
+        """
+        key = (name_size, digest_size)
+        codec = cls._entry_codecs.get(key)
+        if codec is None:
+            codec = cls._entry_codecs[key] = struct.Struct(
+                f"!B{name_size}sB{digest_size}sQ"
+            )
+        return codec
+
+    @classmethod
+    def unpack_entry(cls, struct_bytes, offset: int) -> Tuple[FileDataStruct, int]:
+        """
+        Decodes the entry at `offset`, returns it with the offset past it.
+        Raises `struct.error` or `KeyError` if the entry is malformed.
+        """
+        (name_length,) = cls._name_codec.unpack_from(struct_bytes, offset)
+        offset += cls._name_codec.size
+        name = bytes(struct_bytes[offset:offset + name_length])
+        offset += name_length
+        (digest_alg,) = cls._digest_codec.unpack_from(struct_bytes, offset)
+        offset += cls._digest_codec.size
+        digest_size = 0 if digest_alg == cls.NO_DIGEST else algorithm_by_id(digest_alg).size
+        digest = binascii.hexlify(struct_bytes[offset:offset + digest_size])
+        offset += digest_size
+        (file_size,) = cls._size_codec.unpack_from(struct_bytes, offset)
+        offset += cls._size_codec.size
+        if len(name) != name_length or len(digest) != 2 * digest_size:
+            raise struct.error("Truncated file entry")
+        if digest_size:
+            digest = cls._digest_prefixes[digest_alg] + digest
+        return FileDataStruct.from_encoded(name, digest, file_size), offset
+
+    @classmethod
+    def from_bytes(cls, struct_bytes):
+        try:
+            flags, count = cls._codec.unpack_from(struct_bytes)
+            offset = cls._codec.size
+            entries = []
+            for _ in range(count):
+                (entry, offset) = cls.unpack_entry(struct_bytes, offset)
+                entries.append(entry)
+            load = None
+            if flags & cls.FLAG_LOAD:
+                load = LoadStruct.from_bytes(struct_bytes[offset:])
+                offset += LoadStruct.struct_size
+            available = None
+            if flags & cls.FLAG_PARTIAL:
+                available = [
+                    cls._available_codec.unpack_from(
+                        struct_bytes, offset + index * cls._available_codec.size
+                    )[0]
+                    for index in range(count)
+                ]
+                offset += cls._available_codec.size * count
+            (search_id, attempt) = (None, 0)
+            if flags & cls.FLAG_SEARCH_ID:
+                (search_id, attempt) = cls._search_id_codec.unpack_from(struct_bytes, offset)
+        except (struct.error, KeyError):
+            raise InvalidHeaderException("Malformed file batch")
+        return cls(entries, flags, load, available, search_id, attempt)
+
+
+class CatalogSyncStruct(Struct):
+    """
+    Version 2 gossip request, sent by unicast.
+    Layout: catalog incarnation and version of the sender, incarnation and
+    version of the receiver catalog known to the sender, count, followed by
+    the other replicated catalogs: origin IPv4 address, incarnation, version.
+    """
+
+    PROTO_VERSION = 2
+    FORMAT = "!IQIQH"
+    ENTRY_FORMAT = "!4sIQ"
+    _entry_codec = struct.Struct(ENTRY_FORMAT)
+
+    __slots__ = (
+        "_sender_incarnation",
+        "_sender_version",
+        "_your_incarnation",
+        "_your_version",
+        "_versions",
+    )
+
+    def __init__(
+        self,
+        sender_incarnation: int,
+        sender_version: int,
+        your_incarnation: int,
+        your_version: int,
+        versions: Dict[str, Tuple[int, int]],
+    ):
+        super().__init__()
+        self._sender_incarnation = sender_incarnation
+        self._sender_version = sender_version
+        self._your_incarnation = your_incarnation
+        self._your_version = your_version
+        self._versions = versions
+
+    @property
+    def sender_incarnation(self) -> int:
+        return self._sender_incarnation
+
+    @property
+    def sender_version(self) -> int:
+        return self._sender_version
+
+    @property
+    def your_incarnation(self) -> int:
+        return self._your_incarnation
+
+    @property
+    def your_version(self) -> int:
+        return self._your_version
+
+    @property
+    def versions(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Incarnation and version of the replicated catalogs by origin
+        """
+        return self._versions
+
+    @classmethod
+    def max_entries(cls, max_size: int) -> int:
+        return (max_size - cls._codec.size) // cls._entry_codec.size
+
+    def to_bytes(self) -> bytes:
+        parts = [
+            self._codec.pack(
+                self._sender_incarnation,
+                self._sender_version,
+                self._your_incarnation,
+                self._your_version,
+                len(self._versions),
+            )
+        ]
+        for (origin, (incarnation, version)) in self._versions.items():
+            parts.append(
+                self._entry_codec.pack(socket.inet_aton(origin), incarnation, version)
+            )
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, struct_bytes):
+        try:
+            (
+                sender_incarnation,
+                sender_version,
+                your_incarnation,
+                your_version,
+                count,
+            ) = cls._codec.unpack_from(struct_bytes)
+            offset = cls._codec.size
+            versions = {}
+            for _ in range(count):
+                origin, incarnation, version = cls._entry_codec.unpack_from(
+                    struct_bytes, offset
+                )
+                offset += cls._entry_codec.size
+                versions[socket.inet_ntoa(origin)] = (incarnation, version)
+        except struct.error:
+            raise InvalidHeaderException("Malformed catalog sync")
+        return cls(sender_incarnation, sender_version, your_incarnation, your_version, versions)
+
+
+class CatalogDeltaStruct(Struct):
+    """
+    Version 2 gossip response, the changes of a single catalog
+    between two versions of an incarnation, sent by unicast.
+    Layout: origin IPv4 address (0.0.0.0 for the sender catalog),
+    incarnation, versions from and to, count, followed by the entries:
+    file entry as in FileBatchStruct, version, deleted flag.
+    """
+
+    PROTO_VERSION = 2
+    FORMAT = "!4sIQQH"
+    ENTRY_FORMAT = "!QB"
+    SENDER_ORIGIN = "0.0.0.0"
+    _entry_codec = struct.Struct(ENTRY_FORMAT)
+
+    __slots__ = ("_origin", "_incarnation", "_from_version", "_to_version", "_entries")
+
+    def __init__(
+        self,
+        origin: Optional[str],
+        incarnation: int,
+        from_version: int,
+        to_version: int,
+        entries: List[CatalogEntry],
+    ):
+        super().__init__()
+        self._origin = origin
+        self._incarnation = incarnation
+        self._from_version = from_version
+        self._to_version = to_version
+        self._entries = entries
+
+    @property
+    def origin(self) -> Optional[str]:
+        """
+        Origin of the catalog, None for the catalog of the sender
+        """
+        return self._origin
+
+    @property
+    def incarnation(self) -> int:
+        return self._incarnation
+
+    @property
+    def from_version(self) -> int:
+        return self._from_version
+
+    @property
+    def to_version(self) -> int:
+        return self._to_version
+
+    @property
+    def entries(self) -> List[CatalogEntry]:
+        return self._entries
+
+    @classmethod
+    def entry_size(cls, entry: CatalogEntry) -> int:
+        return FileBatchStruct.entry_size(
+            FileDataStruct(entry.name, entry.digest, entry.size)
+        ) + cls._entry_codec.size
+
+    @classmethod
+    def pack_delta(
+        cls,
+        origin: Optional[str],
+        incarnation: int,
+        since: int,
+        to_version: int,
+        entries: List[CatalogEntry],
+        max_size: int,
+    ) -> List["CatalogDeltaStruct"]:
+        """
+        Splits the changes since version `since`, ordered by version,
+        into deltas of at most `max_size` bytes, chained by their versions
+        """
+        deltas = []
+        batch = []
+        batch_size = cls._codec.size
+        from_version = since
+        for entry in entries:
+            size = cls.entry_size(entry)
+            if batch and batch_size + size > max_size:
+                deltas.append(
+                    cls(origin, incarnation, from_version, batch[-1].version, batch)
+                )
+                from_version = batch[-1].version
+                batch = []
+                batch_size = cls._codec.size
+            batch.append(entry)
+            batch_size += size
+        deltas.append(cls(origin, incarnation, from_version, to_version, batch))
+        return deltas
+
+    def to_bytes(self) -> bytes:
+        origin = socket.inet_aton(self._origin or self.SENDER_ORIGIN)
+        parts = [
+            self._codec.pack(
+                origin,
+                self._incarnation,
+                self._from_version,
+                self._to_version,
+                len(self._entries),
+            )
+        ]
+        for entry in self._entries:
+            parts.append(
+                FileBatchStruct.pack_entry(FileDataStruct(entry.name, entry.digest, entry.size))
+            )
+            parts.append(self._entry_codec.pack(entry.version, entry.deleted))
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, struct_bytes):
+        try:
+            origin, incarnation, from_version, to_version, count = cls._codec.unpack_from(
+                struct_bytes
+            )
+            offset = cls._codec.size
+            entries = []
+            for _ in range(count):
+                (file_struct, offset) = FileBatchStruct.unpack_entry(struct_bytes, offset)
+                version, deleted = cls._entry_codec.unpack_from(struct_bytes, offset)
+                offset += cls._entry_codec.size
+                entries.append(
+                    CatalogEntry(
+                        file_struct.file_name,
+                        file_struct.file_digest,
+                        file_struct.file_size,
+                        version,
+                        bool(deleted),
+                    )
+                )
+        except (struct.error, KeyError, UnicodeDecodeError):
+            raise InvalidHeaderException("Malformed catalog delta")
+        origin = socket.inet_ntoa(origin)
+        if origin == cls.SENDER_ORIGIN:
+            origin = None
+        return cls(origin, incarnation, from_version, to_version, entries)
+
+
+class FetchStruct(Struct):
+    """
+    Version 2 request for the content of a small file, sent by unicast.
+    Layout: request id, followed by the file entry as in FileBatchStruct,
+    an entry without a name asks for any file with the digest.
+    """
+
+    PROTO_VERSION = 2
+    FORMAT = "!I"
+
+    __slots__ = ("_request_id", "_entry")
+
+    def __init__(self, request_id: int, entry: FileDataStruct):
+        super().__init__()
+        self._request_id = request_id
+        self._entry = entry
+
+    @property
+    def request_id(self) -> int:
+        return self._request_id
+
+    @property
+    def entry(self) -> FileDataStruct:
+        return self._entry
+
+    def to_bytes(self) -> bytes:
+        return self._codec.pack(self._request_id) + FileBatchStruct.pack_entry(self._entry)
+
+    @classmethod
+    def from_bytes(cls, struct_bytes):
+        try:
+            (request_id,) = cls._codec.unpack_from(struct_bytes)
+            (entry, _) = FileBatchStruct.unpack_entry(struct_bytes, cls._codec.size)
+        except (struct.error, KeyError):
+            raise InvalidHeaderException("Malformed fetch")
+        return cls(request_id, entry)
+
+
+class FetchedStruct(Struct):
+    """
+    Version 2 response to a FETCH, a fragment of the file content.
+    Layout: request id, fragment index, fragment count, file size,
+    followed by the fragment. A count of 0 tells that the file is not sent.
+    """
+
+    PROTO_VERSION = 2
+    FORMAT = "!IHHQ"
+    # content carried by a single datagram
+    FRAGMENT_SIZE = UDP_BUFFER_SIZE - struct.calcsize(HeaderStruct.FORMAT) - struct.calcsize(FORMAT)
+
+    __slots__ = ("_request_id", "_index", "_count", "_size", "_fragment")
+
+    def __init__(self, request_id: int, index: int, count: int, size: int, fragment: bytes = b""):
+        super().__init__()
+        self._request_id = request_id
+        self._index = index
+        self._count = count
+        self._size = size
+        self._fragment = fragment
+
+    @property
+    def request_id(self) -> int:
+        return self._request_id
+
+    @property
+    def index(self) -> int:
+        return self._index
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def fragment(self) -> bytes:
+        return self._fragment
+
+    @classmethod
+    def fragments(cls, request_id: int, content: bytes) -> List["FetchedStruct"]:
+        """
+        Splits `content` into the fragments answering request `request_id`
+        """
+        count = max(1, -(-len(content) // cls.FRAGMENT_SIZE))
+        return [
+            cls(
+                request_id,
+                index,
+                count,
+                len(content),
+                content[index * cls.FRAGMENT_SIZE : (index + 1) * cls.FRAGMENT_SIZE],
+            )
+            for index in range(count)
+        ]
+
+    def to_bytes(self) -> bytes:
+        return (
+            self._codec.pack(self._request_id, self._index, self._count, self._size)
+            + self._fragment
+        )
+
+    @classmethod
+    def from_bytes(cls, struct_bytes):
+        try:
+            request_id, index, count, size = cls._codec.unpack_from(struct_bytes)
+        except struct.error:
+            raise InvalidHeaderException("Malformed fetched")
+        return cls(request_id, index, count, size, bytes(struct_bytes[cls._codec.size :]))
+
+
+# message struct by message type and protocol version
+MESSAGE_STRUCTS: Dict[Tuple[MessageType, int], type] = {}
+for _proto_version in range(MIN_PROTO_VERSION, PROTO_VERSION + 1):
+    _file_struct = FileDataStruct if _proto_version == MIN_PROTO_VERSION else FileBatchStruct
+    MESSAGE_STRUCTS.update(
+        {
+            (MessageType.HELLO, _proto_version): HelloStruct,
+            (MessageType.HERE, _proto_version): HereStruct,
+            (MessageType.PEERS, _proto_version): PeerListStruct,
+            (MessageType.FIND, _proto_version): _file_struct,
+            (MessageType.FOUND, _proto_version): _file_struct,
+            (MessageType.NOTFOUND, _proto_version): _file_struct,
+            (MessageType.CATALOG_SYNC, _proto_version): CatalogSyncStruct,
+            (MessageType.CATALOG_DELTA, _proto_version): CatalogDeltaStruct,
+            (MessageType.FETCH, _proto_version): FetchStruct,
+            (MessageType.FETCHED, _proto_version): FetchedStruct,
+        }
+    )
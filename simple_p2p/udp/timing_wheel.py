@@ -0,0 +1,63 @@
+import time
+from typing import Dict, Hashable, List, Set
+
+
+class TimingWheel:
+    """
+    Hashed timing wheel of deadlines on the monotonic clock.
+    A key is kept in the slot of its deadline tick, so advancing the wheel
+    only looks at the slots that came due instead of every key.
+    Deadlines further than a full turn stay in their slot until their round.
+    Does not perform locking.
+    """
+
+    def __init__(self, tick: float, slots: int):
+        self._tick = tick
+        self._slots: List[Set[Hashable]] = [set() for _ in range(slots)]
+        self._deadline_ticks: Dict[Hashable, int] = {}
+        self._current_tick = int(time.monotonic() // tick)
+
+    def __len__(self):
+        return len(self._deadline_ticks)
+
+    def __contains__(self, key: Hashable):
+        return key in self._deadline_ticks
+
+    def add(self, key: Hashable, deadline: float):
+        """
+        Schedules `key` to expire at `deadline`, replacing its previous deadline
+        """
+        self.discard(key)
+        deadline_tick = max(int(deadline // self._tick), self._current_tick + 1)
+        self._deadline_ticks[key] = deadline_tick
+        self._slots[deadline_tick % len(self._slots)].add(key)
+
+    def discard(self, key: Hashable):
+        deadline_tick = self._deadline_ticks.pop(key, None)
+        if deadline_tick is not None:
+            self._slots[deadline_tick % len(self._slots)].discard(key)
+
+    def advance(self, now: float) -> List[Hashable]:
+        """
+        Moves the wheel to `now`, removes and returns the keys that expired
+        """
+        now_tick = int(now // self._tick)
+        if now_tick <= self._current_tick:
+            return []
+        ticks = range(
+            self._current_tick + 1,
+            min(now_tick, self._current_tick + len(self._slots)) + 1,
+        )
+        self._current_tick = now_tick
+
+        expired = []
+        for tick in ticks:
+            slot = self._slots[tick % len(self._slots)]
+            if not slot:
+                continue
+            due = [key for key in slot if self._deadline_ticks[key] <= now_tick]
+            for key in due:
+                slot.discard(key)
+                del self._deadline_ticks[key]
+            expired.extend(due)
+        return expired
@@ -0,0 +1,39 @@
+import time
+
+
+class TokenBucket:
+    """
+    Allows `rate` events per second on average, in bursts of up to `burst` events.
+    Does not perform locking.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self._rate = rate
+        self._burst = float(burst)
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def delay(self, now: float = None) -> float:
+        """
+        Refills the bucket.
+        Returns the time to wait for a token, 0 if one is available.
+        """
+        if now is None:
+            now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self._rate
+
+    def consume(self):
+        self._tokens -= 1
+
+    def take(self, now: float = None) -> bool:
+        """
+        Consumes a token if one is available
+        """
+        if self.delay(now):
+            return False
+        self._tokens -= 1
+        return True
@@ -1,25 +1,54 @@
 import asyncio
-import copy
-import datetime
 import logging
+import random
 import threading
-from typing import Dict, List, Tuple
+import time
+from collections import Counter, OrderedDict
+from functools import partial
+from types import MappingProxyType
+from typing import AsyncIterator, Callable, Dict, List, Mapping, Optional, Set, Tuple
 
 from simple_p2p.common.config import *
 from simple_p2p.common.tasks import coro_in_background, new_loop
-from simple_p2p.common.utils import get_ip4_broadcast, is_sha256
+from simple_p2p.common.digests import has_default_algorithm, is_digest
+from simple_p2p.common.utils import get_ip4_broadcast, local_ip4_addresses
 from simple_p2p.common.exceptions import LogicError
-from simple_p2p.common.models import FileMetadata
+from simple_p2p.common.models import FileMetadata, FileStatus
 from simple_p2p.udp.datagrams import (
     HelloDatagram,
     HereDatagram,
     FindDatagram,
     FoundDatagram,
     NotFoundDatagram,
+    CatalogSyncDatagram,
+    CatalogDeltaDatagram,
+    FetchDatagram,
+    FetchedDatagram,
+    PeerListDatagram,
 )
+from simple_p2p.udp.catalog_filter import BloomFilter, CatalogFilter
+from simple_p2p.udp.fetch_context import FetchContext
 from simple_p2p.udp.found_response import FoundResponse
-from simple_p2p.udp.structs import FileDataStruct, HereStruct
-from simple_p2p.udp.udp_socket import UdpSocket, BroadcastSocket
+from simple_p2p.udp.message_type import MessageType
+from simple_p2p.udp.replicated_catalog import ReplicatedCatalog
+from simple_p2p.udp.rtt_estimator import RttEstimator
+from simple_p2p.udp.search_context import SearchContext
+from simple_p2p.udp.structs import (
+    CatalogDeltaStruct,
+    CatalogSyncStruct,
+    FetchStruct,
+    FetchedStruct,
+    FileBatchStruct,
+    FileDataStruct,
+    HeaderStruct,
+    HelloStruct,
+    HereStruct,
+    LoadStruct,
+    PeerListStruct,
+)
+from simple_p2p.udp.timing_wheel import TimingWheel
+from simple_p2p.udp.token_bucket import TokenBucket
+from simple_p2p.udp.udp_socket import UdpSocket, BroadcastSocket, MulticastSocket
 from simple_p2p.udp.peer import Peer
 
 
@@ -35,29 +64,71 @@ class UdpController:
         cfg = Config()
 
         self._logger = logging.getLogger("UdpController")
-        broadcast_endpoint = (
-            get_ip4_broadcast(cfg.broadcast_iface),
-            cfg.broadcast_port,
-        )
-        self._broadcast_socket = BroadcastSocket(broadcast_endpoint)
+        # discovery goes through the broadcast socket, or a multicast group
+        if cfg.discovery_mode == "multicast":
+            self._broadcast_socket = MulticastSocket(
+                (cfg.multicast_group, cfg.broadcast_port),
+                ifaces=[iface.strip() for iface in cfg.multicast_ifaces.split(",")],
+                ttl=cfg.multicast_ttl,
+                loop=bool(cfg.multicast_loop),
+            )
+        elif cfg.discovery_mode == "broadcast":
+            broadcast_endpoint = (
+                get_ip4_broadcast(cfg.broadcast_iface),
+                cfg.broadcast_port,
+            )
+            self._broadcast_socket = BroadcastSocket(broadcast_endpoint)
+        else:
+            raise LogicError(f"Unknown discovery mode '{cfg.discovery_mode}'")
         self._unicast_socket = UdpSocket((cfg.bind_ip, cfg.udp_port))
         self._controller = controller
-        self._add_receive_callbacks()
+        self._add_message_handlers()
         self._loop: asyncio.AbstractEventLoop = None
 
-        self._known_peers: Dict[str, Peer] = {}
+        # read-only snapshot, replaced as a whole by the writers holding the lock
+        self._known_peers: Mapping[str, Peer] = MappingProxyType({})
         self._known_peers_lock = threading.Lock()
+        # inactivity deadlines of the peers, guarded by the peer table lock
+        self._peer_expiry = TimingWheel(UDP_PEER_EXPIRY_TICK, UDP_PEER_EXPIRY_SLOTS)
+
+        self._catalog = CatalogFilter()
+        self._advertised_filter: Optional[BloomFilter] = None
+        self._advertise_handle: Optional[asyncio.TimerHandle] = None
+        self._replicated_catalog = ReplicatedCatalog()
 
-        self._search_results: Dict[str, Dict[str, FoundResponse]] = {}
+        self._search_results: Dict[str, SearchContext] = {}
+        self._peer_rtt: Dict[str, RttEstimator] = {}
         self._search_lock = threading.Lock()
+        # inline transfers in progress by request id, guarded by the search lock
+        self._fetches: Dict[int, FetchContext] = {}
 
-    def _add_receive_callbacks(self):
-        """pass callback functions down to receiver"""
-        self._broadcast_socket.add_receive_callback(self.find_callback)
-        self._broadcast_socket.add_receive_callback(self.hello_callback)
-        self._broadcast_socket.add_receive_callback(self.here_callback)
-        self._unicast_socket.add_receive_callback(self.found_callback)
-        self._unicast_socket.add_receive_callback(self.not_found_callback)
+        # FIND rate limits and recent replies by source, used by the socket loop only
+        self._find_buckets: Dict[str, TokenBucket] = {}
+        self._find_replies: "OrderedDict[tuple, Tuple[float, int, Optional[List[bytes]]]]" = (
+            OrderedDict()
+        )
+
+        # datagram counters, e.g. to measure the cost of joins or shed requests
+        self._stats: Counter = Counter()
+
+    def _add_message_handlers(self):
+        """pass callback functions down to receiver, by message type"""
+        self._broadcast_socket.set_receive_callback(self._peer_seen)
+        self._unicast_socket.set_receive_callback(self._peer_seen)
+        self._broadcast_socket.add_handler(MessageType.FIND, self.find_callback)
+        self._broadcast_socket.add_handler(MessageType.HELLO, self.hello_callback)
+        self._broadcast_socket.add_handler(MessageType.HERE, self.here_callback)
+        self._unicast_socket.add_handler(MessageType.HERE, self.here_callback)
+        self._unicast_socket.add_handler(MessageType.PEERS, self.peer_list_callback)
+        self._unicast_socket.add_handler(
+            MessageType.FIND, partial(self.find_callback, unicast=True)
+        )
+        self._unicast_socket.add_handler(MessageType.FOUND, self.found_callback)
+        self._unicast_socket.add_handler(MessageType.NOTFOUND, self.not_found_callback)
+        self._unicast_socket.add_handler(MessageType.CATALOG_SYNC, self.catalog_sync_callback)
+        self._unicast_socket.add_handler(MessageType.CATALOG_DELTA, self.catalog_delta_callback)
+        self._unicast_socket.add_handler(MessageType.FETCH, self.fetch_callback)
+        self._unicast_socket.add_handler(MessageType.FETCHED, self.fetched_callback)
 
     def start(self):
         self._loop = new_loop()
@@ -68,285 +139,955 @@ class UdpController:
 
         # run agent in background
         coro_in_background(self._serve_alive_agent(), self._loop)
+        coro_in_background(self._serve_gossip_agent(), self._loop)
+        coro_in_background(self._serve_expiry_agent(), self._loop)
 
-        # broadcast hello message
-        self._broadcast_socket.send(HelloDatagram().to_bytes())
+        # broadcast hello message, a few peers answer with the peer list
+        self._send_hello(HelloStruct.FLAG_WANTS_PEERS)
+        self._loop.call_soon_threadsafe(
+            self._loop.call_later, HELLO_RETRY_DELAY, self._retry_hello
+        )
         self._logger.debug("Started UDP controller")
 
+    def _send_hello(self, flags: int = 0):
+        self._stats["hello_sent"] += 1
+        self._broadcast_socket.send(
+            HelloDatagram(HelloStruct(Config().udp_port, flags)).to_bytes()
+        )
+
+    def _retry_hello(self):
+        """
+        Asks every peer to answer if none of them sent the peer list
+        """
+        if not self.known_peers:
+            self._logger.debug("Hello | No peers answered, retrying")
+            self._send_hello()
+
     def stop(self):
         self._loop.stop()
         self._unicast_socket.stop()
         self._broadcast_socket.stop()
 
     @property
-    def known_peers(self) -> Dict[str, Peer]:
-        with self._known_peers_lock:
-            return copy.deepcopy(self._known_peers)
+    def stats(self) -> Dict[str, int]:
+        """
+        Counters of the sent and received discovery datagrams
+        """
+        return dict(self._stats)
+
+    @property
+    def known_peers(self) -> Mapping[str, Peer]:
+        """
+        Read-only snapshot of the peer table, never modified afterwards
+        except for the `last_seen` time of the peers
+        """
+        return self._known_peers
 
     @property
     def known_peers_list(self) -> List[Peer]:
         return list(self.known_peers.values())
 
-    def get_peer_by_ip(self, ip) -> Peer:
-        return self.known_peers.get(ip)
-
-    async def _search(
-        self, file_name: str = None, file_digest: str = None
-    ) -> Dict[str, List[FoundResponse]]:
-        if not file_name:
-            raise InvalidSearchArgsException("Filename cannot be empty")
+    @property
+    def heartbeat_interval(self) -> float:
+        """
+        Period of the HERE broadcasts, growing with the number of peers
+        so that the whole network sends about UDP_ADVERTISE_RATE of them per second
+        """
+        interval = (len(self._known_peers) + 1) / UDP_ADVERTISE_RATE
+        return min(max(interval, UDP_ADVERTISE_PERIOD), UDP_ADVERTISE_MAX_PERIOD)
 
-        if file_digest is None:
-            file_digest = ""
+    @property
+    def peer_timeout(self) -> float:
+        """
+        Inactivity after which a peer is removed, scaled with the heartbeat interval
+        """
+        return self.heartbeat_interval * UDP_PEER_CLEANUP_PERIOD / UDP_ADVERTISE_PERIOD
 
-        if file_digest != "" and not is_sha256(file_digest):
-            raise InvalidSearchArgsException("File is not sha256sum")
+    def get_peer_by_ip(self, ip) -> Peer:
+        return self.known_peers.get(ip)
 
+    async def _search(self, searches: List[SearchContext]) -> None:
+        """
+        Sends FIND requests for the `searches` and collects the responses,
+        using batched datagrams when every known peer supports them.
+        Only the peers whose catalog filter matches are expected to answer.
+        Returns once the searches are over.
+        """
+        peers = self.known_peers
+        peers_available = set(peers.keys())
         with self._search_lock:
-            if file_name in self._search_results:
-                self._logger.warning(
-                    "Search | Attempted to search a file for which a search is already in progress"
-                )
-                raise LogicError(
-                    f"There is another search for '{file_name}' in progress"
-                )
-            self._search_results[file_name] = dict()
-
-        peers_available = set(self.known_peers.keys())
-
-        def get_missing_peers():
-            peers_left = peers_available.copy()
-            with self._search_lock:
-                for provider_ip in self._search_results[file_name].keys():
-                    if provider_ip in peers_left:
-                        peers_left.remove(provider_ip)
-            return peers_left
-
-        find_struct = FileDataStruct(file_name, file_digest)
-        find_datagram = FindDatagram(find_struct)
-
-        missing_peers = set()
+            for search in searches:
+                search.start(self._find_targets(search, peers))
 
+        pending = searches
+        waited = 0
         for retry in range(SEARCH_RETRIES + 1):
-            if len(missing_peers) != 0:
+            if retry:
+                with self._search_lock:
+                    pending = [search for search in pending if search.missing_peers]
+                    missing_peers = set().union(
+                        *(search.missing_peers for search in pending)
+                    )
+                if not pending:
+                    # the last answers arrived after the timeout
+                    break
                 self._logger.info(
-                    "Search | %s peers did not respond, retrying search for file %s with optional digest %s (%s/%s)",
+                    "Search | %s peers did not respond, retrying search for %s files, e.g. %s with optional digest %s (%s/%s)",
                     len(missing_peers),
-                    file_name,
-                    file_digest,
+                    len(pending),
+                    pending[0].file_name,
+                    pending[0].file_digest,
                     retry,
                     SEARCH_RETRIES,
                 )
-            try:
-                self._broadcast_socket.send(find_datagram.to_bytes())
-            except Exception as exc:
-                self._logger.error(f"Search | Error while broadcasting", exc_info=exc)
-
-            # find and found callbacks are now working
-            await asyncio.sleep(FINDING_TIME)
+            self._send_find(pending)
 
-            # check if all known peers responded and retry if not
-            missing_peers = get_missing_peers()
-
-            if len(missing_peers) == 0:
+            # find and found callbacks are now working,
+            # wait until every known peer answers or the timeout expires
+            timeout = max(self._search_timeout(search, retry) for search in pending)
+            answered = await asyncio.gather(
+                *(search.wait_answered(timeout) for search in pending)
+            )
+            if all(answered):
                 break
+            waited += timeout
 
-        # delete peers that did not respond
+        with self._search_lock:
+            missing_peers = set().union(*(search.missing_peers for search in searches))
+
+        # delete peers that did not respond within the full search window,
+        # peers that are merely slower than their usual round-trip time are kept,
+        # so are the ones that might have skipped the answer due to an outdated filter
         for peer_ip in missing_peers:
+            peer = peers.get(peer_ip)
+            if waited < FINDING_TIME or (peer and peer.catalog_filter):
+                self._logger.info("Search | Peer %s did not respond in time", peer_ip)
+                continue
             self._logger.info("Search | Deleting unresponsive peer %s", peer_ip)
             self.remove_peer(peer_ip)
 
-        # clear the dict indicating that the search is over
+        for search in searches:
+            # clear the dict indicating that the search is over
+            with self._search_lock:
+                self._search_results.pop(search.key)
+                search.finish()
+                responses = dict(search.responses)
+            search.result.set_result(responses)
+
+            self._logger.info(
+                "Search | Found %s in %d out of %d peers (%d callers)",
+                search.key,
+                sum(1 for response in responses.values() if response.is_found),
+                len(peers_available),
+                search.callers,
+            )
+
+    def _search_timeout(self, search: SearchContext, retry: int) -> float:
+        """
+        Time to wait for the missing peers to answer,
+        based on their round-trip times and doubled with every retry
+        """
         with self._search_lock:
-            responses: Dict[str, FoundResponse] = self._search_results.pop(file_name)
-
-        results_dict = dict()
-        for response in responses.values():
-            if response.is_found:
-                results_dict.setdefault(response.digest, []).append(response)
-
-        self._logger.info(
-            "Search | Found %s in %d out of %d peers",
-            file_name,
-            sum(len(_list) for _list in results_dict.values()),
-            len(peers_available),
-        )
-        return results_dict
+            timeout = max(
+                (
+                    self._peer_rtt[peer_ip].rto if peer_ip in self._peer_rtt else FINDING_TIME
+                    for peer_ip in search.missing_peers
+                ),
+                default=SEARCH_MIN_TIMEOUT,
+            )
+        return min(timeout * 2 ** retry, FINDING_TIME)
 
+    def _update_rtt(self, peer_ip: str, sample: float):
+        """
+        Feeds the round-trip time sample of a peer to its estimator.
+        Does not perform locking.
+        """
+        if sample is None:
+            return
+        self._peer_rtt.setdefault(peer_ip, RttEstimator()).update(sample)
 
-    async def search(
-        self, file_name: str = None, file_digest: str = None
-    ) -> Dict[str, List[FoundResponse]]:
-        if not file_name:
-            raise InvalidSearchArgsException("Filename cannot be empty")
+    def _peers_support(self, proto_version: int) -> bool:
+        return all(
+            peer.proto_version >= proto_version for peer in self.known_peers.values()
+        )
 
-        if file_digest is None:
-            file_digest = ""
+    def _file_datagrams(
+        self,
+        datagram_cls,
+        entries: List[FileDataStruct],
+        proto_version: int,
+        flags: int = 0,
+        load: Optional[LoadStruct] = None,
+        available: Optional[List[int]] = None,
+        search_id: Optional[int] = None,
+        attempt: int = 0,
+    ) -> List[bytes]:
+        """
+        Encodes `entries` as datagrams of type `datagram_cls`,
+        one per file in version 1 or batched up to UDP_BUFFER_SIZE in version 2.
+        The `load` hints, the `available` bytes and the `search_id` are only
+        sent in version 2, as well as the entries with digests of other
+        algorithms than DIGEST_ALG.
+        """
+        if proto_version < FileBatchStruct.PROTO_VERSION:
+            return [
+                datagram_cls(entry).to_bytes() for entry in entries if entry.fits_version_1
+            ]
+        max_size = UDP_BUFFER_SIZE - HeaderStruct.struct_size
+        return [
+            datagram_cls(batch).to_bytes()
+            for batch in FileBatchStruct.pack_entries(
+                entries, max_size, flags, load, available, search_id, attempt
+            )
+        ]
 
-        if file_digest != "" and not is_sha256(file_digest):
-            raise InvalidSearchArgsException("File is not sha256sum")
+    def _load_hints(self) -> LoadStruct:
+        """
+        Current upload load of this node, advertised to the searchers
+        """
+        return LoadStruct(*self._controller.get_load())
 
+    @staticmethod
+    def _find_targets(search: SearchContext, peers: Dict[str, Peer]) -> Set[str]:
+        """
+        Peers that might have the file, according to their catalog filters,
+        version 1 peers only knowing DIGEST_ALG digests
+        """
+        legacy = has_default_algorithm(search.file_digest)
+        return {
+            peer_ip
+            for (peer_ip, peer) in peers.items()
+            if peer.may_have(search.file_name, search.file_digest)
+            and (legacy or peer.proto_version >= FileBatchStruct.PROTO_VERSION)
+        }
+
+    def _send_find(self, searches: List[SearchContext]):
+        """
+        Sends FIND requests for the `searches` to the peers expected to answer:
+        by unicast to a few of them, or by broadcast otherwise.
+        The requests carry the id of the first search and the attempt number,
+        so that the peers replay their answer to a retry.
+        """
+        peers = self.known_peers
+        targets: Dict[str, List[FileDataStruct]] = {}
         with self._search_lock:
-            if file_name in self._search_results:
-                self._logger.warning(
-                    "Search | Attempted to search a file for which a search is already in progress"
+            for search in searches:
+                search.mark_sent()
+                entry = FileDataStruct(search.file_name, search.file_digest)
+                if search.started:
+                    peer_ips = search.missing_peers
+                else:
+                    peer_ips = self._find_targets(search, peers)
+                for peer_ip in peer_ips:
+                    targets.setdefault(peer_ip, []).append(entry)
+            search_id = searches[0].search_id
+            attempt = min(max(search.attempts for search in searches), 0xFF)
+
+        try:
+            if len(targets) <= UNICAST_FIND_LIMIT and all(
+                peer_ip in peers for peer_ip in targets
+            ):
+                for (peer_ip, entries) in targets.items():
+                    peer = peers[peer_ip]
+                    for datagram_bytes in self._file_datagrams(
+                        FindDatagram,
+                        entries,
+                        peer.proto_version,
+                        FileBatchStruct.FLAG_ACCEPTS_PARTIAL,
+                        search_id=search_id,
+                        attempt=attempt,
+                    ):
+                        self._unicast_socket.send_to(
+                            datagram_bytes, peer_ip, peer.unicast_port
+                        )
+                return
+
+            entries = [
+                FileDataStruct(search.file_name, search.file_digest)
+                for search in searches
+            ]
+            # version 1 peers would drop batched datagrams
+            batch_flags = FileBatchStruct.FLAG_FILTERED | FileBatchStruct.FLAG_ACCEPTS_PARTIAL
+            if self._peers_support(PROTO_VERSION):
+                datagrams = self._file_datagrams(
+                    FindDatagram,
+                    entries,
+                    PROTO_VERSION,
+                    batch_flags,
+                    search_id=search_id,
+                    attempt=attempt,
                 )
-                raise LogicError(
-                    f"There is another search for '{file_name}' in progress"
+            else:
+                datagrams = self._file_datagrams(FindDatagram, entries, MIN_PROTO_VERSION)
+                # the digests version 1 cannot carry are for the newer peers
+                newer_entries = [entry for entry in entries if not entry.fits_version_1]
+                if newer_entries:
+                    datagrams += self._file_datagrams(
+                        FindDatagram,
+                        newer_entries,
+                        PROTO_VERSION,
+                        batch_flags,
+                        search_id=search_id,
+                        attempt=attempt,
+                    )
+            for datagram_bytes in datagrams:
+                self._broadcast_socket.send(datagram_bytes)
+        except Exception as exc:
+            self._logger.error(f"Search | Error while sending FIND", exc_info=exc)
+
+    async def _run_search(self, searches: List[SearchContext]):
+        """
+        Runs the `searches` on the controller loop and publishes their results,
+        so that they do not depend on the loop of any of their callers
+        """
+        try:
+            await self._search(searches)
+        except BaseException as exc:
+            self._logger.error("Search | Search failed", exc_info=exc)
+            for search in searches:
+                if search.result.done():
+                    continue
+                with self._search_lock:
+                    if self._search_results.get(search.key) is search:
+                        self._search_results.pop(search.key)
+                    search.finish()
+                search.result.set_exception(
+                    LogicError(f"Search for '{search.key}' failed: {exc!r}")
                 )
-            self._search_results[file_name] = dict()
 
-        peers_available = set(self.known_peers.keys())
+    def _join_searches(
+        self,
+        queries: List[Tuple[str, str]],
+        listener: Callable[[Optional[FoundResponse]], None] = None,
+    ) -> List[SearchContext]:
+        """
+        Starts a search for every (name, digest) of `queries`
+        or attaches to the one in progress.
+        An empty name searches for any file with the digest.
+        The optional `listener` receives every positive response as it arrives
+        and None once the search is over.
+        """
+        for (file_name, file_digest) in queries:
+            if not file_name and not file_digest:
+                raise InvalidSearchArgsException("Filename and digest cannot both be empty")
+            if file_digest != "" and not is_digest(file_digest):
+                raise InvalidSearchArgsException("Invalid file digest")
+
+        searches = []
+        new_searches = []
+        widened_searches = []
+        peers = self.known_peers
+        with self._search_lock:
+            for (file_name, file_digest) in queries:
+                search_key = SearchContext.search_key(file_name, file_digest)
+                search = self._search_results.get(search_key)
+                if search is None:
+                    search = SearchContext(file_name, file_digest)
+                    self._search_results[search_key] = search
+                    new_searches.append(search)
+                elif search.join(file_digest):
+                    search.expect(self._find_targets(search, peers))
+                    widened_searches.append(search)
+                if listener:
+                    search.subscribe(listener)
+                searches.append(search)
+
+        if new_searches:
+            coro_in_background(self._run_search(new_searches), self._loop)
+        if len(new_searches) != len(searches):
+            self._logger.debug(
+                "Search | Joining %d searches in progress",
+                len(searches) - len(new_searches),
+            )
+        if widened_searches:
+            # the peers might have answered NOTFOUND for the other digest
+            self._loop.call_soon_threadsafe(self._send_widened, widened_searches)
+        return searches
 
-        def get_missing_peers():
-            peers_left = peers_available.copy()
-            with self._search_lock:
-                for provider_ip in self._search_results[file_name].keys():
-                    if provider_ip in peers_left:
-                        peers_left.remove(provider_ip)
-            return peers_left
+    def _send_widened(self, searches: List[SearchContext]):
+        """
+        Sends FIND requests for the widened `searches` on the controller loop.
+        The ones not started yet send the widened request first anyway,
+        the ones over by now need none.
+        """
+        with self._search_lock:
+            searches = [
+                search
+                for search in searches
+                if search.started and not search.result.done()
+            ]
+        if searches:
+            self._send_find(searches)
 
-        find_struct = FileDataStruct(file_name, file_digest)
-        find_datagram = FindDatagram(find_struct)
+    async def search(
+        self, file_name: str = None, file_digest: str = None
+    ) -> Dict[str, List[FoundResponse]]:
+        """
+        Searches the network for file `file_name` with optional `file_digest`,
+        or for any file with content `file_digest` if `file_name` is empty.
+        Concurrent searches for the same name share a single search
+        and all receive its result.
+        """
+        file_name = file_name or ""
+        file_digest = file_digest or ""
+        results = self._catalog_search(file_name, file_digest)
+        if results is not None:
+            return results
+        (search,) = self._join_searches([(file_name, file_digest)])
+        responses = await asyncio.wrap_future(search.result)
+        return SearchContext.group_by_digest(responses, file_digest)
+
+    def _catalog_search(
+        self, file_name: str, file_digest: str
+    ) -> Optional[Dict[str, List[FoundResponse]]]:
+        """
+        Answers a search from the replicated catalogs of the peers.
+        Returns None if the catalog of any peer that might have the file
+        is stale, the network has to be searched then.
+        Used by every search API, so that they all answer alike.
+        """
+        peers = self.known_peers
+        for (peer_ip, peer) in peers.items():
+            if peer.may_have(file_name, file_digest) and not self._replicated_catalog.is_fresh(peer_ip):
+                return None
+        results = dict()
+        for (origin, entry) in self._replicated_catalog.lookup(file_name, file_digest):
+            if origin not in peers:
+                continue
+            response = FoundResponse(
+                FileDataStruct(entry.name, entry.digest, entry.size),
+                origin,
+                True,
+                peers[origin].load,
+            )
+            results.setdefault(entry.digest, []).append(response)
+        self._logger.debug(
+            "Search | Answered %s from the replicated catalog",
+            SearchContext.search_key(file_name, file_digest),
+        )
+        return results
 
-        missing_peers = set()
+    def query_catalog(self, pattern: str) -> List[FoundResponse]:
+        """
+        Files shared by the known peers whose names match the shell-style `pattern`,
+        e.g. 'report-*'. Answered from the replicated catalogs only,
+        so files of the peers that do not replicate them are missing.
+        """
+        peers = self.known_peers
+        return [
+            FoundResponse(
+                FileDataStruct(entry.name, entry.digest, entry.size),
+                origin,
+                True,
+                peers[origin].load,
+            )
+            for (origin, entry) in self._replicated_catalog.query(pattern)
+            if origin in peers
+        ]
 
-        for retry in range(SEARCH_RETRIES + 1):
-            if len(missing_peers) != 0:
-                self._logger.info(
-                    "Search | %s peers did not respond, retrying search for file %s with optional digest %s (%s/%s)",
-                    len(missing_peers),
-                    file_name,
-                    file_digest,
-                    retry,
-                    SEARCH_RETRIES,
-                )
-            try:
-                self._broadcast_socket.send(find_datagram.to_bytes())
-            except Exception as exc:
-                self._logger.error(f"Search | Error while broadcasting", exc_info=exc)
+    async def search_many(
+        self, queries: List[Tuple[str, Optional[str]]]
+    ) -> Dict[str, Dict[str, List[FoundResponse]]]:
+        """
+        Searches the network for many files at once,
+        `queries` being a list of file names and optional digests.
+        Returns the search results by file name,
+        the ones searched by digest alone by their search key.
+        """
+        queries = [
+            (file_name or "", file_digest or "") for (file_name, file_digest) in queries
+        ]
+        results = dict()
+        network_queries = []
+        for (file_name, file_digest) in queries:
+            catalog_results = self._catalog_search(file_name, file_digest)
+            if catalog_results is None:
+                network_queries.append((file_name, file_digest))
+            else:
+                results[SearchContext.search_key(file_name, file_digest)] = catalog_results
+        if not network_queries:
+            return results
+        searches = self._join_searches(network_queries)
+        for ((file_name, file_digest), search) in zip(network_queries, searches):
+            responses = await asyncio.wrap_future(search.result)
+            results[search.key] = SearchContext.group_by_digest(responses, file_digest)
+        return results
+
+    async def search_stream(
+        self,
+        file_name: str = None,
+        file_digest: str = None,
+        max_providers: Optional[int] = None,
+        first_match: bool = False,
+    ) -> AsyncIterator[FoundResponse]:
+        """
+        Searches the network for file `file_name` with optional `file_digest`,
+        yielding the positive responses as they arrive.
+        Stops after `max_providers` responses, or after the first one
+        if `first_match` is set, or when the search is over.
+        """
+        file_name = file_name or ""
+        file_digest = file_digest or ""
+        if first_match:
+            max_providers = 1
+        catalog_results = self._catalog_search(file_name, file_digest)
+        if catalog_results is not None:
+            responses = [
+                response for responses in catalog_results.values() for response in responses
+            ]
+            for response in responses[:max_providers]:
+                yield response
+            return
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
 
-            # find and found callbacks are now working
-            await asyncio.sleep(FINDING_TIME)
+        def listener(response: Optional[FoundResponse]):
+            loop.call_soon_threadsafe(queue.put_nowait, response)
 
-            # check if all known peers responded and retry if not
-            missing_peers = get_missing_peers()
+        (search,) = self._join_searches([(file_name, file_digest)], listener)
+        yielded = 0
+        try:
+            while max_providers is None or yielded < max_providers:
+                response: FoundResponse = await queue.get()
+                if response is None:
+                    break
+                if file_digest and response.digest != file_digest:
+                    continue
+                yielded += 1
+                yield response
+        finally:
+            with self._search_lock:
+                search.unsubscribe(listener)
 
-            if len(missing_peers) == 0:
-                break
+    # UDP BROADCAST RECEIVE CALLBACKS
 
-        # delete peers that did not respond
-        for peer_ip in missing_peers:
-            self._logger.info("Search | Deleting unresponsive peer %s", peer_ip)
-            self.remove_peer(peer_ip)
+    @staticmethod
+    def inline_transfer_size() -> int:
+        """
+        Size up to which the files are sent and fetched inline, 0 if disabled
+        """
+        return min(Config().inline_transfer_size, INLINE_TRANSFER_MAX_SIZE)
 
-        # clear the dict indicating that the search is over
+    async def fetch(
+        self, peer_ip: str, file_name: str, file_digest: str, file_size: int
+    ) -> Optional[bytes]:
+        """
+        Asks peer `peer_ip` for the content of the small file `file_name`,
+        or of any file with content `file_digest` if the name is empty,
+        sent back inline in FETCHED datagrams.
+        Returns the content once it matches the digest, None if the peer
+        refused, did not answer in time or sent another content,
+        or if the request could not be sent.
+        """
+        peer = self.get_peer_by_ip(peer_ip)
+        if peer is None or peer.proto_version < FetchStruct.PROTO_VERSION:
+            return None
+        request_id = random.getrandbits(32)
+        fetch = FetchContext(peer_ip, file_digest, file_size)
+        datagram = FetchDatagram(
+            FetchStruct(request_id, FileDataStruct(file_name, file_digest, file_size))
+        ).to_bytes()
         with self._search_lock:
-            responses: Dict[str, FoundResponse] = self._search_results.pop(file_name)
-
-        results_dict = dict()
-        for response in responses.values():
-            if response.is_found:
-                results_dict.setdefault(response.digest, []).append(response)
-
-        self._logger.info(
-            "Search | Found %s in %d out of %d peers",
-            file_name,
-            sum(len(_list) for _list in results_dict.values()),
-            len(peers_available),
-        )
-        return results_dict
-
-    # UDP BROADCAST RECEIVE CALLBACKS
+            self._fetches[request_id] = fetch
+        try:
+            for retry in range(FETCH_RETRIES + 1):
+                with self._search_lock:
+                    fetch.sent()
+                    timeout = self._fetch_timeout(peer_ip, retry)
+                try:
+                    self._unicast_socket.send_to(datagram, peer_ip, peer.unicast_port)
+                except LogicError as exc:
+                    # the send queue is full under load, TCP does not wait for it
+                    self._logger.debug("Fetch | Cannot send FETCH to %s: %s", peer_ip, exc)
+                    return None
+                self._stats["fetch_sent"] += 1
+                try:
+                    # the fragments received so far are kept over the retries
+                    return await asyncio.wait_for(
+                        asyncio.shield(asyncio.wrap_future(fetch.result)), timeout
+                    )
+                except asyncio.TimeoutError:
+                    self._logger.debug(
+                        "Fetch | %s did not send %s in time (%s/%s)",
+                        peer_ip,
+                        file_name or file_digest,
+                        retry,
+                        FETCH_RETRIES,
+                    )
+            return None
+        finally:
+            with self._search_lock:
+                self._fetches.pop(request_id, None)
 
-    def hello_callback(self, datagram_bytes: bytes, address: Tuple[str, int]):
-        received_hello_datagram = HelloDatagram.from_bytes(datagram_bytes)
-        if received_hello_datagram is None:
+    def _fetch_timeout(self, peer_ip: str, retry: int) -> float:
+        """
+        Time to wait for the content, doubled with every retry.
+        Does not perform locking.
+        """
+        rtt = self._peer_rtt.get(peer_ip)
+        timeout = rtt.rto if rtt is not None else FINDING_TIME
+        return min(timeout * 2 ** retry, FINDING_TIME)
+
+    def hello_callback(
+        self, received_hello_datagram: HelloDatagram, address: Tuple[str, int]
+    ):
+        self._stats["hello_received"] += 1
+        hello_struct: HelloStruct = received_hello_datagram.message
+        if hello_struct.unicast_port is None:
+            # a version 1 peer only listens to broadcasts
+            self._logger.debug("Hello | Responding with HERE to new peer %s", address[0])
+            self._advertise()
             return
-        self._logger.debug("Hello | Responding with HERE to new peer %s", address[0])
-        here_datagram = HereDatagram()
-        self._broadcast_socket.send(here_datagram.to_bytes())
 
-    def here_callback(self, datagram_bytes: bytes, address: Tuple[str, int]):
-        received_here_datagram = HereDatagram.from_bytes(datagram_bytes)
+        if hello_struct.wants_peers:
+            # only a few peers answer, the joiner learns the others from their lists
+            responders = PEER_LIST_RESPONDERS / max(len(self.known_peers), 1)
+            if random.random() >= responders:
+                return
+
+        # spread the answers of the peers over time
+        self._loop.call_later(
+            random.uniform(0, HELLO_REPLY_JITTER),
+            self._answer_hello,
+            address[0],
+            hello_struct.unicast_port,
+            hello_struct.wants_peers,
+        )
 
-        if received_here_datagram is None:
+    def _answer_hello(self, ip_address: str, unicast_port: int, wants_peers: bool):
+        """
+        Sends a HERE message, and optionally the peer list, to the joiner
+        """
+        self._logger.debug("Hello | Responding with HERE to new peer %s", ip_address)
+        try:
+            self._unicast_socket.send_to(self._here_datagram(), ip_address, unicast_port)
+            self._stats["here_unicast_sent"] += 1
+            if not wants_peers:
+                return
+            peers = [
+                (peer.ip_address, peer.unicast_port, peer.tcp_port, peer.proto_version)
+                for peer in self.known_peers.values()
+                if peer.ip_address != ip_address
+            ]
+            max_entries = PeerListStruct.max_entries(
+                UDP_BUFFER_SIZE - HeaderStruct.struct_size
+            )
+            for start in range(0, len(peers), max_entries):
+                peers_struct = PeerListStruct(peers[start:start + max_entries])
+                self._unicast_socket.send_to(
+                    PeerListDatagram(peers_struct).to_bytes(), ip_address, unicast_port
+                )
+                self._stats["peers_sent"] += 1
+        except Exception as exc:
+            self._logger.error("Hello | Error while answering HELLO", exc_info=exc)
+
+    def peer_list_callback(
+        self, received_peers_datagram: PeerListDatagram, address: Tuple[str, int]
+    ):
+        if self.get_peer_by_ip(address[0]) is None:
+            self._logger.debug(
+                "Peers | Received datagram from unknown host %s, skipping", address[0]
+            )
             return
+        local_addresses = local_ip4_addresses()
+        now = time.monotonic()
+        deadline = now + self.peer_timeout
+        with self._known_peers_lock:
+            peers = dict(self._known_peers)
+            for (ip_address, unicast_port, tcp_port, proto_version) in (
+                received_peers_datagram.message.peers
+            ):
+                if ip_address in peers or ip_address in local_addresses:
+                    continue
+                # the catalog filter comes with the next HERE of the peer
+                peers[ip_address] = Peer(
+                    ip_address=ip_address,
+                    tcp_port=tcp_port,
+                    unicast_port=unicast_port,
+                    last_seen=now,
+                    proto_version=proto_version,
+                )
+                self._peer_expiry.add(ip_address, deadline)
+                self._stats["peers_learned"] += 1
+                self._logger.debug("Peers | Learned peer %s from %s", ip_address, address[0])
+            if len(peers) != len(self._known_peers):
+                self._known_peers = MappingProxyType(peers)
+
+    def here_callback(
+        self, received_here_datagram: HereDatagram, address: Tuple[str, int]
+    ):
+        self._stats["here_received"] += 1
         here_struct: HereStruct = received_here_datagram.message
 
         ip_address = address[0]
 
+        catalog_filter = None
+        if here_struct.catalog_filter is not None:
+            try:
+                catalog_filter = BloomFilter.from_bytes(here_struct.catalog_filter)
+            except Exception:
+                self._logger.warning("Here | Invalid catalog filter from peer %s", address[0])
+
         with self._known_peers_lock:
-            is_new = ip_address not in self._known_peers
-            self._known_peers[ip_address] = Peer(
-                ip_address=ip_address,
-                tcp_port=here_struct.tcp_port,
-                unicast_port=here_struct.unicast_port,
-                last_updated=datetime.datetime.now(),
-            )
+            peer = self._known_peers.get(ip_address)
+            is_new = peer is None
+            if (
+                not is_new
+                and peer.tcp_port == here_struct.tcp_port
+                and peer.unicast_port == here_struct.unicast_port
+                and peer.proto_version == here_struct.proto_version
+                and peer.catalog_filter == catalog_filter
+            ):
+                # unchanged peer, the snapshot is kept
+                peer.touch()
+                peer.load = here_struct.load
+            else:
+                peer = Peer(
+                    ip_address=ip_address,
+                    tcp_port=here_struct.tcp_port,
+                    unicast_port=here_struct.unicast_port,
+                    last_seen=time.monotonic(),
+                    proto_version=here_struct.proto_version,
+                    catalog_filter=catalog_filter,
+                    load=here_struct.load,
+                )
+                peers = dict(self._known_peers)
+                peers[ip_address] = peer
+                self._known_peers = MappingProxyType(peers)
+                if is_new:
+                    self._peer_expiry.add(ip_address, peer.last_seen + self.peer_timeout)
             self._logger.debug(
                 "Here | Received HERE message from peer %s:%s", address[0], address[1]
             )
         if is_new:
             self._logger.debug("Here | Discovered peer %s:%s", address[0], address[1])
 
-    def find_callback(self, datagram_bytes: bytes, address: Tuple[str, int]):
-        # check if datagram is of type FindDatagram
-        received_find_datagram = FindDatagram.from_bytes(datagram_bytes)
-        if received_find_datagram is None:
-            return
-        find_struct: FileDataStruct = received_find_datagram.message
-        # check if peer is known
-        ip_address = address[0]
-        peer: Peer = self.get_peer_by_ip(ip_address)
-        if peer is None:
-            self._logger.debug(
-                "Find | Received datagram from unknown host %s, skipping", address[0]
-            )
-            return
-
-        self._logger.debug("Find | Received datagram from %s", address[0])
+        catalog_version = here_struct.catalog_version
+        if catalog_version is not None and self._replicated_catalog.advertise(
+            ip_address, *catalog_version
+        ):
+            self._send_catalog_sync(peer)
 
+    def _lookup_file(self, find_struct: FileDataStruct) -> Optional[FileDataStruct]:
+        """
+        Returns the description of a shareable local file matching the FIND entry,
+        an entry without a name matches any file with the digest
+        """
         try:
-            file: FileMetadata = self._controller.get_file(find_struct.file_name)
+            if find_struct.file_name:
+                file: FileMetadata = self._controller.get_file(find_struct.file_name)
+            else:
+                file: FileMetadata = next(
+                    file
+                    for file in self._controller.get_files_by_digest(find_struct.file_digest)
+                    if file.can_share
+                )
             if not file.can_share:
                 raise LogicError("File is not shareable")
             target_digest: str = find_struct.file_digest
             if target_digest and file.digest != target_digest:
                 self._logger.warning(
                     "Find | Asked for file %s with digest %.8s, but local is %.8s",
+                    find_struct.file_name,
                     target_digest,
                     file.digest,
                 )
                 raise LogicError("Hash mismatch")
-            response_datagram = FoundDatagram(
-                FileDataStruct(file.name, file.digest, file.size)
-            )
-            self._logger.debug(
-                "Find | Sending positive reply for file %s with digest %.8s",
-                file.name,
-                file.digest,
-            )
-        except Exception as ex:
-            response_datagram = NotFoundDatagram(find_struct)
+        except Exception:
             self._logger.debug(
                 "Find | Sending negative reply for file %s with digest %.8s",
                 find_struct.file_name,
                 find_struct.file_digest,
             )
+            return None
+        self._logger.debug(
+            "Find | Sending positive reply for file %s with digest %.8s",
+            file.name,
+            file.digest,
+        )
+        return FileDataStruct(file.name, file.digest, file.size)
 
-        unicast_port = peer.unicast_port
-        self._unicast_socket.send_to(
-            response_datagram.to_bytes(), ip_address, unicast_port
+    def _lookup_partial(
+        self, find_struct: FileDataStruct
+    ) -> Optional[Tuple[FileDataStruct, int]]:
+        """
+        Returns the description of a local file still downloading
+        that matches the FIND entry, with its verified bytes
+        """
+        if find_struct.file_name:
+            try:
+                files = [self._controller.get_file(find_struct.file_name)]
+            except Exception:
+                return None
+        else:
+            files = self._controller.get_files_by_digest(find_struct.file_digest)
+        for file in files:
+            if file.status != FileStatus.DOWNLOADING or not file.digest:
+                continue
+            if find_struct.file_digest and file.digest != find_struct.file_digest:
+                continue
+            have = self._controller.get_have(file.name)
+            if have is not None and have.verified_bytes > 0:
+                return (FileDataStruct(file.name, file.digest, file.size), have.verified_bytes)
+        return None
+
+    def find_callback(
+        self,
+        received_find_datagram: FindDatagram,
+        address: Tuple[str, int],
+        unicast: bool = False,
+    ):
+        # check if peer is known
+        ip_address = address[0]
+        peer: Peer = self.get_peer_by_ip(ip_address)
+        if peer is None:
+            self._logger.debug(
+                "Find | Received datagram from unknown host %s, skipping", address[0]
+            )
+            return
+
+        self._logger.debug("Find | Received datagram from %s", address[0])
+        self._stats["find_received"] += 1
+        now = time.monotonic()
+        find_message = received_find_datagram.message
+        proto_version = received_find_datagram.header.proto_version
+
+        # retries of a search already answered are not looked up again,
+        # older searchers send no search id, their repeats are all retries
+        (search_id, attempt) = (None, 0)
+        if isinstance(find_message, FileBatchStruct):
+            (search_id, attempt) = (find_message.search_id, find_message.attempt)
+        request_key = (
+            ip_address,
+            proto_version,
+            search_id,
+            tuple((entry.file_name, entry.file_digest) for entry in find_message.entries),
         )
+        self._expire_find_replies(now)
+        reply = self._find_replies.get(request_key)
+        if reply is not None:
+            (_, answered_attempt, reply_datagrams) = reply
+            if reply_datagrams is None or (
+                search_id is not None and attempt <= answered_attempt
+            ):
+                self._stats["find_duplicate"] += 1
+                return
+            # asked again, so the searcher missed the reply
+            self._stats["find_replayed"] += 1
+            self._reply_find(request_key, attempt, peer.unicast_port, reply_datagrams, unicast)
+            return
 
-    # UDP UNICAST RECEIVE CALLBACKS
+        bucket = self._find_buckets.get(ip_address)
+        if bucket is None:
+            bucket = self._find_buckets[ip_address] = TokenBucket(FIND_RATE, FIND_BURST)
+        if not bucket.take(now):
+            self._stats["find_shed"] += 1
+            self._logger.debug("Find | Shedding datagram from %s over the rate limit", ip_address)
+            return
+
+        # the searcher does not await NOTFOUND for files absent from our filter
+        advertised_filter = self._advertised_filter
+        skip_absent = (
+            isinstance(find_message, FileBatchStruct)
+            and find_message.flags & FileBatchStruct.FLAG_FILTERED
+            and advertised_filter is not None
+        )
+        # the searcher also takes the files we are still downloading
+        accepts_partial = isinstance(find_message, FileBatchStruct) and bool(
+            find_message.flags & FileBatchStruct.FLAG_ACCEPTS_PARTIAL
+        )
 
-    def found_callback(self, datagram_bytes: bytes, address: Tuple[str, int]):
-        # check if datagram is of type FoundDatagram
-        received_found_datagram = FoundDatagram.from_bytes(datagram_bytes)
-        if received_found_datagram is None:
+        found_entries = []
+        partial_entries = []
+        available = []
+        not_found_entries = []
+        for find_struct in find_message.entries:
+            found_struct = self._lookup_file(find_struct)
+            partial_found = None
+            if found_struct is None and accepts_partial:
+                partial_found = self._lookup_partial(find_struct)
+            if found_struct is not None:
+                found_entries.append(found_struct)
+            elif partial_found is not None:
+                partial_entries.append(partial_found[0])
+                available.append(partial_found[1])
+            elif not skip_absent or advertised_filter.might_contain(
+                find_struct.file_name, find_struct.file_digest
+            ):
+                not_found_entries.append(find_struct)
+
+        # answer in the version of the request, FOUND tells how busy we are
+        load = self._load_hints() if found_entries or partial_entries else None
+        reply_datagrams = (
+            self._file_datagrams(FoundDatagram, found_entries, proto_version, load=load)
+            + self._file_datagrams(
+                FoundDatagram,
+                partial_entries,
+                proto_version,
+                load=load,
+                available=available,
+            )
+            + self._file_datagrams(NotFoundDatagram, not_found_entries, proto_version)
+        )
+        self._reply_find(request_key, attempt, peer.unicast_port, reply_datagrams, unicast)
+
+    def _reply_find(
+        self,
+        request_key: tuple,
+        attempt: int,
+        unicast_port: int,
+        reply_datagrams: List[bytes],
+        unicast: bool,
+    ):
+        """
+        Sends the reply to a FIND at once if it was sent by unicast,
+        otherwise every peer got the broadcast and their replies are spread over time
+        """
+        if unicast:
+            self._send_find_reply(request_key, attempt, unicast_port, reply_datagrams)
             return
+        self._find_replies[request_key] = (time.monotonic(), attempt, None)
+        self._find_replies.move_to_end(request_key)
+        self._loop.call_later(
+            random.uniform(0, FIND_REPLY_JITTER),
+            self._send_find_reply,
+            request_key,
+            attempt,
+            unicast_port,
+            reply_datagrams,
+        )
+
+    def _send_find_reply(
+        self,
+        request_key: tuple,
+        attempt: int,
+        unicast_port: int,
+        reply_datagrams: List[bytes],
+    ):
+        ip_address = request_key[0]
+        self._find_replies[request_key] = (time.monotonic(), attempt, reply_datagrams)
+        self._find_replies.move_to_end(request_key)
+        try:
+            for datagram_bytes in reply_datagrams:
+                self._unicast_socket.send_to(datagram_bytes, ip_address, unicast_port)
+        except Exception as exc:
+            self._logger.error("Find | Error while answering %s", ip_address, exc_info=exc)
+
+    def _expire_find_replies(self, now: float):
+        """
+        Forgets the replies older than FIND_DUPLICATE_WINDOW, oldest first
+        """
+        while self._find_replies:
+            (answered_at, _, _) = next(iter(self._find_replies.values()))
+            if now - answered_at <= FIND_DUPLICATE_WINDOW:
+                return
+            self._find_replies.popitem(last=False)
+
+    # UDP UNICAST RECEIVE CALLBACKS
+
+    def found_callback(
+        self, received_found_datagram: FoundDatagram, address: Tuple[str, int]
+    ):
 
         provider_ip = address[0]
 
@@ -357,32 +1098,43 @@ class UdpController:
             )
             return
 
-        # create found_response
-        found_response = FoundResponse(
-            received_found_datagram.message, provider_ip, True
-        )
-
-        # add provider to the set
-        with self._search_lock:
-            result_peers = self._search_results.get(found_response.name)
-            if result_peers is not None:
-                result_peers[provider_ip] = found_response
-
-        self._logger.debug(
-            "Found | Found file %s with digest %.8s, of size %s, peer %s",
-            found_response.name,
-            found_response.digest,
-            found_response.file_size,
-            provider_ip,
-        )
+        found_message = received_found_datagram.message
+        load = None
+        available = None
+        if isinstance(found_message, FileBatchStruct):
+            load = found_message.load
+            available = found_message.available
+        for (index, found_struct) in enumerate(found_message.entries):
+            # create found_response
+            found_response = FoundResponse(
+                found_struct,
+                provider_ip,
+                True,
+                load,
+                available[index] if available is not None else None,
+            )
 
-    def not_found_callback(self, datagram_bytes: bytes, address: Tuple[str, int]):
+            # add provider to the searches for the name and for the content
+            with self._search_lock:
+                for search_key in (
+                    found_response.name,
+                    SearchContext.search_key("", found_response.digest),
+                ):
+                    search = self._search_results.get(search_key)
+                    if search is not None:
+                        self._update_rtt(provider_ip, search.add_response(found_response))
 
-        # check if datagram is of type FoundDatagram
-        received_not_found_datagram = NotFoundDatagram.from_bytes(datagram_bytes)
-        if received_not_found_datagram is None:
-            return
+            self._logger.debug(
+                "Found | Found file %s with digest %.8s, of size %s, peer %s",
+                found_response.name,
+                found_response.digest,
+                found_response.file_size,
+                provider_ip,
+            )
 
+    def not_found_callback(
+        self, received_not_found_datagram: NotFoundDatagram, address: Tuple[str, int]
+    ):
         provider_ip = address[0]
 
         # check if provider is in known peers
@@ -392,53 +1144,364 @@ class UdpController:
             )
             return
 
-        # create find_response
-        not_found_response = FoundResponse(
-            received_not_found_datagram.message, provider_ip, False
+        for not_found_struct in received_not_found_datagram.message.entries:
+            # create find_response
+            not_found_response = FoundResponse(not_found_struct, provider_ip, False)
+
+            # add provider to the search
+            with self._search_lock:
+                search = self._search_results.get(
+                    SearchContext.search_key(
+                        not_found_response.name, not_found_response.digest
+                    )
+                )
+                if search is not None:
+                    # a NOTFOUND never replaces a FOUND from the same peer
+                    self._update_rtt(provider_ip, search.add_response(not_found_response))
+            self._logger.debug(
+                "NotFound | Did not find file %s with optional digest %.8s, peer %s",
+                not_found_response.name,
+                not_found_response.digest,
+                provider_ip,
+            )
+
+    def catalog_sync_callback(
+        self, received_sync_datagram: CatalogSyncDatagram, address: Tuple[str, int]
+    ):
+        ip_address = address[0]
+        peer: Peer = self.get_peer_by_ip(ip_address)
+        if peer is None:
+            self._logger.debug(
+                "Sync | Received datagram from unknown host %s, skipping", ip_address
+            )
+            return
+        sync_struct: CatalogSyncStruct = received_sync_datagram.message
+        catalog = self._replicated_catalog
+        catalog.record_sync(
+            ip_address,
+            sync_struct.your_incarnation,
+            sync_struct.your_version,
+            sync_struct.versions,
+        )
+
+        # send the changes of every catalog the peer is behind on
+        max_size = UDP_BUFFER_SIZE - HeaderStruct.struct_size
+        known = dict(sync_struct.versions)
+        known[None] = (sync_struct.your_incarnation, sync_struct.your_version)
+        deltas = []
+        for origin in [None, *catalog.version_vector()]:
+            if origin == ip_address:
+                continue
+            changes = catalog.delta(origin, *known.get(origin, (None, 0)))
+            if changes is not None:
+                deltas += CatalogDeltaStruct.pack_delta(origin, *changes, max_size)
+        self._logger.debug("Sync | Sending %d deltas to %s", len(deltas), ip_address)
+        for delta in deltas:
+            self._unicast_socket.send_to(
+                CatalogDeltaDatagram(delta).to_bytes(), ip_address, peer.unicast_port
+            )
+
+        # pull the changes of the peer if it advanced
+        if catalog.advertise(
+            ip_address, sync_struct.sender_incarnation, sync_struct.sender_version
+        ):
+            self._send_catalog_sync(peer)
+
+    def catalog_delta_callback(
+        self, received_delta_datagram: CatalogDeltaDatagram, address: Tuple[str, int]
+    ):
+        ip_address = address[0]
+        if self.get_peer_by_ip(ip_address) is None:
+            self._logger.debug(
+                "Delta | Received datagram from unknown host %s, skipping", ip_address
+            )
+            return
+        delta_struct: CatalogDeltaStruct = received_delta_datagram.message
+        origin = delta_struct.origin or ip_address
+        if not self._replicated_catalog.apply(
+            origin,
+            delta_struct.incarnation,
+            delta_struct.from_version,
+            delta_struct.to_version,
+            delta_struct.entries,
+            relayed=delta_struct.origin is not None,
+        ):
+            # a previous delta was lost, the next sync resends it
+            self._logger.debug(
+                "Delta | Skipping disconnected delta of %s from %s", origin, ip_address
+            )
+            return
+        self._logger.debug(
+            "Delta | Catalog of %s updated to version %d",
+            origin,
+            delta_struct.to_version,
         )
 
-        # add provider to the set
-        with self._search_lock:
-            result_peers = self._search_results.get(not_found_response.name)
-            if result_peers is not None and provider_ip not in result_peers:
-                # insert the peer response only if this peer was not present
-                result_peers[provider_ip] = not_found_response
+    def fetch_callback(
+        self, received_fetch_datagram: FetchDatagram, address: Tuple[str, int]
+    ):
+        ip_address = address[0]
+        peer: Peer = self.get_peer_by_ip(ip_address)
+        if peer is None:
+            self._logger.debug(
+                "Fetch | Received datagram from unknown host %s, skipping", ip_address
+            )
+            return
+        self._stats["fetch_received"] += 1
+        fetch_struct: FetchStruct = received_fetch_datagram.message
+
+        # every fragment costs as much as a FIND
+        bucket = self._find_buckets.get(ip_address)
+        if bucket is None:
+            bucket = self._find_buckets[ip_address] = TokenBucket(FIND_RATE, FIND_BURST)
+        if not bucket.take():
+            self._stats["fetch_shed"] += 1
+            self._logger.debug("Fetch | Shedding datagram from %s over the rate limit", ip_address)
+            return
+
+        content = self._read_inline(fetch_struct.entry)
+        fragments = []
+        if content is not None:
+            fragments = FetchedStruct.fragments(fetch_struct.request_id, content)
+            # the first fragment was paid for by the request,
+            # the peer downloads the file over TCP instead of waiting
+            if not all(bucket.take() for _ in fragments[1:]):
+                self._stats["fetch_shed"] += 1
+                fragments = []
+        if not fragments:
+            fragments = [FetchedStruct(fetch_struct.request_id, 0, 0, 0)]
         self._logger.debug(
-            "NotFound | Did not find file %s with optional digest %.8s, peer %s",
-            not_found_response.name,
-            not_found_response.digest,
-            provider_ip,
+            "Fetch | Sending %s to %s in %d datagrams",
+            fetch_struct.entry.file_name or fetch_struct.entry.file_digest,
+            ip_address,
+            len(fragments) if fragments[0].count else 0,
+        )
+        for fragment in fragments:
+            self._unicast_socket.send_to(
+                FetchedDatagram(fragment).to_bytes(), ip_address, peer.unicast_port
+            )
+
+    def _read_inline(self, fetch_entry: FileDataStruct) -> Optional[bytes]:
+        """
+        Content of the shareable local file matching the FETCH entry,
+        None if there is none or it is too large to be sent inline
+        """
+        if not fetch_entry.file_digest:
+            return None
+        file_struct = self._lookup_file(fetch_entry)
+        if file_struct is None or file_struct.file_size > self.inline_transfer_size():
+            return None
+        try:
+            file: FileMetadata = self._controller.get_file(file_struct.file_name)
+            with open(file.path, "rb") as f:
+                content = f.read(file_struct.file_size + 1)
+        except Exception as exc:
+            self._logger.debug("Fetch | Cannot read %s", file_struct.file_name, exc_info=exc)
+            return None
+        # changed since it was hashed, the TCP transfer finds out
+        return content if len(content) == file_struct.file_size else None
+
+    def fetched_callback(
+        self, received_fetched_datagram: FetchedDatagram, address: Tuple[str, int]
+    ):
+        fetched: FetchedStruct = received_fetched_datagram.message
+        with self._search_lock:
+            fetch = self._fetches.get(fetched.request_id)
+            if fetch is None or fetch.peer_ip != address[0]:
+                return
+            self._update_rtt(address[0], fetch.add_fragment(fetched))
+
+    def _send_catalog_sync(self, peer: Peer):
+        """
+        Asks `peer` for the catalog changes missing in the local replicas
+        """
+        if peer.proto_version < CatalogSyncStruct.PROTO_VERSION:
+            return
+        catalog = self._replicated_catalog
+        versions = catalog.version_vector()
+        (your_incarnation, your_version) = versions.pop(peer.ip_address, (0, 0))
+        max_entries = CatalogSyncStruct.max_entries(UDP_BUFFER_SIZE - HeaderStruct.struct_size)
+        if len(versions) > max_entries:
+            # the other catalogs are synced in the next rounds
+            versions = dict(random.sample(list(versions.items()), max_entries))
+        sync_struct = CatalogSyncStruct(
+            catalog.own_incarnation,
+            catalog.own_version,
+            your_incarnation,
+            your_version,
+            versions,
         )
+        try:
+            self._unicast_socket.send_to(
+                CatalogSyncDatagram(sync_struct).to_bytes(),
+                peer.ip_address,
+                peer.unicast_port,
+            )
+        except Exception as exc:
+            self._logger.error("Sync | Error while sending SYNC", exc_info=exc)
+
+    async def _serve_gossip_agent(self):
+        """
+        agent that syncs the replicated catalogs with a random peer
+        every CATALOG_GOSSIP_PERIOD seconds and purges the replicated tombstones
+        """
+        while True:
+            await asyncio.sleep(CATALOG_GOSSIP_PERIOD)
+            peers = [
+                peer
+                for peer in self.known_peers_list
+                if peer.proto_version >= CatalogSyncStruct.PROTO_VERSION
+            ]
+            if peers:
+                self._send_catalog_sync(random.choice(peers))
+            # the tombstones every replicating peer has are no longer needed
+            self._replicated_catalog.purge(peer.ip_address for peer in peers)
 
     def remove_peer(self, peer_ip):
+        self._replicated_catalog.drop(peer_ip)
+        self._find_buckets.pop(peer_ip, None)
+        with self._search_lock:
+            self._peer_rtt.pop(peer_ip, None)
         with self._known_peers_lock:
-            return self._known_peers.pop(peer_ip)
+            if peer_ip not in self._known_peers:
+                return None
+            peers = dict(self._known_peers)
+            peer = peers.pop(peer_ip)
+            self._known_peers = MappingProxyType(peers)
+            self._peer_expiry.discard(peer_ip)
+            return peer
+
+    def _peer_seen(self, address: Tuple[str, int]):
+        """
+        Called for every received datagram, keeps the sender alive
+        """
+        peer = self._known_peers.get(address[0])
+        if peer is not None:
+            peer.touch()
 
     async def _serve_alive_agent(self):
         """
         thread target:
-        agent that broadcasts HERE messages every 10 seconds
-        and deletes peers older than 30 seconds
+        agent that broadcasts HERE messages every `heartbeat_interval`,
+        with a random phase so that the peers started together drift apart
         """
-        here_bytes = HereDatagram().to_bytes()
         while True:
             self._logger.debug("AliveAgent | Broadcasting HERE message")
-            try:
-                self._broadcast_socket.send(here_bytes)
-            except Exception as exc:
-                self._logger.error("AliveAgent | Error while broadcasting HERE", exc_info=exc)
-            self._delete_old_peers()
-            await asyncio.sleep(UDP_ADVERTISE_PERIOD)
+            self._advertise()
+            interval = self.heartbeat_interval
+            # the replicas are refreshed by the HERE messages of their peers
+            self._replicated_catalog.stale_after = (
+                CATALOG_STALE_AFTER * interval / UDP_ADVERTISE_PERIOD
+            )
+            await asyncio.sleep(
+                interval * random.uniform(1 - UDP_ADVERTISE_JITTER, 1 + UDP_ADVERTISE_JITTER)
+            )
+
+    async def _serve_expiry_agent(self):
+        """
+        thread target:
+        agent that removes the peers not heard of for `peer_timeout`
+        """
+        while True:
+            self._expire_peers()
+            await asyncio.sleep(UDP_PEER_EXPIRY_TICK)
+
+    def _advertise(self):
+        """
+        Broadcasts a HERE message with the current catalog filter
+        """
+        if self._advertise_handle is not None:
+            self._advertise_handle.cancel()
+            self._advertise_handle = None
+        catalog_filter = self._catalog.snapshot
+        try:
+            self._broadcast_socket.send(self._here_datagram(catalog_filter))
+            self._advertised_filter = catalog_filter
+            self._stats["here_broadcast_sent"] += 1
+        except Exception as exc:
+            self._logger.error("AliveAgent | Error while broadcasting HERE", exc_info=exc)
+
+    def _here_datagram(self, catalog_filter: Optional[BloomFilter] = None) -> bytes:
+        """
+        Encodes a HERE message, with the last advertised catalog filter by default
+        """
+        catalog_filter = catalog_filter or self._advertised_filter or self._catalog.snapshot
+        return HereDatagram.with_catalog(
+            catalog_filter.to_bytes(),
+            self._replicated_catalog.own_incarnation,
+            self._replicated_catalog.own_version,
+            self._load_hints(),
+        ).to_bytes()
+
+    def _schedule_advertise(self):
+        """
+        Advertises the changed catalog soon, coalescing bursts of changes
+        """
+        if self._advertise_handle is None:
+            self._advertise_handle = self._loop.call_later(
+                CATALOG_ADVERTISE_DELAY, self._advertise
+            )
+
+    def catalog_add(self, name: str, digest: Optional[str] = None):
+        """
+        Adds a local file to the advertised catalog
+        """
+        self._catalog.add(name, digest)
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._schedule_advertise)
+
+    def catalog_remove(self, name: str, digest: Optional[str] = None):
+        """
+        Removes a local file from the advertised catalog
+        """
+        self._catalog.remove(name, digest)
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._schedule_advertise)
+
+    def share_file(self, name: str, digest: str, size: int):
+        """
+        Publishes a shareable local file in the replicated catalog
+        """
+        self._replicated_catalog.share(name, digest, size)
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._schedule_advertise)
 
-    def _delete_old_peers(self):
+    def unshare_file(self, name: str):
         """
-        deletes peers older than 30 seconds
+        Withdraws a local file from the replicated catalog
         """
-        now = datetime.datetime.now()
+        self._replicated_catalog.unshare(name)
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._schedule_advertise)
+
+    def _expire_peers(self):
+        """
+        Removes the peers whose deadline came due on the timing wheel,
+        the peers seen in the meantime are scheduled again
+        """
+        now = time.monotonic()
+        timeout = self.peer_timeout
+        expired = []
         with self._known_peers_lock:
-            peers = self._known_peers
-            for peer_ip in list(peers.keys()):
-                diff = now - peers[peer_ip].last_updated
-                if diff.total_seconds() > UDP_PEER_CLEANUP_PERIOD:
-                    self._logger.info("Removing peer %s because of inactivity", peer_ip)
-                    peers.pop(peer_ip)  # delete peer from the list
+            for peer_ip in self._peer_expiry.advance(now):
+                peer = self._known_peers.get(peer_ip)
+                if peer is None:
+                    continue
+                deadline = peer.last_seen + timeout
+                if deadline > now:
+                    self._peer_expiry.add(peer_ip, deadline)
+                else:
+                    expired.append(peer_ip)
+            if not expired:
+                return
+            peers = dict(self._known_peers)
+            for peer_ip in expired:
+                del peers[peer_ip]
+            self._known_peers = MappingProxyType(peers)
+
+        for peer_ip in expired:
+            self._logger.info("Removing peer %s because of inactivity", peer_ip)
+            self._replicated_catalog.drop(peer_ip)
+            self._find_buckets.pop(peer_ip, None)
+            with self._search_lock:
+                self._peer_rtt.pop(peer_ip, None)
@@ -3,19 +3,36 @@ import logging
 import queue
 import random
 import socket
+import struct
 import sys
+import threading
 from asyncio import AbstractEventLoop, Future
-from typing import Tuple, Callable
+from typing import Callable, Dict, List, Optional, Tuple
 
 from simple_p2p.common.config import *
 from simple_p2p.common.tasks import new_loop
-from simple_p2p.common.utils import all_ip4_addresses
+from simple_p2p.common.utils import get_ip4_address, local_ip4_addresses
+from simple_p2p.udp.datagrams import Datagram
+from simple_p2p.udp.message_type import MessageType
+from simple_p2p.udp.structs import HeaderStruct, InvalidHeaderException
+from simple_p2p.udp.token_bucket import TokenBucket
+
+MessageHandler = Callable[[Datagram, Tuple[str, int]], None]
+ReceiveCallback = Callable[[Tuple[str, int]], None]
 
 
 class AsyncioDatagramProtocol(asyncio.DatagramProtocol):
-    def __init__(self, receive_callbacks, broadcast_mode=False):
+    def __init__(
+        self,
+        handlers: Dict[MessageType, MessageHandler],
+        broadcast_mode=False,
+        writing_callback: Optional[Callable[[bool], None]] = None,
+        receive_callback: Optional[ReceiveCallback] = None,
+    ):
         self._logger = logging.getLogger("AsyncioDatagramProtocol")
-        self._receive_callbacks = receive_callbacks
+        self._handlers = handlers
+        self._receive_callback = receive_callback
+        self._writing_callback = writing_callback
         self._broadcast_mode = broadcast_mode
         self._drop_counter = 0
         self.transport = None
@@ -32,10 +49,24 @@ class AsyncioDatagramProtocol(asyncio.DatagramProtocol):
     def connection_made(self, transport):
         self.transport = transport
 
+    def pause_writing(self):
+        # the socket buffer is full
+        self._logger.debug("Pausing UDP writes")
+        if self._writing_callback:
+            self._writing_callback(False)
+
+    def resume_writing(self):
+        self._logger.debug("Resuming UDP writes")
+        if self._writing_callback:
+            self._writing_callback(True)
+
+    def error_received(self, exc):
+        self._logger.warning("UDP send failed: %s", exc)
+
     def datagram_received(self, data, address):
         if BROADCAST_OMIT_SELF:
             # drop broadcasts coming from us
-            if address[0] in all_ip4_addresses():
+            if address[0] in local_ip4_addresses():
                 return
 
         # drop broadcast by chance
@@ -54,12 +85,25 @@ class AsyncioDatagramProtocol(asyncio.DatagramProtocol):
                 self._drop_counter -= 1
                 return
 
-        # run callbacks
-        for callback in self._receive_callbacks:
-            try:
-                callback(data, address)
-            except Exception as exc:
-                self._logger.error("Error while executing UDP callback", exc_info=exc)
+        # parse the header once and pass the datagram to the handler of its type
+        try:
+            view = memoryview(data)
+            header = HeaderStruct.from_bytes(view)
+            if self._receive_callback:
+                # any valid datagram tells that the sender is alive
+                self._receive_callback(address)
+            handler = self._handlers.get(header.message_type)
+            if handler is None:
+                return
+            datagram = Datagram.from_header(header, view)
+        except (InvalidHeaderException, struct.error) as exc:
+            self._logger.debug("Dropping invalid datagram from %s: %s", address[0], exc)
+            return
+
+        try:
+            handler(datagram, address)
+        except Exception as exc:
+            self._logger.error("Error while executing UDP callback", exc_info=exc)
 
 
 class UdpSocket:
@@ -72,8 +116,16 @@ class UdpSocket:
         self._buffer_size = buffer_size
         self._address = address
         self._socket = None
-        self._send_queue = queue.Queue()
-        self._receive_callbacks = []
+        # datagrams are sent by the transport on the socket loop,
+        # the queue is drained once per burst of sends
+        self._send_queue = queue.Queue(UDP_SEND_QUEUE_SIZE)
+        self._send_lock = threading.Lock()
+        self._drain_scheduled = False
+        self._writing = True
+        self._broadcast_bucket = TokenBucket(UDP_BROADCAST_RATE, UDP_BROADCAST_BURST)
+        self._handlers: Dict[MessageType, MessageHandler] = {}
+        self._receive_callback: Optional[ReceiveCallback] = None
+        self._loop: AbstractEventLoop = None
         self._transport = None
         self._broadcast_mode = False
 
@@ -83,41 +135,115 @@ class UdpSocket:
         self._transport, protocol = asyncio.run_coroutine_threadsafe(
             self._create_udp(), loop
         ).result()
+        self._loop = loop
 
     async def _create_udp(self):
         return await asyncio.get_event_loop().create_datagram_endpoint(
             lambda: AsyncioDatagramProtocol(
-                receive_callbacks=list(self._receive_callbacks),
+                handlers=dict(self._handlers),
                 broadcast_mode=self._broadcast_mode,
+                writing_callback=self._set_writing,
+                receive_callback=self._receive_callback,
             ),
             sock=self._socket,
         )
 
     def stop(self):
+        self._loop = None
         self._transport.close()
         self._socket.close()
         del self._socket
         self._socket = None
 
-    def add_receive_callback(self, callback: Callable[[bytes, Tuple[str, int]], None]):
+    def add_handler(self, message_type: MessageType, handler: MessageHandler):
+        if self._socket:
+            raise LogicError("Cannot add callbacks while the socket is running")
+        if message_type in self._handlers:
+            raise LogicError(f"Handler for {message_type.name} already exists")
+        self._handlers[message_type] = handler
+
+    def set_receive_callback(self, callback: ReceiveCallback):
+        """
+        Sets the callback called with the sender address of every valid datagram
+        """
         if self._socket:
             raise LogicError("Cannot add callbacks while the socket is running")
-        self._receive_callbacks.append(callback)
+        self._receive_callback = callback
 
     def send(self, data: bytes):
         """queries send method"""
         self.send_to(data, self._address[0], self._address[1])
 
     def send_to(self, data: bytes, ip_address: str, port: int = None):
-        """queries send_to method"""
+        """
+        queues the datagram to be sent by the socket loop, never blocks.
+        Raises LogicError if the send queue is full.
+        """
         if port is None:
             port = self._address[1]
         if ip_address is None or port is None:
             raise ValueError("Destination port or ip is not specified")
-        
-        self._socket.sendto(data, (ip_address, port))
+        if self._loop is None:
+            raise LogicError("Cannot send while the socket is not running")
+
+        try:
+            self._send_queue.put_nowait((data, (ip_address, port)))
+        except queue.Full:
+            raise LogicError(f"UDP send queue is full, dropping datagram to {ip_address}")
+        with self._send_lock:
+            if self._drain_scheduled:
+                return
+            self._drain_scheduled = True
+        self._loop.call_soon_threadsafe(self._drain_send_queue)
+
+    def _drain_send_queue(self):
+        """
+        Sends the queued datagrams through the transport, runs on the socket loop.
+        Sends at most UDP_SEND_BATCH datagrams before yielding to the receivers,
+        stops while the socket buffer is full, paces broadcasts.
+        """
+        with self._send_lock:
+            self._drain_scheduled = False
+        transport = self._transport
+        if transport is None or transport.is_closing():
+            return
+        for _ in range(UDP_SEND_BATCH):
+            if not self._writing:
+                return
+            if self._broadcast_mode:
+                delay = self._broadcast_bucket.delay()
+                if delay:
+                    self._schedule_drain(delay)
+                    return
+            try:
+                data, address = self._send_queue.get_nowait()
+            except queue.Empty:
+                return
+            if self._broadcast_mode:
+                self._broadcast_bucket.consume()
+            transport.sendto(data, address)
+        self._schedule_drain()
 
+    def _schedule_drain(self, delay: float = 0):
+        """
+        Runs on the socket loop
+        """
+        with self._send_lock:
+            if self._drain_scheduled:
+                return
+            self._drain_scheduled = True
+        if delay:
+            self._loop.call_later(delay, self._drain_send_queue)
+        else:
+            self._loop.call_soon(self._drain_send_queue)
 
+    def _set_writing(self, writing: bool):
+        """
+        Called by the protocol when the socket buffer fills up or drains
+        """
+        self._writing = writing
+        if writing:
+            self._drain_send_queue()
 
     def _init_socket(self):
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -131,3 +257,40 @@ class BroadcastSocket(UdpSocket):
     def _init_socket(self):
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+
+class MulticastSocket(UdpSocket):
+    """
+    Sends to and receives from an IP multicast group, joined on `ifaces`.
+    The first interface sends the datagrams.
+    """
+
+    def __init__(
+        self,
+        address,
+        ifaces: List[str],
+        ttl: int = 1,
+        loop: bool = False,
+        buffer_size=UDP_BUFFER_SIZE,
+    ):
+        super().__init__(address, buffer_size)
+        self._ifaces = ifaces or ["default"]
+        self._ttl = ttl
+        self._multicast_loop = loop
+        self._broadcast_mode = True
+
+    def _init_socket(self):
+        group = socket.inet_aton(self._address[0])
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # several instances on a single host might listen to the group
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self._ttl)
+        self._socket.setsockopt(
+            socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, int(self._multicast_loop)
+        )
+        interfaces = [socket.inet_aton(get_ip4_address(iface)) for iface in self._ifaces]
+        self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, interfaces[0])
+        for interface in interfaces:
+            self._socket.setsockopt(
+                socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, group + interface
+            )